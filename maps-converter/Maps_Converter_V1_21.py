@@ -12,10 +12,21 @@
 #
 # /-+ Maps_Converter_V1_X.py
 #   | monitor.py
+#   | shared_tile_cache.py (RAM cache shared by all workers)
+#   | remote_tile_cache.py (RAM cache shared by several servers in memcached, RAM_CACHE_SERVERS)
+#   | seed_tiles.py (fills the tile cache for a region before a trip)
+#   | tile_standin.py (local tile server stand-in for load tests)
+#   | tile_store.py (disk cache backends: file tree, MBTiles or pack files, converter, compaction)
 #   |
 #   +-logs/metrics.log
 #   |    
-#   +-tile_cache/mtype/ZZZ/XXX/YYY.pgn
+#   +-tile_cache/base/mtype/ZZZ/XXX/YYY.png (or .jpg, tiles are cached as delivered by the tile server)
+#   |
+#   +-tile_cache/seamark/ZZZ/XXX/YYY.png
+#   |
+#   +-tile_cache/base_mtype.mbtiles, tile_cache/seamark.mbtiles (with TILE_STORE=mbtiles instead of the file tree)
+#   |
+#   +-tile_cache/packs/base_mtype/GGGG-NNNNN.pack, index-GGGG.log (with TILE_STORE=pack)
 #   |    
 #   +-static/map_logic_X.js
 #
@@ -43,6 +54,12 @@
 # Output of a help page
 # http://localhost:8080/help
 #
+# Output of the disk cache usage per map type and zoom level
+# http://localhost:8080/cache_usage
+#
+# Health and warming state of the RAM cache (cold, warming, warm)
+# http://localhost:8080/health
+#
 #########################################################################################################################
 
 import io
@@ -58,16 +75,32 @@ import csv
 import time
 import random
 import inspect
+import zlib
+import json
+import atexit
+import sqlite3
 from PIL import Image, ImageOps, ImageDraw, ImageFont
 from io import BytesIO
 from flask import Flask, request, jsonify, send_file, session
 from flask_cors import CORS
 from flask_compress import Compress
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
 from collections import deque
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Thread, Lock, Event, Condition
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
 from monitor import init_monitoring
+from shared_tile_cache import SharedTileCache, SharedTokenBuckets
+from remote_tile_cache import MemcachedTileCache, parse_servers
+from tile_store import open_tile_store, sniff_tile_format, tile_digest, write_file_atomic
+
+try:
+    import fcntl  # File locks between worker processes (not available on Windows)
+except ImportError:
+    fcntl = None
 
 
 ###################################################################################
@@ -97,6 +130,392 @@ def get_script_name() -> str:
     # 3. Fallback: call name
     return os.path.basename(sys.argv[0]) or "unknown.py"
    
+###################################################################################
+# Upstream HTTP client with connection pools, timeouts and retries                #
+###################################################################################
+
+# Gunicorn settings (see .env), used to size the connection pools per worker process
+WORKERS = int(os.environ.get("WORKERS", 4))
+THREADS = int(os.environ.get("THREADS", 4))
+
+# Maximum number of parallel tile downloads per image request
+TILE_FETCH_WORKERS = 16
+
+# Maximum number of open connections per tile server for the whole server (all workers)
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 64))
+UPSTREAM_POOL_SIZE = max(THREADS, UPSTREAM_MAX_CONNECTIONS // max(1, WORKERS))  # Connections per host and worker
+
+UPSTREAM_CONNECT_TIMEOUT = 3.05         # Connect timeout in seconds
+UPSTREAM_READ_TIMEOUT = 10.0            # Read timeout in seconds
+UPSTREAM_RETRIES = 2                    # Number of retries after the first attempt
+UPSTREAM_BACKOFF = 0.25                 # Base delay for retries in seconds (doubled per retry, with jitter)
+UPSTREAM_RETRY_STATUS = (429, 500, 502, 503, 504)  # Status codes that are worth a retry
+
+# One keep-alive session per tile server host
+upstream_sessions = {}
+upstream_sessions_lock = Lock()
+
+def get_upstream_session(host):
+    """
+    Returns the shared session for a tile server host. The session keeps a pool
+    of warm keep-alive connections, so a tile miss costs no new TCP/TLS handshake.
+    """
+    with upstream_sessions_lock:
+        http_session = upstream_sessions.get(host)
+        if http_session is None:
+            http_session = requests.Session()
+            # pool_block: wait for a free connection instead of opening more than UPSTREAM_POOL_SIZE
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE, pool_block=True, max_retries=0)
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+            upstream_sessions[host] = http_session
+        return http_session
+
+# Request priorities for the tile servers
+PRIORITY_INTERACTIVE = 0    # Tiles for a device request that is waiting for its image
+PRIORITY_BACKGROUND = 1     # Prefetching, seeding and other work nobody is waiting for
+
+# Function to fetch the tile from OSM with a fake User-Agent header (depending on the OS)
+def get_user_agent():
+    os_name = platform.system()
+    if os_name == "Windows":
+        return "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:148.0) Gecko/20100101"
+    elif os_name == "Linux":
+        return "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:148.0) Gecko/20100101 Firefox/148.0"
+    elif os_name == "Darwin":  # MacOS
+        return "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7; rv:148.0) Gecko/20100101"
+    else:
+        return "Mozilla/5.0 (compatible; Unknown OS; rv:148.0) Gecko/20100101"
+
+# User-Agent for the tile servers, determined once at startup
+USER_AGENT = get_user_agent()
+APP_USER_AGENT = 'MyApplication/1.0 (http://myapplication.org; contact: info@myapplication.org'
+
+# Registry of the tile server providers, built once at startup
+#   hosts:       Mirror hosts, the tiles are spread over all mirrors for more parallel connections
+#   headers:     Request headers
+#   rate_limit:  Request limit for the whole server (all workers): (requests per second, burst size)
+#   max_age:     Freshness of the tiles in seconds, older tiles are revalidated in the background
+#   attribution: Copyright of the map data
+TILE_PROVIDERS = {
+    "osm": {
+        "hosts": ["tile.openstreetmap.org"],    # OSM asks for the single host name (no a/b/c subdomains)
+        "headers": {'User-Agent': APP_USER_AGENT, 'Referer': 'https://www.openstreetmap.de/'},
+        "rate_limit": (20, 80),                 # OSM tile usage policy, no bulk downloads
+        "max_age": 7 * 24 * 3600,
+        "attribution": "(C) OpenStreetMap",
+    },
+    "openseamap": {
+        "hosts": ["t1.openseamap.org"],
+        "headers": {'User-Agent': USER_AGENT, 'Referer': 'https://t1.openseamap.org/'},
+        "rate_limit": (20, 80),
+        "max_age": 7 * 24 * 3600,               # Sea marks change more often than base maps
+        "attribution": "(C) OpenSeaMap",
+    },
+    "google": {
+        "hosts": ["mt0.google.com", "mt1.google.com", "mt2.google.com", "mt3.google.com"],
+        "headers": {'User-Agent': USER_AGENT, 'Referer': 'https://mt1.google.com/'},
+        "rate_limit": (50, 200),
+        "max_age": 30 * 24 * 3600,
+        "attribution": "(C) Google",
+    },
+    "opentopomap": {
+        "hosts": ["a.tile.opentopomap.org", "b.tile.opentopomap.org", "c.tile.opentopomap.org"],
+        "headers": {'User-Agent': USER_AGENT, 'Referer': 'https://tile.opentopomap.org/'},
+        "rate_limit": (10, 40),                 # Small community server
+        "max_age": 30 * 24 * 3600,
+        "attribution": "(C) OpenTopoMap",
+    },
+    "esri": {
+        "hosts": ["server.arcgisonline.com"],
+        "headers": {'User-Agent': USER_AGENT, 'Referer': 'https://server.arcgisonline.com/'},
+        "rate_limit": (30, 120),
+        "max_age": 90 * 24 * 3600,              # Aerial images
+        "attribution": "(C) Esri",
+    },
+    "stadia": {
+        "hosts": ["tiles.stadiamaps.com"],
+        "headers": {'User-Agent': USER_AGENT, 'Referer': 'https://tiles.stadiamaps.com/'},
+        "rate_limit": (20, 80),                 # Limited by the free API key
+        "max_age": 30 * 24 * 3600,
+        "attribution": "(C) Stadia Maps",
+    },
+    "freenauticalchart": {
+        "hosts": ["freenauticalchart.net"],
+        "headers": {'User-Agent': USER_AGENT, 'Referer': 'https://freenauticalchart.net/'},
+        "rate_limit": (10, 40),                 # Small community server
+        "max_age": 30 * 24 * 3600,
+        "attribution": "(C) freenauticalchart.net",
+    },
+}
+DEFAULT_RATE_LIMIT = (10, 40)
+
+# Tile server providers by host name (all mirrors)
+PROVIDER_HOSTS = {host: name for name, provider in TILE_PROVIDERS.items() for host in provider["hosts"]}
+
+# Base URL of a local tile server stand-in (see tile_standin.py), e.g. http://127.0.0.1:8090
+# All tile requests go to <TILE_SERVER_OVERRIDE>/<host>/<path> instead of https://<host>/<path>
+TILE_SERVER_OVERRIDE = os.environ.get("TILE_SERVER_OVERRIDE", "").rstrip("/")
+
+# Function to get the tile server host of a URL, also for URLs redirected to the stand-in
+def get_url_host(url):
+    if TILE_SERVER_OVERRIDE and url.startswith(TILE_SERVER_OVERRIDE + "/"):
+        return url[len(TILE_SERVER_OVERRIDE) + 1:].split("/", 1)[0]
+    return urlsplit(url).netloc
+
+def get_provider(url):
+    host = get_url_host(url)
+    return PROVIDER_HOSTS.get(host, host)
+
+BACKGROUND_RESERVE = 0.5    # Part of the burst that background requests leave for interactive requests
+
+# Token buckets of the providers shared by all worker processes (file in /dev/shm, like the RAM cache)
+try:
+    upstream_buckets = SharedTokenBuckets(os.environ.get("SHARED_CACHE_NAME", "maps_converter_tiles") + "_rate")
+except OSError as e:
+    # No shared memory, every worker process gets its share (1/WORKERS) of the limit and of the burst
+    print(f"Shared rate limit not available ({e}), using a rate limit per worker process.")
+    upstream_buckets = None
+
+# Token buckets (without shared memory) and waiting interactive requests of the providers in this worker process
+provider_buckets = {}
+provider_condition = Condition()
+
+# Function to take a token from the bucket of a provider, returns 0.0 or the seconds until enough tokens are available
+def take_upstream_token(bucket, provider, rate, burst, needed):
+    if upstream_buckets is not None:
+        return upstream_buckets.take(provider, rate, burst, needed)
+    now = time.time()
+    bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+    if bucket["tokens"] >= needed:
+        bucket["tokens"] -= 1.0
+        return 0.0
+    return (needed - bucket["tokens"]) / rate
+
+def acquire_upstream_slot(provider, priority):
+    """
+    Waits until the token bucket of the provider allows another request.
+    All worker processes take from one bucket per provider, so a single
+    worker can use the whole burst for a cold frame. Interactive requests
+    are served first: background requests wait while interactive requests
+    of the same worker are waiting and never use the reserved part of the
+    burst, so device frames stay fast during prefetching or seeding.
+    """
+    rate, burst = TILE_PROVIDERS.get(provider, {}).get("rate_limit", DEFAULT_RATE_LIMIT)
+    if upstream_buckets is None:
+        rate = rate / max(1, WORKERS)
+        burst = max(1.0, burst / max(1, WORKERS))
+    reserve = min(BACKGROUND_RESERVE * burst, burst - 1.0) if priority == PRIORITY_BACKGROUND else 0.0
+    waited = False
+    with provider_condition:
+        bucket = provider_buckets.setdefault(provider, {"tokens": burst, "updated": time.time(), "interactive_waiting": 0})
+        if priority == PRIORITY_INTERACTIVE:
+            bucket["interactive_waiting"] += 1
+        try:
+            while True:
+                delay = 1.0 / rate
+                if priority == PRIORITY_INTERACTIVE or bucket["interactive_waiting"] == 0:
+                    delay = take_upstream_token(bucket, provider, rate, burst, 1.0 + reserve)
+                    if delay == 0.0:
+                        break
+                waited = True
+                provider_condition.wait(timeout=max(0.01, delay))
+        finally:
+            if priority == PRIORITY_INTERACTIVE:
+                bucket["interactive_waiting"] -= 1
+                provider_condition.notify_all()
+    if waited:
+        count_cache_event("rate_limit_wait")
+
+# Circuit breaker per provider: fail fast while a tile server is down
+CIRCUIT_FAILURE_THRESHOLD = 5   # Consecutive failed attempts (errors, timeouts, 429/5xx) that open the circuit
+CIRCUIT_OPEN_TIME = 30          # Seconds the circuit stays open before a single trial request is let through
+
+# Circuit states of the providers in this worker process
+provider_circuits = {}
+provider_circuits_lock = Lock()
+
+class ProviderUnavailable(requests.RequestException):
+    """Raised instead of a request while the circuit of the provider is open."""
+
+def circuit_allows_request(provider):
+    with provider_circuits_lock:
+        circuit = provider_circuits.setdefault(provider, {"failures": 0, "opened": None, "trial": False})
+        if circuit["opened"] is None:
+            return True
+        # Half open: one trial request after the open time, all others keep failing fast
+        if not circuit["trial"] and time.time() - circuit["opened"] >= CIRCUIT_OPEN_TIME:
+            circuit["trial"] = True
+            return True
+        return False
+
+def record_circuit_result(provider, success):
+    with provider_circuits_lock:
+        circuit = provider_circuits.setdefault(provider, {"failures": 0, "opened": None, "trial": False})
+        if success:
+            if circuit["opened"] is not None:
+                print(f"Circuit for {provider} closed.")
+            circuit.update(failures=0, opened=None, trial=False)
+            return
+        circuit["failures"] += 1
+        if circuit["trial"] or (circuit["opened"] is None and circuit["failures"] >= CIRCUIT_FAILURE_THRESHOLD):
+            print(f"Circuit for {provider} opened after {circuit['failures']} failures.")
+            circuit.update(opened=time.time(), trial=False)
+
+def get_circuit_states():
+    with provider_circuits_lock:
+        return {provider: ("closed" if circuit["opened"] is None else "open") for provider, circuit in provider_circuits.items()}
+
+# Hedged requests: a tile request slower than the p95 latency of its provider gets a
+# duplicate request to another mirror host, the first answer wins
+HEDGE_SAMPLES = 200         # Latency samples per provider
+HEDGE_MIN_SAMPLES = 20      # Samples needed before requests are hedged
+HEDGE_MIN_DELAY = 0.05      # Shortest hedge delay in seconds
+HEDGE_BUDGET = 0.05         # Hedges per request (5 % extra load on the tile server)
+HEDGE_BUDGET_BURST = 10     # Hedges saved up for bursts of slow requests
+HEDGE_WORKERS = THREADS * TILE_FETCH_WORKERS * 2    # Threads for hedged requests of this worker process (primary and hedge of every download)
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+# Latency samples and hedge budget per provider
+provider_latencies = {}
+provider_hedge_budgets = {}
+provider_hedge_lock = Lock()
+
+def record_upstream_latency(provider, latency):
+    with provider_hedge_lock:
+        samples = provider_latencies.get(provider)
+        if samples is None:
+            samples = provider_latencies[provider] = deque(maxlen=HEDGE_SAMPLES)
+        samples.append(latency)
+
+def get_hedge_delay(provider):
+    """
+    Returns the p95 latency of the provider in seconds as delay for the hedged
+    request, or None if there are not enough samples yet. Every call earns a
+    share of a hedge for the budget of the provider.
+    """
+    with provider_hedge_lock:
+        budget = provider_hedge_budgets.get(provider, 0.0)
+        provider_hedge_budgets[provider] = min(HEDGE_BUDGET_BURST, budget + HEDGE_BUDGET)
+        samples = provider_latencies.get(provider)
+        if samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+    return max(HEDGE_MIN_DELAY, ordered[int(0.95 * (len(ordered) - 1))])
+
+def take_hedge_budget(provider):
+    with provider_hedge_lock:
+        budget = provider_hedge_budgets.get(provider, 0.0)
+        if budget < 1.0:
+            return False
+        provider_hedge_budgets[provider] = budget - 1.0
+        return True
+
+def get_hedge_states():
+    with provider_hedge_lock:
+        states = {}
+        for provider, samples in provider_latencies.items():
+            ordered = sorted(samples)
+            states[provider] = {
+                "p95": round(ordered[int(0.95 * (len(ordered) - 1))], 3) if ordered else None,
+                "samples": len(ordered),
+                "budget": round(provider_hedge_budgets.get(provider, 0.0), 2),
+            }
+        return states
+
+# Function to move a tile URL to the next mirror host of its provider (same host if there is no mirror)
+def get_mirror_url(url, provider):
+    host = get_url_host(url)
+    hosts = TILE_PROVIDERS.get(provider, {}).get("hosts", [host])
+    mirror = hosts[(hosts.index(host) + 1) % len(hosts)] if host in hosts else host
+    return url.replace(host, mirror, 1)
+
+# Function to send one timed request to a tile server
+def timed_get(url, headers, provider):
+    http_session = get_upstream_session(get_url_host(url))
+    start = time.monotonic()
+    response = http_session.get(url, headers=headers, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    if response.status_code not in UPSTREAM_RETRY_STATUS:
+        record_upstream_latency(provider, time.monotonic() - start)
+    return response
+
+# Function to send the primary request of a hedged request, started is set when a thread has taken it
+def started_get(started, url, headers, provider):
+    started.set()
+    return timed_get(url, headers, provider)
+
+# Function to send the hedged request after it got its own rate limit slot
+def hedge_get(url, headers, provider, priority):
+    acquire_upstream_slot(provider, priority)
+    return timed_get(url, headers, provider)
+
+def hedged_get(url, headers, provider, priority):
+    """
+    Sends a request to a tile server. Interactive requests that take longer than
+    the p95 latency of the provider are duplicated to another mirror host while
+    the hedge budget of the provider allows it. The first answer is returned,
+    the slower request finishes in the background and is dropped.
+    """
+    delay = get_hedge_delay(provider) if priority == PRIORITY_INTERACTIVE else None
+    if delay is None:
+        return timed_get(url, headers, provider)
+    # The hedge delay counts from the start of the request, not from the submit (time in the executor queue)
+    started = Event()
+    primary = hedge_executor.submit(started_get, started, url, headers, provider)
+    started.wait()
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeout:
+        pass
+    if not take_hedge_budget(provider):
+        return primary.result()
+    count_cache_event("hedge")
+    hedge = hedge_executor.submit(hedge_get, get_mirror_url(url, provider), headers, provider, priority)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    count_cache_event("hedge_win")
+                return future.result()
+            error = future.exception()
+    raise error
+
+def upstream_get(url, headers, priority=PRIORITY_INTERACTIVE):
+    """
+    Loads a URL from a tile server over the pooled session of its host.
+    Every attempt waits for the rate limit of the provider first, slow
+    interactive attempts are hedged to a mirror host (see hedged_get).
+    Connection errors, timeouts and temporary server errors are retried
+    with exponential backoff and full jitter. Returns the last response,
+    raises requests.RequestException when all attempts failed and
+    ProviderUnavailable while the circuit of the provider is open.
+    """
+    provider = get_provider(url)
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        if not circuit_allows_request(provider):
+            raise ProviderUnavailable(f"Circuit for {provider} is open")
+        acquire_upstream_slot(provider, priority)
+        try:
+            response = hedged_get(url, headers, provider, priority)
+            record_circuit_result(provider, response.status_code not in UPSTREAM_RETRY_STATUS)
+            if response.status_code not in UPSTREAM_RETRY_STATUS or attempt == UPSTREAM_RETRIES:
+                return response
+            print(f"Status Code {response.status_code} for {url}, retry {attempt + 1}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_circuit_result(provider, False)
+            if attempt == UPSTREAM_RETRIES:
+                raise
+            print(f"Request error for {url}: {e}, retry {attempt + 1}")
+        except requests.RequestException:
+            # Not retried (broken or undecodable body, redirect loop), but it still ends a half open trial
+            record_circuit_result(provider, False)
+            raise
+        time.sleep(random.uniform(0, UPSTREAM_BACKOFF * (2 ** attempt)))
+
 ###################################################################################
 # MB-Tiles Proxy with File and RAM Cache                                          #
 ###################################################################################        
@@ -104,8 +523,83 @@ def get_script_name() -> str:
 # Set maximum RAM cache size (e.g., 512 MB)
 RAM_CACHE_SIZE = 512 * 1024 * 1024  # 512 MB
 
-# RAM cache for fast access
-ram_cache = dc.Cache(size_limit=RAM_CACHE_SIZE)  # RAM cache, no disk persistence
+# Zoom levels up to this level are pinned in the RAM cache (overview tiles used by all devices)
+RAM_PIN_MAX_ZOOM = 8
+
+# RAM cache backends: SharedTileCache (all workers of this server), LocalTileCache (per worker process) and
+# MemcachedTileCache (all servers behind a load balancer, one of the others as near cache). Interface used by
+# the server: get(key, default, count), set(key, value, expire, pin, admit_key), delete(key), key in cache, hot_keys(suffix), volume()
+class LocalTileCache(dc.Cache):
+    """
+    RAM cache per worker process with the interface of SharedTileCache (no admission, no pinning).
+    """
+
+    def get(self, key, default=None, count=True):
+        return super().get(key, default)
+
+    def set(self, key, value, expire=None, pin=False, admit_key=None):
+        return super().set(key, value, expire=expire)
+
+    def hot_keys(self, suffix=""):
+        return [(key, 0, 0.0) for key in self.iterkeys() if key.endswith(suffix)]
+
+# RAM cache for fast access, shared by all worker processes (arena in /dev/shm, see shared_tile_cache.py)
+# New tiles only replace tiles that are requested less often (admission), so scans do not flush the hot tiles
+SHARED_CACHE_NAME = os.environ.get("SHARED_CACHE_NAME", "maps_converter_tiles")
+try:
+    local_ram_cache = SharedTileCache(SHARED_CACHE_NAME, RAM_CACHE_SIZE)
+except OSError as e:
+    # No shared memory (e.g. Windows or a too small /dev/shm in Docker), every worker gets its own cache
+    print(f"Shared RAM cache not available ({e}), using a RAM cache per worker process.")
+    local_ram_cache = LocalTileCache(size_limit=RAM_CACHE_SIZE)
+
+# RAM cache shared by several servers (memcached "host:port,host:port", empty: only the RAM cache of this server)
+RAM_CACHE_SERVERS = parse_servers(os.getenv("RAM_CACHE_SERVERS", ""))
+if RAM_CACHE_SERVERS:
+    ram_cache = MemcachedTileCache(RAM_CACHE_SERVERS, local_ram_cache)
+else:
+    ram_cache = local_ram_cache
+
+# Directory of the disk cache
+TILE_CACHE_DIR = os.path.join(os.getcwd(), "tile_cache")
+
+# Threads for background work (revalidation of stale tiles, prefetch), requests run with PRIORITY_BACKGROUND
+BACKGROUND_WORKERS = 4
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="background")
+
+# Tile downloads in progress in this worker process (single-flight)
+inflight_tiles = {}
+inflight_lock = Lock()
+
+def single_flight(key, function, *args):
+    """
+    Runs function(*args) only once for concurrent calls with the same key.
+    The first caller does the work, all other callers wait for its result
+    (or its exception) instead of starting the same download again.
+    """
+    with inflight_lock:
+        call = inflight_tiles.get(key)
+        leader = call is None
+        if leader:
+            call = {"done": Event(), "result": None, "error": None}
+            inflight_tiles[key] = call
+
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    try:
+        call["result"] = function(*args)
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with inflight_lock:
+            del inflight_tiles[key]
+        call["done"].set()
 
 # Function to convert Latitude/Longitude to Web Mercator Tile X, Y, and pixel offset
 def latlon_to_xyz(lat, lon, zoom):
@@ -131,199 +625,1193 @@ def latlon_to_xyz(lat, lon, zoom):
     return x, y, x_offset, y_offset
     
 
-# Function to fetch the tile from OSM with a fake User-Agent header (depending on the OS)
-def get_user_agent():
-    os_name = platform.system()
-    if os_name == "Windows":
-        return "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:148.0) Gecko/20100101"
-    elif os_name == "Linux":
-        return "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:148.0) Gecko/20100101 Firefox/148.0"
-    elif os_name == "Darwin":  # MacOS
-        return "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7; rv:148.0) Gecko/20100101"
-    else:
-        return "Mozilla/5.0 (compatible; Unknown OS; rv:148.0) Gecko/20100101"
-
-# Function to fetch MB-Tiles tiles
-def fetch_osm_tile(x, y, zoom, map_type):
-    global old_value    # Timer status toggel between 0 und 1
-    global myToken      # Token
-    # Define cache key for RAM cache
-    cache_key = f"{map_type}/{zoom}/{x}/{y}.png"
-    
+# Tile layers, the layer name is also the directory in the disk cache
+#   provider:  Tile server provider (see TILE_PROVIDERS)
+#   url:       URL template with {host}, {zoom}, {x} and {y}
+#   max_zoom:  Highest zoom level of the tile server, higher zoom levels are scaled from the cache
+#   format:    Image format of the tile server, tiles are cached as delivered (png, jpg)
+TILE_LAYERS = {
+    "base/1": {"provider": "osm", "url": "https://{host}/{zoom}/{x}/{y}.png", "max_zoom": 19, "format": "png"},                         # Open Street Map color
+    "base/2": {"provider": "google", "url": "https://{host}/vt/lyrs=y&x={x}&y={y}&z={zoom}", "max_zoom": 20, "format": "jpg"},          # Google Hybrid
+    "base/3": {"provider": "google", "url": "https://{host}/vt/lyrs=m&x={x}&y={y}&z={zoom}", "max_zoom": 20, "format": "jpg"},          # Google Street
+    "base/4": {"provider": "google", "url": "https://{host}/vt/lyrs=p&x={x}&y={y}&z={zoom}", "max_zoom": 20, "format": "jpg"},          # Google Terrain Street Hybrid
+    "base/5": {"provider": "opentopomap", "url": "https://{host}/{zoom}/{x}/{y}.png", "max_zoom": 17, "format": "png"},                 # Open Topo Map
+    "base/6": {"provider": "esri", "url": "https://{host}/ArcGIS/rest/services/World_Imagery/MapServer/tile/{zoom}/{y}/{x}", "max_zoom": 19, "format": "jpg"},  # Esri Base Map
+    "base/7": {"provider": "stadia", "url": "https://{host}/tiles/stamen_toner/{zoom}/{x}/{y}.png?api_key=2ab75b65-06ac-4c54-b041-bf1a65d3a2ab", "max_zoom": 20, "format": "png"},  # Stadimaps toner sw
+    "base/8": {"provider": "stadia", "url": "https://{host}/tiles/stamen_terrain/{zoom}/{x}/{y}.png?api_key=2ab75b65-06ac-4c54-b041-bf1a65d3a2ab", "max_zoom": 20, "format": "png"},  # Stadimaps terrain
+    "base/9": {"provider": "freenauticalchart", "url": "https://{host}/qmap-de/{zoom}/{x}/{y}.png", "max_zoom": 18, "format": "png"},   # Free Nautical Chart (Quantenschaum)
+    "seamark": {"provider": "openseamap", "url": "https://{host}/seamark/{zoom}/{x}/{y}.png", "max_zoom": 18, "format": "png"},         # Open Sea Map Sea Marks (transparent overlay)
+}
+
+# Map types: (base layer, overlay layer or None)
+MAP_TYPES = {
+    1: ("base/1", "seamark"),
+    2: ("base/2", "seamark"),
+    3: ("base/3", "seamark"),
+    4: ("base/4", "seamark"),
+    5: ("base/5", "seamark"),
+    6: ("base/6", "seamark"),
+    7: ("base/7", "seamark"),
+    8: ("base/8", "seamark"),
+    9: ("base/9", None),        # No overlay
+}
+DEFAULT_MAP_TYPE = 1    # Unknown map types use the layers and the cache of this map type
+
+# Disk cache backend (see tile_store.py): tree = one file per tile, mbtiles = one MBTiles file per layer,
+# pack = append-only pack files per layer read through mmap with an index in memory
+TILE_STORE = os.getenv("TILE_STORE", "tree") or "tree"
+tile_store = open_tile_store(
+    TILE_STORE, TILE_CACHE_DIR,
+    {layer: info["format"] for layer, info in TILE_LAYERS.items()},
+    {layer: TILE_PROVIDERS[info["provider"]]["attribution"] for layer, info in TILE_LAYERS.items()},
+)
+
+# Function to build the source (layer, url, headers) of a layer tile
+def get_layer_source(layer, x, y, zoom):
+    layer_info = TILE_LAYERS[layer]
+    provider = TILE_PROVIDERS[layer_info["provider"]]
+    hosts = provider["hosts"]
+    # Neighbouring tiles go to different mirrors, the same tile always to the same mirror (HTTP caches)
+    host = hosts[(x + y) % len(hosts)]
+    url = layer_info["url"].format(host=host, zoom=zoom, x=x, y=y)
+    if TILE_SERVER_OVERRIDE:
+        url = url.replace("https://", TILE_SERVER_OVERRIDE + "/", 1)
+    return (layer, url, provider["headers"])
+
+# Function to choose the tile sources of a map type: base layer and optional sea marks overlay
+def get_tile_sources(x, y, zoom, map_type):
+    """
+    Returns the sources (layer, url, headers) of the base layer and of the overlay layer
+    of a map type. The overlay source is None if the map type has no overlay. Layers
+    are cached independently, so one sea marks tile serves all base maps.
+    """
+    base_layer, overlay_layer = MAP_TYPES.get(map_type, MAP_TYPES[DEFAULT_MAP_TYPE])
+    base_source = get_layer_source(base_layer, x, y, zoom)
+    overlay_source = get_layer_source(overlay_layer, x, y, zoom) if overlay_layer is not None else None
+    return base_source, overlay_source
+
+# Lock files for tile downloads shared by all worker processes
+TILE_LOCK_DIR = os.path.join(TILE_CACHE_DIR, ".locks")
+TILE_LOCK_STRIPES = 4096    # Number of lock files, tiles are spread over the lock files by hash
+TILE_LOCK_TIMEOUT = 30      # Maximum waiting time for a lock in seconds, then the tile is fetched anyway
+
+@contextmanager
+def tile_file_lock(key):
+    """
+    Exclusive lock for a tile across all gunicorn worker processes.
+    Uses flock() on a fixed set of lock files, so the number of lock files
+    stays constant no matter how many tiles are in the cache. Without
+    fcntl (Windows) only the single-flight lock of the process is used.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(TILE_LOCK_DIR, exist_ok=True)
+    lock_path = os.path.join(TILE_LOCK_DIR, f"{zlib.crc32(key.encode()) % TILE_LOCK_STRIPES}.lock")
+    with open(lock_path, "a") as lock_file:
+        deadline = time.time() + TILE_LOCK_TIMEOUT
+        locked = False
+        while not locked:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                if time.time() > deadline:
+                    print(f"Lock for tile {key} timed out, fetching without lock.")
+                    break
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if locked:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Freshness of tiles of unknown providers in seconds (see TILE_PROVIDERS)
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+REVALIDATE_RETRY_TIME = 3600    # Seconds until a failed revalidation is tried again
+
+# Negative cache: time to live in seconds for tiles the tile server could not deliver, per status code
+NEGATIVE_CACHE_TTL = {
+    400: 24 * 3600,         # Bad request (e.g. zoom level not supported)
+    403: 3600,              # Forbidden (e.g. API key or rate limit)
+    404: 7 * 24 * 3600,     # Tile does not exist (e.g. outside the area of the map)
+    410: 30 * 24 * 3600,    # Tile removed
+}
+NEGATIVE_CACHE_DEFAULT_TTL = 300    # All other status codes (e.g. 5xx after all retries)
+NEGATIVE_CACHE_ERROR_TTL = 60       # Timeouts, connection errors and invalid images (status 0)
+NEGATIVE_PERMANENT_STATUS = (404, 410)  # Tiles that do not exist, a composed tile without them is complete
+
+# Tile cache statistics of this worker process (see /cache_stats)
+cache_stats = Counter()
+cache_stats_lock = Lock()
+
+def count_cache_event(event):
+    with cache_stats_lock:
+        cache_stats[event] += 1
+
+# Overlay layers that are transparent in most places of the world
+SPARSE_LAYERS = {"seamark"}
+
+# Marker for an empty (fully transparent) tile of a sparse layer, stored as zero bytes in RAM and disk cache
+EMPTY_TILE = "empty"
+
+# Function to convert cached tile data to an image or to the empty tile marker
+def decode_tile(tile_data):
+    if len(tile_data) == 0:
+        return EMPTY_TILE
+    return Image.open(BytesIO(tile_data))
+
+# Function to check if an image is fully transparent
+def is_transparent(image):
+    if "A" not in image.getbands() and "transparency" not in image.info:
+        return False
+    return image.convert("RGBA").getchannel("A").getbbox() is None
+
+# Identical tiles (plain sea) from this size on are stored once in the RAM cache, smaller tiles take the smallest chunk anyway
+RAM_DEDUP_MIN_SIZE = 512
+RAM_DEDUP_SEEN = 65536      # Digests of tile contents remembered by this worker process (second occurrence: shared blob)
+RAM_BLOB_REF = b"blob/"     # Value of a tile key that refers to the shared blob blob/<digest>
+
+ram_seen_digests = OrderedDict()
+ram_seen_digests_lock = Lock()
+
+# Function to check if a tile content was stored before (remembers the content for the next check)
+def is_seen_content(digest):
+    with ram_seen_digests_lock:
+        if digest in ram_seen_digests:
+            ram_seen_digests.move_to_end(digest)
+            return True
+        ram_seen_digests[digest] = True
+        if len(ram_seen_digests) > RAM_DEDUP_SEEN:
+            ram_seen_digests.popitem(last=False)
+        return False
+
+# Function to store a layer tile in the RAM cache, returns False if the admission rejected it
+def store_ram_tile(layer, x, y, zoom, tile_data):
+    """
+    A tile with a content stored before (plain sea at every zoom level) is stored once as
+    blob/<digest>, the tile key only refers to the blob. The blob stays in the RAM cache
+    as long as one of its tiles is used, every hit of a tile is a hit of the blob.
+    A new blob is admitted with the request count of the tile that brings it.
+    """
+    value = tile_data
+    pin = zoom <= RAM_PIN_MAX_ZOOM
+    tile_key = f"{layer}/{zoom}/{x}/{y}.tile"
+    if len(tile_data) >= RAM_DEDUP_MIN_SIZE:
+        digest = tile_digest(tile_data)
+        blob_key = RAM_BLOB_REF.decode() + digest
+        if blob_key in ram_cache or (is_seen_content(digest) and ram_cache.set(blob_key, tile_data, pin=pin, admit_key=tile_key)):
+            value = RAM_BLOB_REF + digest.encode()
+            count_cache_event("ram_dedup")
+    if ram_cache.set(tile_key, value, pin=pin):
+        return True
+    count_cache_event("ram_reject")
+    return False
+
+# Function to copy the layer tiles of an image from the remote RAM cache into the near cache (two multi-gets: tiles, shared blobs)
+def preload_ram_tiles(tiles, zoom, map_type):
+    layers = [layer for layer in MAP_TYPES.get(map_type, MAP_TYPES[DEFAULT_MAP_TYPE]) if layer is not None]
+    values = ram_cache.get_many([f"{layer}/{zoom}/{x}/{y}.tile" for x, y in tiles for layer in layers])
+    blob_keys = [value.decode() for value in values.values() if value.startswith(RAM_BLOB_REF)]
+    if blob_keys:
+        ram_cache.get_many(blob_keys)
+
+# Function to load a layer tile from the RAM cache (resolves the reference to a shared blob), None if not cached
+def load_ram_tile(layer, x, y, zoom, count=True):
+    cached_tile = ram_cache.get(f"{layer}/{zoom}/{x}/{y}.tile", count=count)
+    if cached_tile is not None and cached_tile.startswith(RAM_BLOB_REF):
+        cached_tile = ram_cache.get(cached_tile.decode(), count=count)     # None: blob evicted, tile loaded from disk again
+    return cached_tile
+
+# Function to load a layer tile from RAM or disk cache, returns None if the tile is not cached
+def load_cached_layer(layer, x, y, zoom, count=True):
+    """
+    count: the request counts for the RAM cache admission and the disk cache
+    access index (False for background work and repeated lookups).
+    """
     # Check if the tile is already in RAM cache
-    cached_tile = ram_cache.get(cache_key)
-    if cached_tile:
-        print(f"Tile {x}, {y} loaded from RAM cache.")
+    cached_tile = load_ram_tile(layer, x, y, zoom, count)
+    if cached_tile is not None:
+        print(f"Tile {layer} {x}, {y} loaded from RAM cache.")
+        count_cache_event("ram_hit")
+        if count:
+            record_tile_access(layer, zoom, x, y)
         # Convert cached binary data back to an image
-        return Image.open(BytesIO(cached_tile))
+        return decode_tile(cached_tile)
         
-    # Define path for disk cache
-    cache_dir = os.path.join(os.getcwd(), "tile_cache", str(map_type), str(zoom), str(x))
-    print("Cache Dir: ", cache_dir)
-    os.makedirs(cache_dir, exist_ok=True)  # Create the directory if it doesn't exist
-    tile_path = os.path.join(cache_dir, f"{y}.png")
-    
     # Check if the tile exists in the disk cache
-    if os.path.exists(tile_path):
-        print(f"Tile {x}, {y} loaded from disk cache.")
-        with open(tile_path, 'rb') as f:
-            tile_data = f.read()
-            ram_cache.set(cache_key, tile_data)  # Load into RAM cache
-        return Image.open(tile_path)
-
-    # Choose the base map type
-    if map_type == 1:
-        url1 = f"https://tile.openstreetmap.org/{zoom}/{x}/{y}.png"      # Open Street Map color
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': 'MyApplication/1.0 (http://myapplication.org; contact: info@myapplication.org',# Use the custom User-Agent function
-            'Referer': 'https://www.openstreetmap.de/'                   # Special Referer!
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 2:
-        url1 = f"https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={zoom}"  # Google Hybrid
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://mt1.google.com/'                         # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 3:
-        url1 = f"https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={zoom}"  # Google Street
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://mt1.google.com/'                         # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 4:
-        url1 = f"https://mt1.google.com/vt/lyrs=p&x={x}&y={y}&z={zoom}"  # Google Terrain Street Hybrid
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://mt1.google.com/'                         # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 5:
-        url1 = f"https://tile.opentopomap.org/{zoom}/{x}/{y}.png"        # Open Topo Map
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://tile.opentopomap.org/'                   # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 6:
-        url1 = f"https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{zoom}/{y}/{x}"  # Esri Base Map
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://server.arcgisonline.com/'                # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 7:
-        url1 = f"https://tiles.stadiamaps.com/tiles/stamen_toner/{zoom}/{x}/{y}.png?api_key=2ab75b65-06ac-4c54-b041-bf1a65d3a2ab" # Stadimaps toner sw
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://tiles.stadiamaps.com/'                   # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 8:
-        url1 = f"https://tiles.stadiamaps.com/tiles/stamen_terrain/{zoom}/{x}/{y}.png?api_key=2ab75b65-06ac-4c54-b041-bf1a65d3a2ab" # Stadimaps terrain
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"   # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://tiles.stadiamaps.com/'                   # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    elif map_type == 9:
-        url1 = f"https://freenauticalchart.net/qmap-de/{zoom}/{x}/{y}.png" # Free Nautical Chart (Quantenschaum)
-        url2 = f""  # No overlay
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://freenauticalchart.net/'                  # Referer
-        }
-        headers2 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-    else:
-        url1 = f"https://tile.openstreetmap.org/{zoom}/{x}/{y}.png"     # Open Street Map color#
-        url2 = f"https://t1.openseamap.org/seamark/{zoom}/{x}/{y}.png"  # Overlay Open Sea Map Sea Marks (transparent overlay)
-        headers1 = {
-            'User-Agent': get_user_agent(),                              # Use the custom User-Agent function
-            'Referer': 'https://tile.openstreetmap.de/'                  # Special Referer!
-        }
-        headers2 = {
-            'User-Agent': 'MyApplication/1.0 (http://myapplication.org; contact: info@myapplication.org',# Use the custom User-Agent function
-            'Referer': 'https://t1.openseamap.org/'                      # Referer
-        }
-
-    # Load background image
-    response = requests.get(url1, headers1)
-    if response.status_code == 200:
-        background = Image.open(BytesIO(response.content))
+    stored_tile = tile_store.load_tile(layer, zoom, x, y)
+    if stored_tile is not None:
+        print(f"Tile {layer} {x}, {y} loaded from disk cache.")
+        count_cache_event("disk_hit")
+        if count:
+            record_tile_access(layer, zoom, x, y)
+        tile_data = stored_tile[0]
+        store_ram_tile(layer, x, y, zoom, tile_data)  # Load into RAM cache
+        return decode_tile(tile_data)
+    
+    return None
+
+# Function to get the freshness of the tiles of a tile server in seconds
+def get_max_age(url):
+    return TILE_PROVIDERS.get(get_provider(url), {}).get("max_age", DEFAULT_MAX_AGE)
+
+# Function to check if a cached tile is older than the freshness of its provider
+def is_tile_stale(source, x, y, zoom):
+    layer, url, headers = source
+    # The marker is checked in the RAM cache of this server only (the near cache with memcached, no round trip)
+    # and does not count as request for the admission
+    fresh_key = f"{layer}/{zoom}/{x}/{y}.fresh"
+    if local_ram_cache.get(fresh_key, count=False) is not None:
+        return False
+    max_age = get_max_age(url)
+    updated = tile_store.tile_time(layer, zoom, x, y)
+    if updated is None:
+        return True  # Only in RAM cache, fetched again
+    age = time.time() - updated
+    if age < max_age:
+        local_ram_cache.set(fresh_key, 1, expire=max_age - age)  # No file access until the tile gets stale (disk of this server)
+        return False
+    return True
+
+# Function to load the upstream validators (ETag, Last-Modified) of a cached tile
+def load_tile_validators(layer, x, y, zoom):
+    return tile_store.load_validators(layer, zoom, x, y)
+
+# Function to store the upstream validators of a tile with the tile
+def store_tile_validators(layer, x, y, zoom, response_headers):
+    validators = {}
+    if response_headers.get("ETag"):
+        validators["etag"] = response_headers["ETag"]
+    if response_headers.get("Last-Modified"):
+        validators["last_modified"] = response_headers["Last-Modified"]
+    if validators:
+        tile_store.store_validators(layer, zoom, x, y, validators)
+
+# Function to load a layer tile from the cache, stale tiles are served and revalidated in the background
+def load_cached_source(source, x, y, zoom, count=True):
+    cached_tile = load_cached_layer(source[0], x, y, zoom, count)
+    if cached_tile is not None and is_tile_stale(source, x, y, zoom):
+        schedule_revalidation(source, x, y, zoom)
+    return cached_tile
+
+# Revalidations waiting or running in this worker process
+revalidations_pending = set()
+revalidations_lock = Lock()
+
+def schedule_revalidation(source, x, y, zoom):
+    key = f"{source[0]}/{zoom}/{x}/{y}"
+    with revalidations_lock:
+        if key in revalidations_pending:
+            return
+        revalidations_pending.add(key)
+    background_executor.submit(revalidate_layer_tile, source, x, y, zoom)
+
+# Function to revalidate a stale tile with a conditional request (If-None-Match / If-Modified-Since)
+def revalidate_layer_tile(source, x, y, zoom):
+    layer, url, headers = source
+    key = f"{layer}/{zoom}/{x}/{y}"
+    fresh_key = f"{key}.fresh"
+    max_age = get_max_age(url)
+    try:
+        with tile_file_lock(key):
+            # Another worker process may have revalidated the tile in the meantime
+            if not is_tile_stale(source, x, y, zoom):
+                return
+            validators = load_tile_validators(layer, x, y, zoom)
+            conditional_headers = dict(headers)
+            if "etag" in validators:
+                conditional_headers["If-None-Match"] = validators["etag"]
+            if "last_modified" in validators:
+                conditional_headers["If-Modified-Since"] = validators["last_modified"]
+            count_cache_event("revalidate")
+            try:
+                response = upstream_get(url, conditional_headers, PRIORITY_BACKGROUND)
+            except requests.RequestException as e:
+                print(f"Tile {layer} {x}, {y} could not be revalidated ({e}).")
+                ram_cache.set(fresh_key, 1, expire=REVALIDATE_RETRY_TIME)
+                return
+            if response.status_code == 304:
+                # Unchanged, only the age of the cached tile is reset
+                print(f"Tile {layer} {x}, {y} not modified.")
+                count_cache_event("revalidate_not_modified")
+                tile_store.touch_tile(layer, zoom, x, y)
+                store_tile_validators(layer, x, y, zoom, response.headers)
+                ram_cache.set(fresh_key, 1, expire=max_age)
+            elif response.status_code == 200:
+                try:
+                    layer_image = Image.open(BytesIO(response.content))
+                    layer_image.load()
+                except OSError as e:
+                    print(f"Tile {layer} {x}, {y} is not a valid image ({e}).")
+                    ram_cache.set(fresh_key, 1, expire=REVALIDATE_RETRY_TIME)
+                    return
+                print(f"Tile {layer} {x}, {y} updated.")
+                store_layer_tile(source, x, y, zoom, layer_image, response.content, response.headers)
+            else:
+                # The stale tile is still better than nothing, try again later
+                print(f"Status Code {response.status_code}, tile {layer} {x}, {y} could not be revalidated.")
+                ram_cache.set(fresh_key, 1, expire=REVALIDATE_RETRY_TIME)
+    except Exception as e:
+        print(f"Revalidation of tile {layer} {x}, {y} failed ({e}).")
+    finally:
+        with revalidations_lock:
+            revalidations_pending.discard(key)
+
+# Function to check the negative cache, returns the status code if the tile is known to be missing
+# (count=False: lookup without log line and hit counters)
+def load_negative_tile(layer, x, y, zoom, count=True):
+    cache_key = f"{layer}/{zoom}/{x}/{y}.neg"
+    status = ram_cache.get(cache_key, None, count=count)
+    if status is None:
+        entry = tile_store.load_negative(layer, zoom, x, y)
+        if entry is None:
+            return None
+        ttl = entry["expires"] - time.time()
+        if ttl <= 0:
+            return None  # Expired, the tile is requested again
+        status = entry["status"]
+        ram_cache.set(cache_key, status, expire=ttl)  # Load into RAM cache
+    if not count:
+        return status
+    print(f"Tile {layer} {x}, {y} is known to be missing (status {status}).")
+    count_cache_event("negative_hit")
+    return status
+
+# Function to store a failed tile in the negative cache (RAM and disk)
+def store_negative_tile(layer, x, y, zoom, status):
+    if status == 0:
+        ttl = NEGATIVE_CACHE_ERROR_TTL
     else:
+        ttl = NEGATIVE_CACHE_TTL.get(status, NEGATIVE_CACHE_DEFAULT_TTL)
+    ram_cache.set(f"{layer}/{zoom}/{x}/{y}.neg", status, expire=ttl)
+    entry = {"status": status, "expires": time.time() + ttl}
+    tile_store.store_negative(layer, zoom, x, y, entry)
+
+# Function to answer a tile of the negative cache, temporary failures get a replacement from the neighbour zoom levels
+def negative_tile_result(layer, x, y, zoom, status):
+    if status == 0 or status in UPSTREAM_RETRY_STATUS:
+        return synthesize_layer_tile(layer, x, y, zoom)
+    return None
+
+# Function to fetch a layer tile, returns None if the tile could not be loaded and EMPTY_TILE for an empty overlay
+def fetch_layer_tile(source, x, y, zoom, priority=PRIORITY_INTERACTIVE):
+    layer = source[0]
+    # Serve the tile from RAM or disk cache if possible
+    cached_tile = load_cached_source(source, x, y, zoom, priority != PRIORITY_BACKGROUND)
+    if cached_tile is not None:
+        return cached_tile
+    
+    # Beyond the highest zoom level of the tile server the tile is scaled from the ancestor tile
+    max_zoom = TILE_LAYERS.get(layer, {}).get("max_zoom")
+    if max_zoom is not None and zoom > max_zoom:
+        return overzoom_layer_tile(source, x, y, zoom, max_zoom, priority)
+    
+    # Known missing tiles are answered without asking the tile server again
+    status = load_negative_tile(layer, x, y, zoom)
+    if status is not None:
+        return negative_tile_result(layer, x, y, zoom, status)
+    
+    # Concurrent misses of the same tile share one download
+    return single_flight(f"{layer}/{zoom}/{x}/{y}", download_layer_tile, source, x, y, zoom, priority)
+
+# Function to scale a tile beyond the highest zoom level of the tile server from its ancestor tile
+def overzoom_layer_tile(source, x, y, zoom, max_zoom, priority=PRIORITY_INTERACTIVE):
+    layer = source[0]
+    levels = zoom - max_zoom
+    ancestor = fetch_layer_tile(get_layer_source(layer, x >> levels, y >> levels, max_zoom), x >> levels, y >> levels, max_zoom, priority)
+    if ancestor is None or ancestor is EMPTY_TILE:
+        return ancestor
+    size = 256 >> levels
+    if size == 0:
+        return None
+    left = (x % (1 << levels)) * size
+    top = (y % (1 << levels)) * size
+    return ancestor.convert("RGBA").crop((left, top, left + size, top + size)).resize((256, 256), Image.BILINEAR)
+
+# Function to download a layer tile once for all worker processes
+def download_layer_tile(source, x, y, zoom, priority):
+    layer = source[0]
+    # Only one worker process downloads the tile, the others wait and read it from the disk cache
+    with tile_file_lock(f"{layer}/{zoom}/{x}/{y}"):
+        # A download for the same tile may have finished just before this one started
+        cached_tile = load_cached_layer(layer, x, y, zoom, count=False)
+        if cached_tile is not None:
+            return cached_tile
+        status = load_negative_tile(layer, x, y, zoom)
+        if status is not None:
+            return negative_tile_result(layer, x, y, zoom, status)
+        return request_layer_tile(source, x, y, zoom, priority)
+
+# Function to load a layer tile from the tile server and store it in RAM and disk cache
+def request_layer_tile(source, x, y, zoom, priority):
+    layer, url, headers = source
+    count_cache_event("download")
+    try:
+        response = upstream_get(url, headers, priority)
+    except ProviderUnavailable as e:
+        print(f"Tile {layer} {x}, {y} not requested ({e}).")
+        return synthesize_layer_tile(layer, x, y, zoom)
+    except requests.RequestException as e:
+        print(f"Tile {layer} {x}, {y} could not be loaded ({e}).")
+        store_negative_tile(layer, x, y, zoom, 0)
+        return synthesize_layer_tile(layer, x, y, zoom)
+    if response.status_code != 200:
         print(f"Status Code {response.status_code}")
-        print(f"Tile {x}, {y} could not be loaded. Using fallback.")
-        return Image.new('RGB', (256, 256), (200, 200, 200))  # Create fallback image
+        print(f"Tile {layer} {x}, {y} could not be loaded.")
+        store_negative_tile(layer, x, y, zoom, response.status_code)
+        if response.status_code in UPSTREAM_RETRY_STATUS:
+            return synthesize_layer_tile(layer, x, y, zoom)
+        return None
+    try:
+        layer_image = Image.open(BytesIO(response.content))
+        layer_image.load()
+    except OSError as e:
+        print(f"Tile {layer} {x}, {y} is not a valid image ({e}).")
+        store_negative_tile(layer, x, y, zoom, 0)
+        return None
+    return store_layer_tile(source, x, y, zoom, layer_image, response.content, response.headers)
+
+# Function to store a downloaded layer tile with its validators in RAM and disk cache
+def store_layer_tile(source, x, y, zoom, layer_image, tile_data, response_headers):
+    """
+    Stores the tile data as delivered by the tile server (no PNG re-encoding,
+    JPEG photo tiles stay JPEG). The file extension follows the image format
+    of the data. Returns the decoded layer image or EMPTY_TILE.
+    """
+    layer, url, headers = source
+    extension = TILE_LAYERS.get(layer, {}).get("format", "png")
+
+    # Empty overlays are stored as zero-byte marker, later renders skip download, decoding and alpha composite
+    if layer in SPARSE_LAYERS and is_transparent(layer_image):
+        print(f"Tile {layer} {x}, {y} is empty.")
+        layer_image = EMPTY_TILE
+        tile_data = b""
+    elif sniff_tile_format(tile_data) is not None:
+        extension = sniff_tile_format(tile_data)
+    else:
+        # Image format without known file extension, stored as PNG
+        buffer = BytesIO()
+        layer_image.save(buffer, format="PNG")
+        tile_data = buffer.getvalue()
+        extension = "png"
+
+    # Save image to RAM cache
+    store_ram_tile(layer, x, y, zoom, tile_data)
+    
+    # Save image to disk cache (file tree: temporary file and rename, MBTiles: batched insert)
+    tile_store.store_tile(layer, zoom, x, y, tile_data, extension)
+    record_tile_access(layer, zoom, x, y, len(tile_data))
+    store_tile_validators(layer, x, y, zoom, response_headers)
+    print(f"Tile {layer} {x}, {y} saved in disk cache.")
+
+    # Fresh for the time the provider allows
+    ram_cache.set(f"{layer}/{zoom}/{x}/{y}.fresh", 1, expire=get_max_age(url))
+
+    # Decoded tiles with the old layer tile are outdated
+    drop_decoded_tiles(layer, x, y, zoom)
 
+    return layer_image
+
+# Function to build a replacement for a tile that cannot be loaded from cached tiles of the neighbour zoom levels
+def synthesize_layer_tile(layer, x, y, zoom):
+    """
+    Degraded rendering while a tile server is down: the tile is cut out of the
+    cached parent tile (zoom - 1, upscaled quadrant) or assembled from the four
+    cached child tiles (zoom + 1, downsampled). The result is not cached.
+    Returns None if the neighbour tiles are not in the cache either.
+    """
+    # Parent tile, the quadrant of the tile is scaled up
+    if zoom > 0:
+        parent = load_cached_layer(layer, x // 2, y // 2, zoom - 1)
+        if parent is EMPTY_TILE:
+            return EMPTY_TILE
+        if parent is not None:
+            left = (x % 2) * 128
+            top = (y % 2) * 128
+            count_cache_event("degraded")
+            return parent.convert("RGBA").crop((left, top, left + 128, top + 128)).resize((256, 256), Image.BILINEAR)
+
+    # Child tiles, all four are needed for a complete tile
+    children = []
+    for dy in (0, 1):
+        for dx in (0, 1):
+            child = load_cached_layer(layer, 2 * x + dx, 2 * y + dy, zoom + 1)
+            if child is None:
+                return None
+            children.append((dx, dy, child))
+    mosaic = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+    for dx, dy, child in children:
+        if child is not EMPTY_TILE:
+            mosaic.paste(child.convert("RGBA"), (dx * 256, dy * 256))
+    count_cache_event("degraded")
+    return mosaic.resize((256, 256), Image.LANCZOS)
+
+# Function to combine base layer and sea marks overlay to one tile
+def compose_tile(background, overlay):
+    # Missing and empty overlays need no alpha composite
+    if overlay is None or overlay is EMPTY_TILE:
+        return background
     # Convert background image to RGBA mode
-    background = background.convert("RGBA")
+    combined_image = background.convert("RGBA")
+    # Apply overlay
+    overlay = overlay.convert("RGBA")
+    combined_image.paste(overlay, (0, 0), overlay)
+    return combined_image
 
-    # Load sea marks overlay
-    if url2 != "":
-        response = requests.get(url2, headers2)
-        if response.status_code == 200:
-            overlay = Image.open(BytesIO(response.content))
-        else:
-            print(f"Status Code {response.status_code}")
-            print(f"Tile {x}, {y} could not be loaded. Using fallback.")
-            overlay = Image.new('RGBA', (256, 256), (0, 0, 0, 0))  # Create transparent overlay
+# Function to load a tile from RAM or disk cache, returns None if a layer of the tile is not cached
+def load_cached_tile(x, y, zoom, map_type):
+    """
+    Returns (tile, complete). An overlay known to be missing is left out as in
+    fetch_osm_tile, the tile is only complete (may be kept in the decoded tile
+    cache) if the overlay does not exist (404, 410) and not after a temporary failure.
+    """
+    base_source, overlay_source = get_tile_sources(x, y, zoom, map_type)
+    background = load_cached_source(base_source, x, y, zoom)
+    if background is None:
+        return None, False
+    overlay = None
+    complete = True
+    if overlay_source is not None:
+        overlay = load_cached_source(overlay_source, x, y, zoom)
+        if overlay is None:
+            status = load_negative_tile(overlay_source[0], x, y, zoom, count=False)
+            if status is None:
+                return None, False
+            complete = status in NEGATIVE_PERMANENT_STATUS
+    return compose_tile(background, overlay), complete
+
+# Decoded tile cache (hot tier) of this worker process in front of the RAM cache: composed tiles as
+# 256x256 RGB pixel arrays, a hit needs no PNG decoding and no alpha composite (0: switched off)
+DECODED_CACHE_SIZE = int(os.environ.get("DECODED_CACHE_SIZE", 64 * 1024 * 1024))  # 64 MB = 341 tiles
+DECODED_TILE_TTL = 600      # Seconds, then the tile is read again from the RAM cache (tiles refreshed by other workers)
+DECODED_MAX_TILES = 16384   # Tiles in the decoded tile cache, identical tiles (plain sea) share one pixel array
+
+decoded_tiles = OrderedDict()   # (base layer, overlay layer, zoom, x, y) -> (time, digest of the pixels), oldest first
+decoded_pixels = {}             # Digest of the pixels -> [pixels, number of tiles]
+decoded_tiles_size = 0          # Bytes of all pixel arrays (shared arrays counted once)
+decoded_tiles_lock = Lock()
+
+def load_decoded_tile(key):
+    with decoded_tiles_lock:
+        entry = decoded_tiles.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > DECODED_TILE_TTL:
+            remove_decoded_tile(key)
+            return None
+        decoded_tiles.move_to_end(key)
+        return decoded_pixels[entry[1]][0]
+
+def store_decoded_tile(key, pixels):
+    """
+    Stores the pixels of a composed tile, a tile with the same pixels as a cached tile
+    shares its array. Returns the stored (possibly shared) pixel array.
+    """
+    global decoded_tiles_size
+    if pixels.nbytes > DECODED_CACHE_SIZE:
+        return pixels
+    digest = tile_digest(pixels)
+    with decoded_tiles_lock:
+        remove_decoded_tile(key)
+        shared = decoded_pixels.get(digest)
+        if shared is None:
+            shared = decoded_pixels[digest] = [pixels, 0]
+            decoded_tiles_size += pixels.nbytes
+        shared[1] += 1
+        decoded_tiles[key] = (time.monotonic(), digest)
+        # Evict the least recently used tiles
+        while decoded_tiles_size > DECODED_CACHE_SIZE or len(decoded_tiles) > DECODED_MAX_TILES:
+            remove_decoded_tile(next(iter(decoded_tiles)))
+        return shared[0]
+
+# Function to remove a decoded tile, the pixel array is removed with its last tile (called with decoded_tiles_lock)
+def remove_decoded_tile(key):
+    global decoded_tiles_size
+    entry = decoded_tiles.pop(key, None)
+    if entry is None:
+        return
+    shared = decoded_pixels[entry[1]]
+    shared[1] -= 1
+    if shared[1] == 0:
+        del decoded_pixels[entry[1]]
+        decoded_tiles_size -= shared[0].nbytes
+
+# Function to remove the decoded tiles of all map types that contain a layer tile
+def drop_decoded_tiles(layer, x, y, zoom):
+    with decoded_tiles_lock:
+        for base_layer, overlay_layer in set(MAP_TYPES.values()):
+            if layer in (base_layer, overlay_layer):
+                remove_decoded_tile((base_layer, overlay_layer, zoom, x, y))
+
+# Function to convert a tile image to a read-only 256x256 RGB pixel array
+def tile_to_pixels(tile):
+    if tile.size != (256, 256):
+        tile = tile.resize((256, 256), Image.BILINEAR)
+    pixels = np.asarray(tile.convert("RGB"))
+    pixels.flags.writeable = False
+    return pixels
+
+# Fallback color of tiles that cannot be loaded and of tiles outside the map (beyond about 85° latitude)
+FALLBACK_TILE_COLOR = (200, 200, 200)
+OUTSIDE_TILE_PIXELS = np.full((256, 256, 3), FALLBACK_TILE_COLOR, dtype=np.uint8)
+OUTSIDE_TILE_PIXELS.flags.writeable = False
+
+# Function to wrap the tile column around the antimeridian, returns None for rows outside the map
+def normalize_tile(x, y, zoom):
+    scale = 1 << zoom
+    if not 0 <= y < scale:
+        return None
+    return x % scale, y
+
+def load_tile_pixels(x, y, zoom, map_type):
+    """
+    Returns the composed tile as RGB pixel array from the decoded tile cache or
+    from the RAM/disk cache (decoded once, then kept in the decoded tile cache).
+    Returns None if a layer of the tile is not cached.
+    """
+    tile = normalize_tile(x, y, zoom)
+    if tile is None:
+        return OUTSIDE_TILE_PIXELS
+    x, y = tile
+    key = MAP_TYPES.get(map_type, MAP_TYPES[DEFAULT_MAP_TYPE]) + (zoom, x, y)
+    if DECODED_CACHE_SIZE > 0:
+        pixels = load_decoded_tile(key)
+        if pixels is not None:
+            count_cache_event("decoded_hit")
+            return pixels
+    tile, complete = load_cached_tile(x, y, zoom, map_type)
+    if tile is None:
+        return None
+    pixels = tile_to_pixels(tile)
+    if DECODED_CACHE_SIZE > 0 and complete:
+        pixels = store_decoded_tile(key, pixels)
+    return pixels
+
+# Function to fetch MB-Tiles tiles
+def fetch_osm_tile(x, y, zoom, map_type, priority=PRIORITY_INTERACTIVE):
+    # Frames near ±180° longitude or the poles reach beyond the map, nothing is fetched or stored for these tiles
+    tile = normalize_tile(x, y, zoom)
+    if tile is None:
+        return Image.new('RGB', (256, 256), FALLBACK_TILE_COLOR)
+    x, y = tile
+    base_source, overlay_source = get_tile_sources(x, y, zoom, map_type)
+
+    # Load background image
+    background = fetch_layer_tile(base_source, x, y, zoom, priority)
+    if background is None:
+        print(f"Tile {x}, {y} could not be loaded. Using fallback.")
+        return Image.new('RGB', (256, 256), FALLBACK_TILE_COLOR)  # Create fallback image
+
+    # Load sea marks overlay, a missing overlay is left out
+    overlay = None
+    if overlay_source is not None:
+        overlay = fetch_layer_tile(overlay_source, x, y, zoom, priority)
     else: # No sea marks overlay
         print(f"No overlay. Using transparent tail.")
-        overlay = Image.new('RGBA', (256, 256), (0, 0, 0, 0))  # Create transparent overlay
         
-    # Apply overlay
-    combined_image = background.copy()
-    combined_image.paste(overlay, (0, 0), overlay)
+    return compose_tile(background, overlay)
 
-    # Save image to RAM cache
-    buffer = BytesIO()
-    combined_image.save(buffer, format="PNG")
-    buffer.seek(0)
-    tile_data = buffer.read()
-    ram_cache.set(cache_key, tile_data)  # Save in RAM cache
-    
-    # Save image to disk cache
-    combined_image.save(tile_path)
-    print(f"Tile {x}, {y} saved in disk cache.")
 
-    return combined_image
+###################################################################################
+# Disk Cache Quota and Janitor                                                    #
+###################################################################################
+
+# Function to convert a size with K, M, G or T (e.g. 500M) to bytes
+def parse_byte_size(text):
+    text = text.strip().upper()
+    factor = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}.get(text[-1:], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+# Function to read the quotas per map type (base layer) or layer, e.g. "1:5G,2:10G,seamark:2G"
+def parse_layer_quotas(text):
+    quotas = {}
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        name, _, size = item.partition(":")
+        name = name.strip()
+        if name.isdigit():
+            if int(name) not in MAP_TYPES:
+                raise ValueError(f"Unknown map type {name} in DISK_CACHE_QUOTAS")
+            name = MAP_TYPES[int(name)][0]
+        quotas[name] = parse_byte_size(size)
+    return quotas
+
+# Byte quotas of the disk cache (0 or empty: unlimited)
+DISK_CACHE_QUOTA = parse_byte_size(os.getenv("DISK_CACHE_QUOTA", "0") or "0")   # All layers together
+DISK_CACHE_QUOTAS = parse_layer_quotas(os.getenv("DISK_CACHE_QUOTAS", ""))      # Per map type and for the sea marks
+
+DISK_JANITOR_INTERVAL = 30      # Seconds between the runs of the janitor (access index update, eviction)
+DISK_EVICT_TARGET = 0.9         # The janitor evicts tiles until the usage is below 90 % of the quota
+DISK_EVICT_BATCH = 500          # Tiles evicted per step
+DISK_HIT_CREDIT = 3600          # Seconds each access of a tile adds to its last access for the eviction order
+DISK_MAX_HIT_CREDIT = 24        # Accesses credited at most (a tile used all day does not stay forever)
+DISK_RECLAIM_INTERVAL = 24 * 3600   # Seconds between the removals of blobs no tile refers to any more (replaced tiles)
+
+# Access index of the disk cache, shared by all worker processes (not the atime of the files, which is often switched off)
+USAGE_DB_PATH = os.path.join(TILE_CACHE_DIR, ".usage.db")
+USAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tile_usage (layer TEXT, zoom INTEGER, x INTEGER, y INTEGER, size INTEGER, last_access REAL,
+                                       hits INTEGER, coldness REAL, PRIMARY KEY (layer, zoom, x, y)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tile_usage_layer_coldness ON tile_usage (layer, coldness);
+CREATE INDEX IF NOT EXISTS tile_usage_coldness ON tile_usage (coldness);
+CREATE TABLE IF NOT EXISTS usage_meta (name TEXT PRIMARY KEY, value);
+"""
+UPSERT_USAGE = """
+INSERT INTO tile_usage (layer, zoom, x, y, size, last_access, hits, coldness) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (layer, zoom, x, y) DO UPDATE SET
+    size = coalesce(excluded.size, size),
+    last_access = max(last_access, excluded.last_access),
+    hits = hits + excluded.hits,
+    coldness = max(last_access, excluded.last_access) + min(hits + excluded.hits, ?) * ?
+"""
+INSERT_INVENTORY = """
+INSERT INTO tile_usage (layer, zoom, x, y, size, last_access, hits, coldness) VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+ON CONFLICT (layer, zoom, x, y) DO UPDATE SET size = excluded.size
+"""
+SELECT_COLDEST = "SELECT layer, zoom, x, y, size FROM tile_usage ORDER BY coldness LIMIT ?"
+SELECT_COLDEST_LAYER = "SELECT layer, zoom, x, y, size FROM tile_usage WHERE layer = ? ORDER BY coldness LIMIT ?"
+DELETE_USAGE = "DELETE FROM tile_usage WHERE layer = ? AND zoom = ? AND x = ? AND y = ?"
+ADD_USAGE_META = "INSERT INTO usage_meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value"
+
+# Tile accesses of this worker process, written to the access index by the janitor
+tile_accesses = {}      # (layer, zoom, x, y) -> [accesses, last access, size or None]
+tile_accesses_lock = Lock()
+janitor_pid = None
+
+def connect_usage_db():
+    os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+    connection = sqlite3.connect(USAGE_DB_PATH, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(USAGE_SCHEMA)
+    return connection
+
+# Function to note an access (size None) or a new tile (with size) in memory, costs no disk I/O
+def record_tile_access(layer, zoom, x, y, size=None):
+    with tile_accesses_lock:
+        entry = tile_accesses.get((layer, zoom, x, y))
+        if entry is None:
+            entry = tile_accesses[(layer, zoom, x, y)] = [0, 0.0, None]
+        if size is None:
+            entry[0] += 1
+        else:
+            entry[2] = size
+        entry[1] = time.time()
+
+def start_cache_janitor():
+    global janitor_pid
+    with tile_accesses_lock:
+        if janitor_pid == os.getpid():
+            return
+        janitor_pid = os.getpid()
+    Thread(target=run_cache_janitor, name="cache-janitor", daemon=True).start()
+    # Accesses of the last seconds are written when the process ends
+    atexit.register(lambda: flush_tile_accesses(connect_usage_db()))
+
+def run_cache_janitor():
+    """
+    Background thread of every worker process: writes the tile accesses to the access
+    index. One worker at a time (file lock) takes stock of the tiles stored before the
+    access index existed and evicts the coldest tiles of layers over their quota.
+    """
+    connection = connect_usage_db()
+    while True:
+        time.sleep(DISK_JANITOR_INTERVAL)
+        try:
+            flush_tile_accesses(connection)
+            with janitor_file_lock() as locked:
+                if locked:
+                    take_tile_inventory(connection)
+                    enforce_disk_quotas(connection)
+                    reclaim_disk_cache(connection)
+                    if time.time() - hot_tiles_saved > HOT_TILES_INTERVAL:
+                        save_hot_tiles()
+        except Exception as e:
+            print(f"Cache janitor failed ({e}).")
+
+@contextmanager
+def janitor_file_lock():
+    if fcntl is None:
+        yield True
+        return
+    os.makedirs(TILE_LOCK_DIR, exist_ok=True)
+    with open(os.path.join(TILE_LOCK_DIR, "janitor.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False     # Another worker process is the janitor at the moment
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def flush_tile_accesses(connection):
+    with tile_accesses_lock:
+        accesses = dict(tile_accesses)
+        tile_accesses.clear()
+    if not accesses:
+        return
+    rows = [(layer, zoom, x, y, size, last_access, hits, last_access + min(hits, DISK_MAX_HIT_CREDIT) * DISK_HIT_CREDIT, DISK_MAX_HIT_CREDIT, DISK_HIT_CREDIT)
+            for (layer, zoom, x, y), (hits, last_access, size) in accesses.items()]
+    connection.execute("BEGIN")
+    connection.executemany(UPSERT_USAGE, rows)
+    connection.execute("COMMIT")
+
+def take_tile_inventory(connection):
+    """
+    Adds the tiles of the disk cache to the access index once per layer and disk cache
+    backend (tiles stored before the access index existed or by another backend).
+    """
+    for layer in TILE_LAYERS:
+        row = connection.execute("SELECT value FROM usage_meta WHERE name = ?", (f"inventory:{layer}",)).fetchone()
+        if row is not None and row[0] == TILE_STORE:
+            continue
+        started = time.monotonic()
+        connection.execute("BEGIN")
+        if row is not None:
+            connection.execute("DELETE FROM tile_usage WHERE layer = ?", (layer,))    # Backend changed
+        count = 0
+        for zoom, x, y, size, updated in tile_store.iter_tile_sizes(layer):
+            connection.execute(INSERT_INVENTORY, (layer, zoom, x, y, size, updated, updated))
+            count += 1
+            if count % 1000 == 0:
+                connection.execute("COMMIT")
+                connection.execute("BEGIN")
+        connection.execute("INSERT OR REPLACE INTO usage_meta (name, value) VALUES (?, ?)", (f"inventory:{layer}", TILE_STORE))
+        connection.execute("COMMIT")
+        if count:
+            print(f"Disk cache inventory {layer}: {count} tiles ({time.monotonic() - started:.1f} s)")
+
+def enforce_disk_quotas(connection):
+    usage = dict(connection.execute("SELECT layer, coalesce(sum(size), 0) FROM tile_usage GROUP BY layer"))
+    evicted = 0
+    for layer, quota in DISK_CACHE_QUOTAS.items():
+        if quota and usage.get(layer, 0) > quota:
+            freed = evict_tiles(connection, layer, usage[layer] - quota * DISK_EVICT_TARGET)
+            usage[layer] -= freed
+            evicted += freed
+    total = sum(usage.values())
+    if DISK_CACHE_QUOTA and total > DISK_CACHE_QUOTA:
+        evicted += evict_tiles(connection, None, total - DISK_CACHE_QUOTA * DISK_EVICT_TARGET)
+    if evicted:
+        # The blobs of the evicted tiles went with the tiles, the pack files are compacted by the daily reclaim
+        tile_store.flush()
+        tile_store.reclaim(full=False)
+
+# Function to remove the blobs of replaced tiles once a day (blobs of evicted tiles are removed with the tiles)
+def reclaim_disk_cache(connection):
+    row = connection.execute("SELECT value FROM usage_meta WHERE name = 'last_reclaim'").fetchone()
+    if row is None:
+        connection.execute("INSERT INTO usage_meta (name, value) VALUES ('last_reclaim', ?)", (time.time(),))
+        return
+    if time.time() - row[0] < DISK_RECLAIM_INTERVAL:
+        return
+    tile_store.flush()
+    freed = tile_store.reclaim()
+    connection.execute("INSERT OR REPLACE INTO usage_meta (name, value) VALUES ('last_reclaim', ?)", (time.time(),))
+    print(f"Disk cache janitor: {freed / 1024 / 1024:.1f} MB of unused blobs removed")
+
+def evict_tiles(connection, layer, amount):
+    """
+    Removes the coldest tiles of a layer (all layers for None) from disk and RAM cache
+    until amount bytes are freed. Cold: last access long ago and few accesses.
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    tiles = 0
+    while freed < amount:
+        if layer is None:
+            rows = connection.execute(SELECT_COLDEST, (DISK_EVICT_BATCH,)).fetchall()
+        else:
+            rows = connection.execute(SELECT_COLDEST_LAYER, (layer, DISK_EVICT_BATCH)).fetchall()
+        if not rows:
+            break
+        evicted = []
+        evicted_bytes = 0
+        for tile_layer, zoom, x, y, size in rows:
+            if freed + evicted_bytes >= amount:
+                break
+            tile_store.delete_tile(tile_layer, zoom, x, y)
+            ram_cache.delete(f"{tile_layer}/{zoom}/{x}/{y}.tile")
+            drop_decoded_tiles(tile_layer, x, y, zoom)
+            count_cache_event("evict")
+            evicted.append((tile_layer, zoom, x, y))
+            evicted_bytes += size or 0
+        connection.execute("BEGIN")
+        connection.executemany(DELETE_USAGE, evicted)
+        connection.executemany(ADD_USAGE_META, [("evicted_tiles", len(evicted)), ("evicted_bytes", evicted_bytes)])
+        connection.execute("INSERT OR REPLACE INTO usage_meta (name, value) VALUES ('last_eviction', ?)", (time.time(),))
+        connection.execute("COMMIT")
+        freed += evicted_bytes
+        tiles += len(evicted)
+    print(f"Disk cache janitor: {tiles} tiles of {layer or 'all layers'} evicted ({freed / 1024 / 1024:.1f} MB)")
+    return freed
+
+
+###################################################################################
+# Hot Tile Set, saved periodically and loaded into the RAM cache at start         #
+###################################################################################
+
+HOT_TILES_PATH = os.path.join(TILE_CACHE_DIR, ".hot_tiles.json")
+HOT_TILES_INTERVAL = 300    # Seconds between two snapshots of the tiles in the RAM cache
+WARM_PROGRESS_STEP = 100    # Tiles between two updates of the warming progress
+
+# Warming state in the RAM cache, shared by the worker processes (pinned, never evicted)
+WARM_STATE_KEY = "warm/state"           # Missing: cold, 0: warming, 1: warm
+WARM_SNAPSHOT_KEY = "warm/snapshot"     # Time of the snapshot in the RAM cache
+WARM_LOADED_KEY = "warm/loaded"
+WARM_TOTAL_KEY = "warm/total"
+WARM_COLD, WARM_WARMING, WARM_WARM = None, 0, 1
+
+hot_tiles_saved = 0.0
+
+def save_hot_tiles():
+    """
+    Writes the tiles of the RAM cache with their request counts, most requested first.
+    Only a warm RAM cache is saved, a half warmed cache would replace a better snapshot.
+    """
+    global hot_tiles_saved
+    hot_tiles_saved = time.time()
+    if ram_cache.get(WARM_STATE_KEY, count=False) != WARM_WARM:
+        return
+    tiles = []
+    for key, request_count, _ in ram_cache.hot_keys(".tile"):
+        layer, zoom, x, y = key[:-len(".tile")].rsplit("/", 3)
+        tiles.append([layer, int(zoom), int(x), int(y), request_count])
+    if tiles:
+        write_file_atomic(HOT_TILES_PATH, json.dumps({"time": int(hot_tiles_saved), "tiles": tiles}).encode())
+        set_warm_state(WARM_SNAPSHOT_KEY, int(hot_tiles_saved))    # The RAM cache holds this snapshot
+        print(f"Hot tile set saved: {len(tiles)} tiles.")
+
+@contextmanager
+def warm_file_lock():
+    if fcntl is None or not isinstance(local_ram_cache, SharedTileCache):
+        yield True     # Every worker process warms its own RAM cache
+        return
+    os.makedirs(TILE_LOCK_DIR, exist_ok=True)
+    with open(os.path.join(TILE_LOCK_DIR, "warm.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False     # Another worker process is warming the shared RAM cache
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def set_warm_state(key, value):
+    ram_cache.set(key, value, pin=True)
+
+def warm_ram_cache():
+    """
+    Background thread at start: loads the tiles of the last hot tile set from the
+    disk cache into the RAM cache, most requested first. A restarted worker finds
+    the shared RAM cache already warm and does nothing.
+    """
+    try:
+        with open(HOT_TILES_PATH) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        snapshot = {"time": 0, "tiles": []}
+    if ram_cache.get(WARM_STATE_KEY, count=False) == WARM_WARM and ram_cache.get(WARM_SNAPSHOT_KEY, count=False) == snapshot["time"]:
+        return
+    with warm_file_lock() as locked:
+        if not locked:
+            return
+        tiles = snapshot["tiles"]
+        started = time.monotonic()
+        set_warm_state(WARM_TOTAL_KEY, len(tiles))
+        set_warm_state(WARM_LOADED_KEY, 0)
+        set_warm_state(WARM_STATE_KEY, WARM_WARMING)
+        loaded = 0
+        for index, (layer, zoom, x, y, _) in enumerate(tiles, 1):
+            try:
+                if f"{layer}/{zoom}/{x}/{y}.tile" not in ram_cache:
+                    stored_tile = tile_store.load_tile(layer, zoom, x, y)
+                    if stored_tile is not None and store_ram_tile(layer, x, y, zoom, stored_tile[0]):
+                        loaded += 1
+            except Exception as e:
+                print(f"Tile {layer} {x}, {y} could not be warmed ({e}).")
+            if index % WARM_PROGRESS_STEP == 0:
+                set_warm_state(WARM_LOADED_KEY, index)
+        set_warm_state(WARM_LOADED_KEY, len(tiles))
+        set_warm_state(WARM_SNAPSHOT_KEY, snapshot["time"])
+        set_warm_state(WARM_STATE_KEY, WARM_WARM)
+        if tiles:
+            print(f"RAM cache warmed: {loaded} of {len(tiles)} hot tiles loaded ({time.monotonic() - started:.1f} s).")
+
+def get_warm_state():
+    state = ram_cache.get(WARM_STATE_KEY, count=False)
+    return {
+        "cache": {WARM_WARMING: "warming", WARM_WARM: "warm"}.get(state, "cold"),
+        "loaded": ram_cache.get(WARM_LOADED_KEY, 0, count=False),
+        "total": ram_cache.get(WARM_TOTAL_KEY, 0, count=False),
+    }
+
+
+###################################################################################
+# Predictive Tile Prefetch along the Course of each Device                        #
+###################################################################################
+
+# Motion model: speed and course are estimated from the positions of consecutive image requests
+PREFETCH_HORIZON = 120          # Look ahead time in seconds
+PREFETCH_MIN_INTERVAL = 0.5     # Shorter request intervals are ignored (seconds)
+PREFETCH_MAX_INTERVAL = 300     # Longer request intervals restart the motion model (seconds)
+PREFETCH_SMOOTHING = 0.3        # Weight of the newest velocity in the smoothed velocity
+PREFETCH_MIN_SPEED = 0.5        # Slower devices (in pixels per second) are considered not moving
+PREFETCH_MAX_TILES = 48         # Tiles per request that may be queued for prefetch
+PREFETCH_QUEUE_LIMIT = 256      # Queued prefetch tiles of this worker process
+PREFETCH_DEVICE_TIMEOUT = 600   # Devices without requests are forgotten after 10 minutes
+
+# Motion state per device: {"time", "x", "y", "vx", "vy"} in world coordinates 0...1 (Web Mercator)
+device_motion = {}
+device_motion_lock = Lock()
+
+# Tiles queued for prefetch in this worker process
+prefetch_pending = set()
+prefetch_lock = Lock()
+
+# Function to identify a device by its session, devices without cookies by their IP address
+def get_device_key():
+    return session.get("sid") or request.remote_addr
+
+# Function to convert geo-coordinates to world coordinates 0...1 (Web Mercator)
+def latlon_to_world(lat, lon):
+    lat_rad = math.radians(max(-85.0511, min(85.0511, lat)))
+    x = (lon + 180.0) / 360.0
+    y = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0
+    return x, y
+
+def update_device_motion(device, lat, lon):
+    """
+    Adds a position of a device to its motion model and returns the smoothed
+    velocity (vx, vy) in world coordinates per second, or None while the
+    course of the device is not known yet.
+    """
+    now = time.monotonic()
+    x, y = latlon_to_world(lat, lon)
+    with device_motion_lock:
+        # Forget devices that are gone
+        for key in [key for key, state in device_motion.items() if now - state["time"] > PREFETCH_DEVICE_TIMEOUT]:
+            del device_motion[key]
+        state = device_motion.get(device)
+        if state is None or now - state["time"] > PREFETCH_MAX_INTERVAL:
+            device_motion[device] = {"time": now, "x": x, "y": y, "vx": None, "vy": None}
+            return None
+        interval = now - state["time"]
+        if interval < PREFETCH_MIN_INTERVAL:
+            return None if state["vx"] is None else (state["vx"], state["vy"])
+        # Shortest way over the date line
+        dx = (x - state["x"] + 0.5) % 1.0 - 0.5
+        vx = dx / interval
+        vy = (y - state["y"]) / interval
+        if state["vx"] is not None:
+            vx = PREFETCH_SMOOTHING * vx + (1 - PREFETCH_SMOOTHING) * state["vx"]
+            vy = PREFETCH_SMOOTHING * vy + (1 - PREFETCH_SMOOTHING) * state["vy"]
+        state.update(time=now, x=x, y=y, vx=vx, vy=vy)
+        return vx, vy
+
+# Function to get the tiles of a viewport around a world position (same tile window as stitch_and_rotate_tiles)
+def get_viewport_tiles(x, y, zoom, output_size_pixels):
+    num_tiles = math.ceil(max(output_size_pixels) / 256) + 2
+    scale = 2 ** zoom
+    x_tile = int(x * scale)
+    y_tile = int(y * scale)
+    tiles = []
+    for i in range(num_tiles):
+        for j in range(num_tiles):
+            tile_y = y_tile + j - num_tiles // 2
+            if 0 <= tile_y < scale:
+                tiles.append(((x_tile + i - num_tiles // 2) % scale, tile_y))
+    return tiles
+
+# Function to check if a layer tile is in the RAM, disk or negative cache without loading it (no hit counters)
+def is_layer_cached(layer, x, y, zoom):
+    if f"{layer}/{zoom}/{x}/{y}.tile" in ram_cache:
+        return True
+    return tile_store.tile_exists(layer, zoom, x, y) or load_negative_tile(layer, x, y, zoom, count=False) is not None
+
+def prefetch_along_course(device, lat, lon, zoom, output_size_pixels, map_type):
+    """
+    Updates the motion model of the device and queues the tiles its viewport
+    will enter within PREFETCH_HORIZON seconds for download in the background
+    (PRIORITY_BACKGROUND): the tiles at the current zoom level ahead of the
+    device and the tiles around the predicted position at zoom - 1 and zoom + 1.
+    The cache lookups of the candidates run in the background too (plan_prefetch),
+    with a remote RAM cache every lookup is a round trip.
+    """
+    velocity = update_device_motion(device, lat, lon)
+    if velocity is None:
+        return
+    vx, vy = velocity
+    x, y = latlon_to_world(lat, lon)
+
+    # Devices at anchor or in the harbour need no prefetch
+    if math.hypot(vx, vy) * (2 ** zoom) * 256 < PREFETCH_MIN_SPEED:
+        return
+
+    # Predicted position at the end of the look ahead time
+    ahead_x = (x + vx * PREFETCH_HORIZON) % 1.0
+    ahead_y = min(max(y + vy * PREFETCH_HORIZON, 0.0), 0.999999)
+
+    # Zoom levels above the highest zoom level of the tile servers do not exist upstream
+    max_zoom = max(TILE_LAYERS[layer]["max_zoom"] for layer in MAP_TYPES.get(map_type, MAP_TYPES[DEFAULT_MAP_TYPE]) if layer is not None)
+
+    current_tiles = set(get_viewport_tiles(x, y, zoom, output_size_pixels))
+    candidates = [(tile_x, tile_y, zoom) for tile_x, tile_y in get_viewport_tiles(ahead_x, ahead_y, zoom, output_size_pixels) if (tile_x, tile_y) not in current_tiles]
+    for other_zoom in (zoom - 1, zoom + 1):
+        if 0 <= other_zoom <= max_zoom:
+            candidates += [(tile_x, tile_y, other_zoom) for tile_x, tile_y in get_viewport_tiles(ahead_x, ahead_y, other_zoom, output_size_pixels)]
+
+    # One plan per device at a time, the next request plans again
+    key = f"plan/{device}"
+    with prefetch_lock:
+        if key in prefetch_pending:
+            return
+        prefetch_pending.add(key)
+    background_executor.submit(plan_prefetch, key, candidates, map_type)
+
+# Function to queue the candidate tiles that are not cached yet (background thread)
+def plan_prefetch(key, candidates, map_type):
+    try:
+        queued = 0
+        for tile_x, tile_y, tile_zoom in candidates:
+            if queued >= PREFETCH_MAX_TILES:
+                break
+            if schedule_prefetch(tile_x, tile_y, tile_zoom, map_type):
+                queued += 1
+    except Exception as e:
+        print(f"Prefetch planning failed: {e}")
+    finally:
+        with prefetch_lock:
+            prefetch_pending.discard(key)
+
+def schedule_prefetch(x, y, zoom, map_type):
+    sources = [source for source in get_tile_sources(x, y, zoom, map_type) if source is not None]
+    sources = [source for source in sources if not is_layer_cached(source[0], x, y, zoom)]
+    if not sources:
+        return False
+    key = f"{map_type}/{zoom}/{x}/{y}"
+    with prefetch_lock:
+        if key in prefetch_pending or len(prefetch_pending) >= PREFETCH_QUEUE_LIMIT:
+            return False
+        prefetch_pending.add(key)
+    background_executor.submit(prefetch_tile, key, sources, x, y, zoom)
+    return True
+
+# Function to download the missing layers of a tile in the background
+def prefetch_tile(key, sources, x, y, zoom):
+    try:
+        for source in sources:
+            if not is_layer_cached(source[0], x, y, zoom):
+                count_cache_event("prefetch")
+                fetch_layer_tile(source, x, y, zoom, PRIORITY_BACKGROUND)
+    except Exception as e:
+        print(f"Prefetch of tile {x}, {y} failed: {e}")
+    finally:
+        with prefetch_lock:
+            prefetch_pending.discard(key)
 
 
 ###################################################################################
@@ -489,19 +1977,41 @@ def stitch_and_rotate_tiles(lat, lon, zoom, output_size_pixels, rotation_angle,
     num_tiles_x = num_tiles
     num_tiles_y = num_tiles
     
-    # Create an empty image for the final mosaic
+    # Pixel array for the final mosaic, the tiles are copied in as RGB pixel arrays
     total_width = num_tiles_x * 256
     total_height = num_tiles_y * 256
-    combined_image = Image.new('RGB', (total_width, total_height))
+    mosaic = np.zeros((total_height, total_width, 3), dtype=np.uint8)
     
-    # Download and stitch the tiles
+    # Tiles of other servers: one multi-get for all tiles of the image into the near cache
+    if isinstance(ram_cache, MemcachedTileCache):
+        preload_ram_tiles([(x_tile + i - num_tiles_x//2, y_tile + j - num_tiles_y//2) for i in range(num_tiles_x) for j in range(num_tiles_y)], zoom, map_type)
+
+    # Collect the tiles, cache hits are served immediately and misses are downloaded in parallel
+    missing_tiles = []
     for i in range(num_tiles_x):
         for j in range(num_tiles_y):
-            tile = fetch_osm_tile(x_tile + i - num_tiles_x//2, y_tile + j - num_tiles_y//2, zoom, map_type)
-            combined_image.paste(tile, (i * 256, j * 256))
-            
-            # Draw the black line around each tile
-            if grid == 1:
+            tile_x = x_tile + i - num_tiles_x//2
+            tile_y = y_tile + j - num_tiles_y//2
+            pixels = load_tile_pixels(tile_x, tile_y, zoom, map_type)
+            if pixels is not None:
+                mosaic[j * 256:(j + 1) * 256, i * 256:(i + 1) * 256] = pixels
+            else:
+                missing_tiles.append((i, j, tile_x, tile_y))
+    
+    if missing_tiles:
+        # Bounded fetch pool per request, all missing tiles are requested at the same time
+        with ThreadPoolExecutor(max_workers=min(TILE_FETCH_WORKERS, len(missing_tiles))) as pool:
+            futures = {(i, j): pool.submit(fetch_osm_tile, tile_x, tile_y, zoom, map_type) for i, j, tile_x, tile_y in missing_tiles}
+            for (i, j), future in futures.items():
+                mosaic[j * 256:(j + 1) * 256, i * 256:(i + 1) * 256] = tile_to_pixels(future.result())
+    
+    # Stitch the tiles when all tiles have arrived
+    combined_image = Image.fromarray(mosaic)
+    
+    # Draw the black line around each tile
+    if grid == 1:
+        for i in range(num_tiles_x):
+            for j in range(num_tiles_y):
                 draw_tile_borders(combined_image, i, j)
     
     # Draw a cross on the central tile at the offset position
@@ -1007,6 +2517,9 @@ def get_image_pbm():
 
         # Load tiles, stitch them together, rotate, and crop
         temp_image = stitch_and_rotate_tiles(lat, lon, zoom_level, (width, height), map_rotation, map_type, symbol, sym_size, sym_rotation, show_grid)
+        
+        # Load the tiles ahead of the device in the background
+        prefetch_along_course(get_device_key(), lat, lon, zoom_level, (width, height), map_type)
 
         # Cutout and borders
         temp_image = cutout_image_bw(temp_image, cutout, tab, border)
@@ -1094,6 +2607,9 @@ def get_image_json():
         output_size_pixels = (width, height)  # Image size in pixels
         # Load tiles, stitch them together, rotate, and crop
         temp_image = stitch_and_rotate_tiles(lat, lon, zoom_level, output_size_pixels, map_rotation, map_type, symbol, sym_size, sym_rotation, show_grid)
+        
+        # Load the tiles ahead of the device in the background
+        prefetch_along_course(get_device_key(), lat, lon, zoom_level, output_size_pixels, map_type)
 
         # Post processing: converts image into a round/oval or square image
         temp_image = cutout_image(temp_image, cutout, tab, border_color=(0, 0, 0),  border_width=border, outside_alpha=alpha)
@@ -1230,6 +2746,9 @@ def get_image():
         # Load tiles, stitch them together, rotate, and crop
         temp_image = stitch_and_rotate_tiles(lat, lon, zoom_level, output_size_pixels, map_rotation, map_type, symbol, sym_size, sym_rotation, show_grid)
         
+        # Load the tiles ahead of the device in the background
+        prefetch_along_course(get_device_key(), lat, lon, zoom_level, output_size_pixels, map_type)
+        
         # Select the image output type based on the 'type' parameter
         if image_type == 1:
             final_image = temp_image  # Color image
@@ -1272,6 +2791,24 @@ def favicon():
 # Initialize monitoring
 init_monitoring(app, ram_cache)
 
+# Background services of a server worker process, started by the server entry point (gunicorn.conf.py,
+# __main__) and not by an import: seed_tiles.py uses the tile functions without janitor and hot tile set
+server_services_pid = None
+
+def start_server_services():
+    """
+    Starts the disk cache janitor (access index, quotas) of this worker process and
+    the warming of the RAM cache with the hot tiles of the last run. The hot tiles
+    are saved again when the worker ends.
+    """
+    global server_services_pid
+    if server_services_pid == os.getpid():
+        return
+    server_services_pid = os.getpid()
+    start_cache_janitor()
+    Thread(target=warm_ram_cache, name="cache-warming", daemon=True).start()
+    atexit.register(save_hot_tiles)
+
 # Output metrics for the charts
 ####################################
 @app.route("/metrics")
@@ -1306,6 +2843,63 @@ def get_metrics():
     return jsonify(data)
 
 
+# Output tile cache statistics of the worker process
+######################################################
+@app.route("/cache_stats")
+def get_cache_stats():
+    with cache_stats_lock:
+        stats = dict(cache_stats)
+    result = {"pid": os.getpid(), "stats": stats, "circuits": get_circuit_states(), "hedging": get_hedge_states()}
+    if isinstance(ram_cache, MemcachedTileCache):
+        result["remote_cache"] = ram_cache.get_states()
+    return jsonify(result)
+
+
+# Health of the server for the Docker healthcheck, with the warming state of the RAM cache
+###########################################################################################
+@app.route("/health")
+def get_health():
+    return jsonify({"status": "ok", "pid": os.getpid(), **get_warm_state()})
+
+
+# Output disk cache usage per map type and zoom level
+#######################################################
+@app.route("/cache_usage")
+def get_cache_usage():
+    connection = connect_usage_db()
+    try:
+        rows = connection.execute("SELECT layer, zoom, count(*), coalesce(sum(size), 0) FROM tile_usage GROUP BY layer, zoom").fetchall()
+        meta = dict(connection.execute("SELECT name, value FROM usage_meta"))
+    finally:
+        connection.close()
+    layers = {}
+    for layer in TILE_LAYERS:
+        layers[layer] = {
+            "map_types": [map_type for map_type, map_layers in MAP_TYPES.items() if layer in map_layers],
+            "quota": DISK_CACHE_QUOTAS.get(layer, 0),
+            "tiles": 0,
+            "bytes": 0,
+            "inventory": meta.get(f"inventory:{layer}") == TILE_STORE,
+            "zoom": {},
+        }
+    for layer, zoom, tiles, size in rows:
+        if layer in layers:
+            layers[layer]["tiles"] += tiles
+            layers[layer]["bytes"] += size
+            layers[layer]["zoom"][zoom] = {"tiles": tiles, "bytes": size}
+    return jsonify({
+        "store": TILE_STORE,
+        "quota": DISK_CACHE_QUOTA,
+        "tiles": sum(layer["tiles"] for layer in layers.values()),
+        "bytes": sum(layer["bytes"] for layer in layers.values()),
+        "evicted_tiles": meta.get("evicted_tiles", 0),
+        "evicted_bytes": meta.get("evicted_bytes", 0),
+        "last_eviction": meta.get("last_eviction"),
+        "last_reclaim": meta.get("last_reclaim"),
+        "layers": layers,
+    })
+
+
 # Display dashboard as an HTML page
 ###################################
 @app.route("/dashboard")
@@ -1477,8 +3071,8 @@ def help():
     
     <p>The container contains a main directory for the application software and two additional external persistent drives are mounted for log files and the cache map directory.</p>
     <p><strong>/app</strong> - Application folder<br><strong>/app/logs</strong> - Log foulder<br><strong>/app/tile_cache</strong> - Cache folder for maps</p>
-    <p>The dashboard accesses the log file and displays the values in charts. The log file is designed as a rotating file that cannot exceed a specified size. The cache map directory is organized and stored as MB Tiles. It can also be used for an MB Tiles server. Depending on the use of different geographical regions, the Map Converter's cache map directory grows over time. A distinction is made between the respective map sources, which are stored in separate subfolders.</p>
-    <p><strong>/app/tile_cache/1</strong> - Open Street Map Cache<br><strong>/app/tile_cache/2</strong> - Google Hybrid Cache<br>...<br>etc.</p>
+    <p>The dashboard accesses the log file and displays the values in charts. The log file is designed as a rotating file that cannot exceed a specified size. The cache map directory is organized and stored as MB Tiles. It can also be used for an MB Tiles server. Depending on the use of different geographical regions, the Map Converter's cache map directory grows over time. A distinction is made between the respective map sources, which are stored in separate subfolders. The OpenSeaMap sea marks overlay is stored only once and is shared by all map types.</p>
+    <p><strong>/app/tile_cache/base/1</strong> - Open Street Map Cache<br><strong>/app/tile_cache/base/2</strong> - Google Hybrid Cache<br>...<br>etc.<br><strong>/app/tile_cache/seamark</strong> - OpenSeaMap Sea Marks Cache</p>
     <p>Currently accessed map areas are stored in a RAM cache for subsequent access. The RAM cache size is 512 MB. This allows approximately 10,000 tiles to be stored in the RAM cache and allows approximately 50 devices to be served simultaneously. Older saved map areas are automatically deleted when the cache is full.</p>
             
     <h3>Dockerfile</h3>
@@ -1769,7 +3363,8 @@ if __name__ == '__main__':
     def run_json_server():
         app.run(host='0.0.0.0', port=serverport, threaded=True)
 
-    # Start the JSON server in a separate thread
+    # Start the background services and the JSON server in a separate thread
+    start_server_services()
     Thread(target=run_json_server).start()
 
     print(f"Server running on port {serverport} for JSON responses.")
@@ -11,6 +11,7 @@ echo "Start Docker Container..."
 docker run -d \
   --name maps-converter-container \
   -p 8080:8080 \
+  --shm-size=600m \
   -v "$(pwd)/tile_cache:/app/tile_cache" \
   -v "$(pwd)/logs:/app/logs" \
   --restart unless-stopped \
@@ -0,0 +1,16 @@
+#########################################################################################################################
+#
+# Maps-Converter Gunicorn Settings
+#
+# Open Boat Projects, Norbert Walter (C) 2025-2026
+#
+# Read by Gunicorn from the working directory (/app in the Docker container). The background services of the
+# server (disk cache janitor, RAM cache warming, saving of the hot tiles) are started in every worker process
+# here and not when Maps_Converter_V1_21 is imported, so seed_tiles.py and other tools run without them.
+#
+#########################################################################################################################
+
+# Function called by Gunicorn in every worker process after the app is loaded
+def post_worker_init(worker):
+    import Maps_Converter_V1_21
+    Maps_Converter_V1_21.start_server_services()
@@ -0,0 +1,276 @@
+#########################################################################################################################
+#
+# Maps-Converter Remote Tile Cache
+#
+# Open Boat Projects, Norbert Walter (C) 2025-2026
+#
+# RAM cache shared by several Maps Converter servers behind a load balancer: the tiles are kept in one or more
+# memcached servers (text protocol), so a region loaded by one server is a RAM hit for all others. The RAM cache
+# of the server (SharedTileCache or diskcache) stays in front as near cache:
+#
+#   get       Near cache, then memcached (the tile is copied into the near cache for REMOTE_NEAR_TTL seconds)
+#   get_many  Near cache, then one pipelined multi-get per memcached server (all tiles of an image at once)
+#   set       Near cache and memcached
+#
+# Keys are spread over the memcached servers by hash. A server that does not answer is left out for
+# REMOTE_RETRY_TIME seconds, meanwhile only the near cache is used (the server keeps working without memcached).
+# A value the server refuses to store (SERVER_ERROR, e.g. out of memory) is only counted, the server stays in use.
+#
+# Values: tiles (bytes, flags 0) and integer markers (flags 1, "value expiry" as text, so the near cache
+# knows the remaining lifetime of a marker read from memcached).
+#
+# Test with a local memcached:
+# docker run -d -p 11211:11211 memcached
+# RAM_CACHE_SERVERS=127.0.0.1:11211 python Maps_Converter_V1_21.py
+#
+#########################################################################################################################
+
+import os
+import time
+import zlib
+import socket
+from collections import Counter
+from threading import Lock, local
+
+REMOTE_CONNECT_TIMEOUT = 0.5    # Seconds for the connection to a memcached server
+REMOTE_TIMEOUT = 1.0            # Seconds for an answer of a memcached server
+REMOTE_RETRY_TIME = 30          # Seconds a memcached server is left out after an error
+REMOTE_NEAR_TTL = 300           # Seconds a value read from memcached stays in the near cache (values changed by other servers)
+REMOTE_GET_BATCH = 100          # Keys per get command of a multi-get
+REMOTE_MAX_RELATIVE_TTL = 30 * 24 * 3600    # Longer expiry times are sent as time stamp (memcached protocol)
+
+# Flags of the values in memcached
+FLAG_BYTES = 0
+FLAG_INT = 1
+
+class RemoteCacheError(Exception):
+    pass
+
+class RemoteItemError(RemoteCacheError):
+    """SERVER_ERROR of a memcached server for one item (e.g. out of memory, value too large)."""
+
+# Function to parse the memcached servers "host:port,host:port" (port 11211 if missing)
+def parse_servers(text):
+    servers = []
+    for entry in text.split(","):
+        entry = entry.strip()
+        if entry:
+            host, _, port = entry.rpartition(":") if ":" in entry else (entry, "", "11211")
+            servers.append((host, int(port)))
+    return servers
+
+class MemcachedTileCache:
+    """
+    Tile cache in memcached servers with a near cache in front, with the interface of
+    SharedTileCache used by the server: get(key, default, count), set(key, value,
+    expire, pin, admit_key), delete(key), key in cache, hot_keys(suffix) and volume(). Request
+    counts, pinning and hot keys are those of the near cache.
+    """
+
+    def __init__(self, servers, near_cache):
+        self.servers = servers
+        self.near_cache = near_cache
+        self.connections = local()
+        self.down_until = {}
+        self.stats = Counter()
+        self.stats_lock = Lock()
+
+    def count(self, event, amount=1):
+        with self.stats_lock:
+            self.stats[event] += amount
+
+    # Function to choose the memcached server of a key
+    def get_server(self, key):
+        if len(self.servers) == 1:
+            return self.servers[0]
+        return self.servers[zlib.crc32(key.encode()) % len(self.servers)]
+
+    def is_down(self, server):
+        return self.down_until.get(server, 0) > time.monotonic()
+
+    def connect(self, server):
+        """
+        Returns the connection (socket, reader) of this thread to a memcached server,
+        connections are not shared between threads and worker processes.
+        """
+        connections = getattr(self.connections, "by_server", None)
+        if connections is None or getattr(self.connections, "pid", None) != os.getpid():
+            connections = self.connections.by_server = {}
+            self.connections.pid = os.getpid()
+        connection = connections.get(server)
+        if connection is None:
+            sock = socket.create_connection(server, timeout=REMOTE_CONNECT_TIMEOUT)
+            sock.settimeout(REMOTE_TIMEOUT)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = connections[server] = (sock, sock.makefile("rb"))
+        return connection
+
+    # Function to close the connection of this thread to a memcached server
+    def close(self, server):
+        connection = self.connections.by_server.pop(server, None) if hasattr(self.connections, "by_server") else None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    # Function to close the connection after an error and to leave the server out for a while
+    def fail(self, server, error):
+        self.close(server)
+        if not self.is_down(server):
+            print(f"Memcached {server[0]}:{server[1]} not available ({error}), using the near cache for {REMOTE_RETRY_TIME} s.")
+        self.down_until[server] = time.monotonic() + REMOTE_RETRY_TIME
+        self.count("remote_error")
+
+    @staticmethod
+    def read_line(reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise RemoteCacheError("connection closed")
+        return line[:-2]
+
+    def request(self, server, command, replies):
+        """
+        Sends a command and returns the reply lines (replies: number of replies, one per
+        pipelined command). Values of get commands are returned as (key, flags, data).
+        """
+        sock, reader = self.connect(server)
+        sock.sendall(command)
+        results = []
+        for _ in range(replies):
+            while True:
+                line = self.read_line(reader)
+                if line.startswith(b"VALUE "):
+                    _, key, flags, length = line.split(b" ")[:4]
+                    data = reader.read(int(length) + 2)
+                    if len(data) != int(length) + 2:
+                        raise RemoteCacheError("connection closed")
+                    results.append((key.decode(), int(flags), data[:-2]))
+                    continue
+                if line.startswith(b"SERVER_ERROR"):
+                    raise RemoteItemError(line.decode(errors="replace"))
+                if line.startswith((b"ERROR", b"CLIENT_ERROR")):
+                    raise RemoteCacheError(line.decode(errors="replace"))
+                if line != b"END":
+                    results.append(line)    # STORED, DELETED, NOT_FOUND, ...
+                break
+        return results
+
+    @staticmethod
+    def encode(value, expire):
+        if isinstance(value, int):
+            expires = time.time() + expire if expire else 0
+            return FLAG_INT, f"{value} {expires:.0f}".encode()
+        return FLAG_BYTES, bytes(value)
+
+    @staticmethod
+    def decode(flags, data):
+        """
+        Returns (value, remaining lifetime in seconds or None), value None if the
+        marker has expired.
+        """
+        if flags != FLAG_INT:
+            return data, None
+        value, _, expires = data.partition(b" ")
+        expires = float(expires or 0)
+        if not expires:
+            return int(value), None
+        remaining = expires - time.time()
+        return (int(value), remaining) if remaining > 0 else (None, None)
+
+    # Function to copy a value read from memcached into the near cache
+    def keep_near(self, key, value, remaining):
+        self.near_cache.set(key, value, expire=min(REMOTE_NEAR_TTL, remaining or REMOTE_NEAR_TTL))
+
+    def get(self, key, default=None, count=True):
+        value = self.near_cache.get(key, None, count=count)
+        if value is not None:
+            return value
+        return self.get_many([key], count=False).get(key, default)
+
+    def get_many(self, keys, count=False):
+        """
+        Returns a dict with the values of all keys found in the near cache or in
+        memcached. The keys missing in the near cache are read with one pipelined
+        multi-get per memcached server.
+        """
+        values = {}
+        missing = {}
+        for key in keys:
+            value = self.near_cache.get(key, None, count=count)
+            if value is not None:
+                values[key] = value
+            else:
+                server = self.get_server(key)
+                if not self.is_down(server):
+                    missing.setdefault(server, []).append(key)
+        for server, server_keys in missing.items():
+            batches = [server_keys[start:start + REMOTE_GET_BATCH] for start in range(0, len(server_keys), REMOTE_GET_BATCH)]
+            command = b"".join(b"get " + " ".join(batch).encode() + b"\r\n" for batch in batches)
+            try:
+                results = self.request(server, command, len(batches))
+            except (OSError, ValueError, RemoteCacheError) as e:
+                self.fail(server, e)
+                continue
+            found = 0
+            for result in results:
+                if isinstance(result, tuple):
+                    key, flags, data = result
+                    value, remaining = self.decode(flags, data)
+                    if value is not None:
+                        values[key] = value
+                        self.keep_near(key, value, remaining)
+                        found += 1
+            self.count("remote_hit", found)
+            self.count("remote_miss", len(server_keys) - found)
+        return values
+
+    def set(self, key, value, expire=None, pin=False, admit_key=None):
+        """
+        Stores a value in the near cache and in memcached, returns False if neither
+        stored it (near cache admission and memcached not available).
+        """
+        stored = self.near_cache.set(key, value, expire=expire, pin=pin, admit_key=admit_key)
+        server = self.get_server(key)
+        if self.is_down(server):
+            return stored
+        flags, data = self.encode(value, expire)
+        expire_time = 0
+        if expire:
+            expire_time = max(1, int(expire)) if expire <= REMOTE_MAX_RELATIVE_TTL else int(time.time() + expire)
+        command = b"set %s %d %d %d\r\n%s\r\n" % (key.encode(), flags, expire_time, len(data), data)
+        try:
+            return self.request(server, command, 1)[0] == b"STORED" or stored
+        except RemoteItemError:
+            # The server works but did not store this value, the connection may be closed by the server after the error
+            self.count("remote_set_error")
+            self.close(server)
+            return stored
+        except (OSError, ValueError, RemoteCacheError) as e:
+            self.fail(server, e)
+            return stored
+
+    def delete(self, key):
+        deleted = self.near_cache.delete(key)
+        server = self.get_server(key)
+        if self.is_down(server):
+            return deleted
+        try:
+            return self.request(server, b"delete %s\r\n" % key.encode(), 1)[0] == b"DELETED" or deleted
+        except (OSError, ValueError, RemoteCacheError) as e:
+            self.fail(server, e)
+            return deleted
+
+    def __contains__(self, key):
+        return key in self.near_cache or key in self.get_many([key])
+
+    def hot_keys(self, suffix=""):
+        return self.near_cache.hot_keys(suffix)
+
+    def volume(self):
+        return self.near_cache.volume()
+
+    # Function to get the state of the memcached servers and the hit counters of this worker process
+    def get_states(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        servers = {f"{host}:{port}": "down" if self.is_down((host, port)) else "up" for host, port in self.servers}
+        return {"servers": servers, **stats}
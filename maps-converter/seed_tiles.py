@@ -0,0 +1,330 @@
+#########################################################################################################################
+#
+# Maps-Converter Tile Seeding
+#
+# Open Boat Projects, Norbert Walter (C) 2025-2026
+#
+# Fills the tile cache of the Maps Converter for a region before a trip, so that the boat has all tiles
+# when it leaves the mobile network coverage. The tiles are loaded with the same functions and the same
+# disk cache backend (file tree or MBTiles files, TILE_STORE in tile_store.py) as the server.
+#
+# Start in the directory of the server (tile_cache/ is relative to the working directory):
+#
+# Bounding box south,west,north,east for zoom levels 8 to 14 and map types 1 and 2
+# python seed_tiles.py --bbox 54.0,10.0,54.8,11.5 --zoom 8-14 --mtype 1,2
+#
+# Corridor of 2 km on both sides of a GPX route (tracks, routes and waypoints)
+# python seed_tiles.py --gpx trip.gpx --corridor 2 --zoom 10-15 --mtype 1
+#
+# Only show the number of tiles, the size and the duration
+# python seed_tiles.py --bbox 54.0,10.0,54.8,11.5 --zoom 8-14 --estimate
+#
+# In the Docker container
+# docker exec -it maps-converter python seed_tiles.py --bbox 54.0,10.0,54.8,11.5 --zoom 8-14
+#
+# An interrupted seeding continues where it stopped when it is started again with the same parameters
+# (progress file tile_cache/.seed/<job>.json). The seeding takes from the rate limit of the running server
+# (shared memory) and leaves the reserved part of the burst to the devices, so the tile servers are not overloaded.
+#
+#########################################################################################################################
+
+import os
+import sys
+import math
+import time
+import json
+import zlib
+import argparse
+import xml.etree.ElementTree as ET
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+import Maps_Converter_V1_21 as maps
+from tile_store import write_file_atomic
+
+# Number of parallel downloads
+SEED_WORKERS = 8
+
+# Tiles per progress step, the progress file is written after each completed step
+SEED_CHUNK_SIZE = 256
+
+# Seconds between two progress reports
+SEED_REPORT_INTERVAL = 10
+
+# Average size of a layer tile in bytes if there are no tiles of the layer in the cache yet
+DEFAULT_TILE_SIZE = 20 * 1024
+
+# Earth radius in meters (Web Mercator)
+EARTH_RADIUS = 6378137.0
+
+# Function to print a report line, the prints of the tile functions are suppressed
+def report(text):
+    print(text, file=sys.__stdout__, flush=True)
+
+# Function to read the zoom levels, e.g. "12" or "8-14"
+def parse_zoom_range(text):
+    if "-" in text:
+        first, last = text.split("-", 1)
+        zooms = range(int(first), int(last) + 1)
+    else:
+        zooms = range(int(text), int(text) + 1)
+    if not zooms or zooms[0] < 0 or zooms[-1] > 20:
+        raise argparse.ArgumentTypeError(f"Invalid zoom range: '{text}' (0...20)")
+    return list(zooms)
+
+# Function to read the bounding box south,west,north,east
+def parse_bbox(text):
+    try:
+        south, west, north, east = (float(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid bounding box: '{text}' (south,west,north,east)")
+    if not (-85.0511 <= south < north <= 85.0511 and -180.0 <= west < east <= 180.0):
+        raise argparse.ArgumentTypeError(f"Invalid bounding box: '{text}' (south < north, west < east)")
+    return south, west, north, east
+
+# Function to read the track, route and waypoint positions of a GPX file
+def read_gpx_points(path):
+    """
+    Returns the positions of a GPX file as list of segments, each segment is a
+    list of (lat, lon). Tracks and routes are connected lines, waypoints are
+    single points.
+    """
+    root = ET.parse(path).getroot()
+    segments = []
+    # GPX 1.0 and 1.1 use different namespaces, compare the local names only
+    for element in root.iter():
+        name = element.tag.rsplit("}", 1)[-1]
+        if name in ("trkseg", "rte"):
+            points = [(float(point.get("lat")), float(point.get("lon"))) for point in element
+                      if point.tag.rsplit("}", 1)[-1] in ("trkpt", "rtept")]
+            if points:
+                segments.append(points)
+        elif name == "wpt":
+            segments.append([(float(element.get("lat")), float(element.get("lon")))])
+    return segments
+
+# Function to get the tiles of a bounding box at a zoom level
+def get_bbox_tiles(bbox, zoom):
+    south, west, north, east = bbox
+    x_min, y_min, _, _ = maps.latlon_to_xyz(north, west, zoom)
+    x_max, y_max, _, _ = maps.latlon_to_xyz(south, east, zoom)
+    last = 2 ** zoom - 1
+    for x in range(max(0, x_min), min(last, x_max) + 1):
+        for y in range(max(0, y_min), min(last, y_max) + 1):
+            yield x, y
+
+# Function to get the tiles of a corridor around GPX segments at a zoom level
+def get_corridor_tiles(segments, corridor, zoom):
+    """
+    Follows the segments in steps of half a tile and collects all tiles within
+    the corridor (in meters) on both sides of the line.
+    """
+    tiles = set()
+    scale = 2 ** zoom
+    for points in segments:
+        # Interpolate the line, so that no tile between two distant points is missed
+        positions = [points[0]]
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            x1, y1 = maps.latlon_to_world(lat1, lon1)
+            x2, y2 = maps.latlon_to_world(lat2, lon2)
+            steps = max(1, math.ceil(max(abs(x2 - x1), abs(y2 - y1)) * scale * 2))
+            positions += [(lat1 + (lat2 - lat1) * step / steps, lon1 + (lon2 - lon1) * step / steps) for step in range(1, steps + 1)]
+        for lat, lon in positions:
+            # Tile size in meters at this latitude
+            tile_size = 2 * math.pi * EARTH_RADIUS * math.cos(math.radians(lat)) / scale
+            radius = math.ceil(corridor / max(tile_size, 1.0))
+            x, y = maps.latlon_to_world(lat, lon)
+            x_tile = int(x * scale)
+            y_tile = int(y * scale)
+            for dx in range(-radius, radius + 1):
+                for dy in range(-radius, radius + 1):
+                    if 0 <= y_tile + dy < scale:
+                        tiles.add(((x_tile + dx) % scale, y_tile + dy))
+    return sorted(tiles)
+
+# Function to build the list of all tiles (zoom, x, y) of the seeding job
+def get_seed_tiles(args):
+    tiles = []
+    if args.bbox is not None:
+        for zoom in args.zoom:
+            tiles += [(zoom, x, y) for x, y in get_bbox_tiles(args.bbox, zoom)]
+    else:
+        segments = read_gpx_points(args.gpx)
+        if not segments:
+            raise SystemExit(f"No track, route or waypoint in {args.gpx}")
+        for zoom in args.zoom:
+            tiles += [(zoom, x, y) for x, y in get_corridor_tiles(segments, args.corridor * 1000, zoom)]
+    return tiles
+
+# Function to get the average size of the cached tiles of a layer (sample of the disk cache)
+def get_average_tile_size(layer, samples=200):
+    sizes = maps.tile_store.sample_tile_sizes(layer, samples)
+    return sum(sizes) / len(sizes) if sizes else DEFAULT_TILE_SIZE
+
+# Function to get the layers (layer name, provider) of the map types
+def get_seed_layers(map_types):
+    layers = {}
+    for map_type in map_types:
+        for layer in maps.MAP_TYPES.get(map_type, maps.MAP_TYPES[maps.DEFAULT_MAP_TYPE]):
+            if layer is not None:
+                layers[layer] = maps.TILE_LAYERS[layer]["provider"]
+    return layers
+
+def estimate_seeding(tiles, layers):
+    """
+    Prints the number of layer tiles, the expected download size and the expected
+    duration with the rate limit per tile server.
+    """
+    total_size = 0
+    provider_tiles = {}
+    for layer, provider in layers.items():
+        total_size += len(tiles) * get_average_tile_size(layer)
+        provider_tiles[provider] = provider_tiles.get(provider, 0) + len(tiles)
+    duration = 0
+    for provider, count in provider_tiles.items():
+        rate, _ = maps.TILE_PROVIDERS.get(provider, {}).get("rate_limit", maps.DEFAULT_RATE_LIMIT)
+        if maps.upstream_buckets is None:
+            rate /= max(1, maps.WORKERS)
+        duration = max(duration, count / rate)
+    report(f"Tiles: {len(tiles)} per layer, {len(tiles) * len(layers)} layer tiles in {len(layers)} layers ({', '.join(layers)})")
+    report(f"Estimated size: {total_size / 1024 / 1024:.1f} MB (without tiles already in the cache)")
+    report(f"Estimated duration: {duration / 60:.1f} min (without tiles already in the cache)")
+
+# Function to name the progress file after the parameters of the job
+def get_progress_path(args):
+    job = json.dumps({"bbox": args.bbox, "gpx": os.path.abspath(args.gpx) if args.gpx else None,
+                      "corridor": args.corridor, "zoom": args.zoom, "mtype": args.mtype}, sort_keys=True)
+    return os.path.join(maps.TILE_CACHE_DIR, ".seed", f"{zlib.crc32(job.encode()):08x}.json")
+
+def load_progress(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"next": 0, "downloaded": 0, "cached": 0, "failed": 0, "bytes": 0}
+
+def save_progress(path, progress):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file_atomic(path, json.dumps(progress).encode())
+
+# Function to load all layers of a tile into the cache
+def seed_tile(zoom, x, y, map_types):
+    """
+    Returns (downloaded, cached, failed, bytes) for the layer tiles of one tile
+    position. Layers shared by several map types (sea marks) are loaded once.
+    """
+    downloaded = cached = failed = size = 0
+    sources = {}
+    for map_type in map_types:
+        for source in maps.get_tile_sources(x, y, zoom, map_type):
+            if source is not None:
+                sources[source[0]] = source
+    for layer, source in sources.items():
+        # Higher zoom levels than the tile server provides are scaled by the server from the cache
+        if zoom > maps.TILE_LAYERS[layer]["max_zoom"]:
+            continue
+        if maps.is_layer_cached(layer, x, y, zoom):
+            cached += 1
+            continue
+        maps.fetch_layer_tile(source, x, y, zoom, maps.PRIORITY_BACKGROUND)
+        tile_size = maps.tile_store.tile_size(layer, zoom, x, y)
+        status = maps.load_negative_tile(layer, x, y, zoom, count=False)
+        if tile_size is not None:
+            downloaded += 1
+            size += tile_size
+        elif status is None or status == 0 or status in maps.UPSTREAM_RETRY_STATUS:
+            failed += 1     # Connection error, server error or tile server unavailable
+        else:
+            cached += 1     # Tile does not exist at the tile server (negative cache)
+    return downloaded, cached, failed, size
+
+def run_seeding(tiles, map_types, progress_path, workers):
+    """
+    Loads the tiles in steps of SEED_CHUNK_SIZE tiles, the progress file is updated
+    after each step. A new start continues with the first unfinished step.
+    """
+    progress = load_progress(progress_path)
+    start = progress["next"]
+    if start >= len(tiles):
+        if not progress["failed"]:
+            report(f"Seeding already finished ({progress_path}), delete the file to start again.")
+            return
+        # Second run for the failed tiles, the cached tiles are skipped quickly
+        report(f"Retry of {progress['failed']} failed layer tiles")
+        progress.update(next=0, failed=0)
+        start = 0
+    if start > 0:
+        report(f"Continue at tile {start} of {len(tiles)}")
+
+    started = time.monotonic()
+    last_report = started
+    session_tiles = 0
+    session_bytes = 0
+    pool = ThreadPoolExecutor(max_workers=workers)
+    usage_connection = maps.connect_usage_db()
+    try:
+        for chunk_start in range(start, len(tiles), SEED_CHUNK_SIZE):
+            chunk = tiles[chunk_start:chunk_start + SEED_CHUNK_SIZE]
+            for downloaded, cached, failed, size in pool.map(lambda tile: seed_tile(*tile, map_types), chunk):
+                progress["downloaded"] += downloaded
+                progress["cached"] += cached
+                progress["failed"] += failed
+                progress["bytes"] += size
+                session_tiles += downloaded
+                session_bytes += size
+            progress["next"] = chunk_start + len(chunk)
+            maps.tile_store.flush()     # The tiles of the step are stored before the progress
+            maps.flush_tile_accesses(usage_connection)  # The server janitor counts the new tiles for the quotas
+            save_progress(progress_path, progress)
+
+            # Throughput of this run and remaining time
+            now = time.monotonic()
+            if now - last_report >= SEED_REPORT_INTERVAL or progress["next"] == len(tiles):
+                last_report = now
+                elapsed = max(now - started, 0.001)
+                done = progress["next"] - start
+                remaining = (len(tiles) - progress["next"]) * elapsed / max(done, 1)
+                report(f"{progress['next']}/{len(tiles)} tiles ({100 * progress['next'] / len(tiles):.1f} %), "
+                       f"{session_tiles / elapsed:.1f} tiles/s, {session_bytes / elapsed / 1024:.1f} KB/s, "
+                       f"downloaded {progress['downloaded']}, cached {progress['cached']}, failed {progress['failed']}, "
+                       f"remaining {remaining / 60:.1f} min")
+    except KeyboardInterrupt:
+        # Queued tiles are dropped, the unfinished step is loaded again at the next start
+        pool.shutdown(wait=False, cancel_futures=True)
+        report(f"Seeding interrupted at tile {progress['next']} of {len(tiles)}, start again to continue.")
+        return
+    pool.shutdown()
+
+    report(f"Seeding finished: {progress['downloaded']} layer tiles downloaded ({progress['bytes'] / 1024 / 1024:.1f} MB), "
+           f"{progress['cached']} already cached, {progress['failed']} failed")
+    if progress["failed"]:
+        report("Failed tiles are retried when the seeding is started again.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the tile cache of the Maps Converter for a region.")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--bbox", type=parse_bbox, help="Bounding box south,west,north,east in degrees")
+    region.add_argument("--gpx", help="GPX file with tracks, routes or waypoints")
+    parser.add_argument("--corridor", type=float, default=2.0, help="Corridor width on both sides of the GPX route in km (default 2)")
+    parser.add_argument("--zoom", type=parse_zoom_range, required=True, help="Zoom level or range, e.g. 12 or 8-14")
+    parser.add_argument("--mtype", type=lambda text: [int(value) for value in text.split(",")], default=[1], help="Map types, e.g. 1,2 (default 1)")
+    parser.add_argument("--workers", type=int, default=SEED_WORKERS, help=f"Parallel downloads (default {SEED_WORKERS})")
+    parser.add_argument("--estimate", action="store_true", help="Only show the number of tiles, size and duration")
+    parser.add_argument("--verbose", action="store_true", help="Show the messages of the tile functions")
+    args = parser.parse_args()
+
+    tiles = get_seed_tiles(args)
+    layers = get_seed_layers(args.mtype)
+    estimate_seeding(tiles, layers)
+    if args.estimate:
+        return
+
+    progress_path = get_progress_path(args)
+    if args.verbose:
+        run_seeding(tiles, args.mtype, progress_path, args.workers)
+    else:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            run_seeding(tiles, args.mtype, progress_path, args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,605 @@
+#########################################################################################################################
+#
+# Maps-Converter Shared Tile Cache
+#
+# Open Boat Projects, Norbert Walter (C) 2025-2026
+#
+# RAM cache shared by all Gunicorn worker processes. The cache is a fixed-size arena in shared memory
+# (a file in /dev/shm mapped by every worker), so a tile loaded by one worker is a RAM hit for all others.
+#
+# Arena layout:
+#
+#   Header          Sizes, fill level and number of entries
+#   Class table     Head of the free chunk list per size class
+#   Page table      Size class of every page (FREE_PAGE: not assigned yet)
+#   Buckets         Hash table, head of the chunk chain per bucket
+#   Sketch          Access frequency of the keys (count-min sketch, 4 rows of 4 bit counters in bytes)
+#   Pages           1 MB pages, each page is cut into chunks of one size class (slab allocator)
+#
+# Chunk: header (next chunk in bucket or free list, key hash, last access, expiry, key and value length) + key + value
+#
+# Full size classes evict the least recently used of a random sample of chunks (sampled LRU). Size classes
+# without pages take over a page of another size class if it is older than their own eviction candidate.
+#
+# Admission (TinyLFU): when the cache is full, a new tile is only stored if its key was requested more often
+# than the key of the eviction candidate. A scan (seeding, a device panning across the sea) brings many tiles
+# that are requested once, they cannot push out the hot tiles shared by many devices. The counters are halved
+# after 10 requests per bucket, so old popularity fades. Pinned entries (low zoom levels) are never evicted.
+#
+# The arena is locked with a thread lock and an fcntl lock on the arena file for every access (short copies only).
+# The holder of the lock is noted in the header: a worker killed while it changed the arena (Gunicorn timeout,
+# SIGKILL) leaves its note behind, the next worker finds it and clears the arena instead of following broken
+# chains. Chains longer than the arena has chunks (a cycle) clear the arena as well.
+#
+#########################################################################################################################
+
+import os
+import time
+import mmap
+import random
+import struct
+import hashlib
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:     # Windows, the server falls back to the per-process diskcache
+    fcntl = None
+
+# Directory for the arena file, /dev/shm is RAM (tmpfs) on Linux
+SHARED_MEMORY_DIR = "/dev/shm"
+
+# Page size of the slab allocator
+PAGE_SIZE = 1024 * 1024
+
+# Chunk sizes of the size classes (empty markers and status codes, tiles, large aerial images)
+SIZE_CLASSES = (256, 1024, 4096, 8192, 16384, 32768, 65536, 131072, 262144)
+
+# Chunks compared for an eviction
+EVICT_SAMPLES = 16
+
+# Chunk headers read to get the age of a page
+PAGE_SAMPLES = 64
+
+# Average tile size, determines the number of hash buckets
+AVERAGE_ENTRY_SIZE = 16 * 1024
+
+# Frequency sketch: rows, highest count, requests per counter of a row until all counters are halved
+SKETCH_DEPTH = 4
+SKETCH_MAX = 15
+SKETCH_RESET = 10
+HALVE = bytes(count >> 1 for count in range(256))
+
+# Share of the arena that may be pinned
+PIN_MAX_SHARE = 0.25
+
+MAGIC = b"MCSTC003"
+HEADER = struct.Struct("<8sQQQQQQQQQQ")  # magic, size, page size, page count, bucket count, next free page, used bytes, entries, pinned bytes, sketch requests, pid of the lock holder
+CHUNK = struct.Struct("<QQddHBBI")      # next, hash, last access, expiry (0: none), key length, value type, flags, value length
+FREE_PAGE = 255
+
+# Chunk flags
+USED = 1
+PINNED = 2
+
+# Value types
+TYPE_BYTES = 0
+TYPE_INT = 1
+
+class SharedTileCache:
+    """
+    Tile cache in shared memory with the interface of diskcache.Cache used by the
+    server: get(key), set(key, value, expire=None), delete(key), key in cache and
+    volume(). Values are bytes or integers. Additionally get(key, count=False) does
+    not count the request for the admission (background work) and set(key, value,
+    pin=True) keeps the entry until it expires or is replaced.
+    """
+
+    def __init__(self, name, size_limit, directory=SHARED_MEMORY_DIR, admission=True):
+        if fcntl is None:
+            raise OSError("Shared tile cache needs fcntl (Linux, macOS)")
+        self.path = os.path.join(directory, name)
+        self.page_count = max(1, size_limit // PAGE_SIZE)
+        self.bucket_count = 1 << max(10, (self.page_count * PAGE_SIZE // AVERAGE_ENTRY_SIZE - 1).bit_length())
+        self.class_offset = HEADER.size
+        self.page_table_offset = self.class_offset + 8 * len(SIZE_CLASSES)
+        self.bucket_offset = self.page_table_offset + self.page_count
+        self.bucket_offset += -self.bucket_offset % 8
+        self.sketch_offset = self.bucket_offset + 8 * self.bucket_count
+        self.data_offset = self.sketch_offset + SKETCH_DEPTH * self.bucket_count
+        self.data_offset += -self.data_offset % mmap.PAGESIZE
+        self.size = self.data_offset + self.page_count * PAGE_SIZE
+        self.pin_limit = int(self.page_count * PAGE_SIZE * PIN_MAX_SHARE)
+        self.max_chunks = self.page_count * (PAGE_SIZE // SIZE_CLASSES[0])   # Longest possible chain
+        self.admission = admission
+        self.lock = Lock()
+        self.open()
+
+    def open(self):
+        self.pid = os.getpid()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != self.size:
+                os.ftruncate(self.fd, 0)
+                # Reserve the memory now, a full /dev/shm raises an error here instead of SIGBUS later
+                os.posix_fallocate(self.fd, 0, self.size)
+            self.memory = mmap.mmap(self.fd, self.size)
+            magic, size, page_size, page_count, bucket_count = HEADER.unpack_from(self.memory, 0)[:5]
+            if (magic, size, page_size, page_count, bucket_count) != (MAGIC, self.size, PAGE_SIZE, self.page_count, self.bucket_count):
+                self.clear_arena()
+            elif self.read_header(9):
+                self.reset_arena("a worker process ended while it changed the arena")
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # Function to initialize an empty arena (called with the file lock)
+    def clear_arena(self):
+        self.memory[self.class_offset:self.data_offset] = bytes(self.data_offset - self.class_offset)
+        self.memory[self.page_table_offset:self.page_table_offset + self.page_count] = bytes([FREE_PAGE]) * self.page_count
+        HEADER.pack_into(self.memory, 0, MAGIC, self.size, PAGE_SIZE, self.page_count, self.bucket_count, 0, 0, 0, 0, 0, 0)
+
+    # Function to start again with an empty arena when its chains cannot be trusted (called with the locks)
+    def reset_arena(self, reason):
+        print(f"Shared tile cache {self.path} cleared: {reason}.")
+        self.clear_arena()
+
+    def acquire(self):
+        # Worker processes forked after the import need their own file descriptor for the fcntl lock
+        if os.getpid() != self.pid:
+            self.lock = Lock()
+            self.open()
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        if self.read_header(9):
+            # The lock was released by the death of its holder in the middle of a change
+            self.reset_arena("a worker process ended while it changed the arena")
+        self.write_header(9, self.pid)
+
+    def release(self):
+        self.write_header(9, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    # Header fields
+    def read_header(self, index):
+        return struct.unpack_from("<Q", self.memory, 8 + 8 * index)[0]
+
+    def write_header(self, index, value):
+        struct.pack_into("<Q", self.memory, 8 + 8 * index, value)
+
+    def add_usage(self, used_bytes, entries):
+        self.write_header(5, self.read_header(5) + used_bytes)
+        self.write_header(6, self.read_header(6) + entries)
+
+    # Free chunk lists per size class
+    def read_free_head(self, size_class):
+        return struct.unpack_from("<Q", self.memory, self.class_offset + 8 * size_class)[0]
+
+    def write_free_head(self, size_class, offset):
+        struct.pack_into("<Q", self.memory, self.class_offset + 8 * size_class, offset)
+
+    # Hash buckets
+    def read_bucket(self, bucket):
+        return struct.unpack_from("<Q", self.memory, self.bucket_offset + 8 * bucket)[0]
+
+    def write_bucket(self, bucket, offset):
+        struct.pack_into("<Q", self.memory, self.bucket_offset + 8 * bucket, offset)
+
+    def page_class(self, page):
+        return self.memory[self.page_table_offset + page]
+
+    # Frequency sketch, the counters of a key are at (low + row * high) in each row (double hashing)
+    def sketch_positions(self, key_hash):
+        low, high = key_hash & 0xFFFFFFFF, (key_hash >> 32) | 1
+        mask = self.bucket_count - 1
+        return [self.sketch_offset + row * self.bucket_count + ((low + row * high) & mask) for row in range(SKETCH_DEPTH)]
+
+    def estimate(self, key_hash):
+        return min(self.memory[position] for position in self.sketch_positions(key_hash))
+
+    def count_request(self, key_hash):
+        positions = self.sketch_positions(key_hash)
+        counts = [self.memory[position] for position in positions]
+        lowest = min(counts)
+        if lowest < SKETCH_MAX:
+            # Conservative update: only the smallest counters are increased (less overestimation)
+            for position, count in zip(positions, counts):
+                if count == lowest:
+                    self.memory[position] = count + 1
+        requests = self.read_header(8) + 1
+        if requests >= SKETCH_RESET * self.bucket_count:
+            # Aging: all counters are halved
+            end = self.sketch_offset + SKETCH_DEPTH * self.bucket_count
+            self.memory[self.sketch_offset:end] = self.memory[self.sketch_offset:end].translate(HALVE)
+            requests //= 2
+        self.write_header(8, requests)
+
+    @staticmethod
+    def hash_key(key):
+        # Stable over all processes (hash() of Python is randomized per process)
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+    @staticmethod
+    def get_size_class(size):
+        for size_class, chunk_size in enumerate(SIZE_CLASSES):
+            if size <= chunk_size:
+                return size_class
+        return None
+
+    def find(self, key, key_hash):
+        """
+        Returns (offset, previous offset in the bucket chain) of the chunk of a key
+        or (0, 0) if the key is not in the cache.
+        """
+        previous = 0
+        offset = self.read_bucket(key_hash & (self.bucket_count - 1))
+        steps = 0
+        while offset:
+            steps += 1
+            if steps > self.max_chunks or not self.data_offset <= offset < self.size:
+                self.reset_arena("broken bucket chain")
+                return 0, 0
+            next_offset, chunk_hash, _, _, key_length = CHUNK.unpack_from(self.memory, offset)[:5]
+            if chunk_hash == key_hash and key_length == len(key) and self.memory[offset + CHUNK.size:offset + CHUNK.size + key_length] == key:
+                return offset, previous
+            previous = offset
+            offset = next_offset
+        return 0, 0
+
+    # Function to remove a chunk from its bucket chain and put it on the free list of its size class
+    def remove(self, offset, previous, key_hash):
+        next_offset = struct.unpack_from("<Q", self.memory, offset)[0]
+        if previous:
+            struct.pack_into("<Q", self.memory, previous, next_offset)
+        else:
+            self.write_bucket(key_hash & (self.bucket_count - 1), next_offset)
+        size_class = self.page_class((offset - self.data_offset) // PAGE_SIZE)
+        if CHUNK.unpack_from(self.memory, offset)[6] & PINNED:
+            self.write_header(7, self.read_header(7) - SIZE_CLASSES[size_class])
+        self.push_free(offset, size_class)
+        self.add_usage(-SIZE_CLASSES[size_class], -1)
+
+    def push_free(self, offset, size_class):
+        CHUNK.pack_into(self.memory, offset, self.read_free_head(size_class), 0, 0.0, 0.0, 0, 0, 0, 0)
+        self.write_free_head(size_class, offset)
+
+    # Function to remove a chunk with known offset (eviction), the bucket chain is searched for its predecessor
+    def evict(self, offset):
+        key_hash = CHUNK.unpack_from(self.memory, offset)[1]
+        previous = 0
+        current = self.read_bucket(key_hash & (self.bucket_count - 1))
+        steps = 0
+        while current and current != offset:
+            steps += 1
+            if steps > self.max_chunks or not self.data_offset <= current < self.size:
+                self.reset_arena("broken bucket chain")
+                return
+            previous = current
+            current = struct.unpack_from("<Q", self.memory, current)[0]
+        if current == offset:
+            self.remove(offset, previous, key_hash)
+
+    # Function to cut a free page into chunks of a size class
+    def assign_page(self, page, size_class):
+        self.memory[self.page_table_offset + page] = size_class
+        start = self.data_offset + page * PAGE_SIZE
+        chunk_size = SIZE_CLASSES[size_class]
+        for offset in range(start + PAGE_SIZE - chunk_size, start - 1, -chunk_size):
+            self.push_free(offset, size_class)
+
+    # Function to get the newest access of the used chunks of a page (sample of PAGE_SAMPLES chunks)
+    def page_access(self, page):
+        start = self.data_offset + page * PAGE_SIZE
+        chunk_size = SIZE_CLASSES[self.page_class(page)]
+        step = max(1, PAGE_SIZE // chunk_size // PAGE_SAMPLES)
+        newest = 0.0
+        for offset in range(start, start + PAGE_SIZE, chunk_size * step):
+            _, _, access, _, _, _, used = CHUNK.unpack_from(self.memory, offset)[:7]
+            if used:
+                newest = max(newest, access)
+        return newest
+
+    def page_pinned(self, page):
+        start = self.data_offset + page * PAGE_SIZE
+        chunk_size = SIZE_CLASSES[self.page_class(page)]
+        return any(CHUNK.unpack_from(self.memory, offset)[6] & PINNED for offset in range(start, start + PAGE_SIZE, chunk_size))
+
+    # Function to give a page of another size class to a size class
+    def steal_page(self, page, size_class):
+        old_class = self.page_class(page)
+        start = self.data_offset + page * PAGE_SIZE
+        chunk_size = SIZE_CLASSES[old_class]
+        for offset in range(start, start + PAGE_SIZE, chunk_size):
+            if CHUNK.unpack_from(self.memory, offset)[6]:
+                self.evict(offset)
+        if self.read_header(4) < self.page_count:
+            return      # Arena cleared (broken chain), all pages are free again
+        # Take the chunks of the page out of the free list of the old size class
+        previous = 0
+        offset = self.read_free_head(old_class)
+        steps = 0
+        while offset:
+            steps += 1
+            if steps > self.max_chunks or not self.data_offset <= offset < self.size:
+                self.reset_arena("broken free list")
+                return
+            next_offset = struct.unpack_from("<Q", self.memory, offset)[0]
+            if start <= offset < start + PAGE_SIZE:
+                if previous:
+                    struct.pack_into("<Q", self.memory, previous, next_offset)
+                else:
+                    self.write_free_head(old_class, next_offset)
+            else:
+                previous = offset
+            offset = next_offset
+        self.assign_page(page, size_class)
+
+    def allocate(self, size_class, key_hash=None):
+        """
+        Returns a free chunk of a size class. Evicts the least recently used chunk
+        of a random sample or takes over an older page of another size class.
+        Returns 0 if the key (key_hash, None: no admission) is requested less often
+        than the eviction candidate or if only pinned chunks were found.
+        """
+        offset = self.read_free_head(size_class)
+        if not offset:
+            next_page = self.read_header(4)
+            if next_page < self.page_count:
+                self.write_header(4, next_page + 1)
+                self.assign_page(next_page, size_class)
+            else:
+                pages = [page for page in range(self.page_count) if self.page_class(page) == size_class]
+                chunk_size = SIZE_CLASSES[size_class]
+                candidate = 0
+                candidate_access = float("inf")
+                for _ in range(EVICT_SAMPLES if pages else 0):
+                    page = random.choice(pages)
+                    sample = self.data_offset + page * PAGE_SIZE + random.randrange(PAGE_SIZE // chunk_size) * chunk_size
+                    _, sample_hash, access, _, _, _, flags = CHUNK.unpack_from(self.memory, sample)[:7]
+                    if access < candidate_access and not flags & PINNED:
+                        candidate, candidate_hash, candidate_access = sample, sample_hash, access
+                # Admission: the new entry must be requested more often than the entry it replaces
+                if self.admission and key_hash is not None and candidate and self.estimate(key_hash) <= self.estimate(candidate_hash):
+                    return 0
+                # A page of another size class that is older than the own candidate is taken over
+                other_page = random.randrange(self.page_count)
+                if (self.page_class(other_page) != size_class and len(pages) < self.page_count
+                        and self.page_access(other_page) < candidate_access and not self.page_pinned(other_page)):
+                    self.steal_page(other_page, size_class)
+                elif candidate:
+                    self.evict(candidate)
+                else:
+                    return 0
+            offset = self.read_free_head(size_class)
+            if not offset:
+                return 0    # Arena cleared (broken chain)
+        self.write_free_head(size_class, struct.unpack_from("<Q", self.memory, offset)[0])
+        return offset
+
+    def get(self, key, default=None, count=True):
+        key = key.encode()
+        key_hash = self.hash_key(key)
+        self.acquire()
+        try:
+            if count:
+                self.count_request(key_hash)
+            offset, previous = self.find(key, key_hash)
+            if not offset:
+                return default
+            _, _, _, expire, key_length, value_type, _, value_length = CHUNK.unpack_from(self.memory, offset)
+            now = time.time()
+            if expire and expire < now:
+                self.remove(offset, previous, key_hash)
+                return default
+            struct.pack_into("<d", self.memory, offset + 16, now)
+            start = offset + CHUNK.size + key_length
+            value = self.memory[start:start + value_length]
+        finally:
+            self.release()
+        if value_type == TYPE_INT:
+            return struct.unpack("<q", value)[0]
+        return value
+
+    def set(self, key, value, expire=None, pin=False, admit_key=None):
+        """
+        Stores a value, returns False if it was not admitted. Only tiles (bytes) pass
+        the admission, integer markers are small and always stored. admit_key: key
+        whose request count decides the admission (a value shared by this key).
+        """
+        key = key.encode()
+        if isinstance(value, int):
+            value_type, value = TYPE_INT, struct.pack("<q", value)
+        else:
+            value_type, value = TYPE_BYTES, bytes(value)
+        key_hash = self.hash_key(key)
+        size_class = self.get_size_class(CHUNK.size + len(key) + len(value))
+        now = time.time()
+        self.acquire()
+        try:
+            offset, previous = self.find(key, key_hash)
+            if offset:
+                self.remove(offset, previous, key_hash)
+            # Larger values than the largest size class are not cached
+            if size_class is None:
+                return False
+            admit_hash = key_hash if admit_key is None else self.hash_key(admit_key.encode())
+            offset = self.allocate(size_class, admit_hash if value_type == TYPE_BYTES else None)
+            if not offset:
+                return False
+            flags = USED
+            if pin and self.read_header(7) + SIZE_CLASSES[size_class] <= self.pin_limit:
+                flags |= PINNED
+                self.write_header(7, self.read_header(7) + SIZE_CLASSES[size_class])
+            bucket = key_hash & (self.bucket_count - 1)
+            CHUNK.pack_into(self.memory, offset, self.read_bucket(bucket), key_hash, now, now + expire if expire else 0.0,
+                            len(key), value_type, flags, len(value))
+            start = offset + CHUNK.size
+            self.memory[start:start + len(key)] = key
+            self.memory[start + len(key):start + len(key) + len(value)] = value
+            self.write_bucket(bucket, offset)
+            self.add_usage(SIZE_CLASSES[size_class], 1)
+            return True
+        finally:
+            self.release()
+
+    def delete(self, key):
+        key = key.encode()
+        key_hash = self.hash_key(key)
+        self.acquire()
+        try:
+            offset, previous = self.find(key, key_hash)
+            if offset:
+                self.remove(offset, previous, key_hash)
+            return bool(offset)
+        finally:
+            self.release()
+
+    def __contains__(self, key):
+        key = key.encode()
+        key_hash = self.hash_key(key)
+        self.acquire()
+        try:
+            offset = self.find(key, key_hash)[0]
+            return bool(offset) and not (0 < CHUNK.unpack_from(self.memory, offset)[3] < time.time())
+        finally:
+            self.release()
+
+    def __len__(self):
+        self.acquire()
+        try:
+            return self.read_header(6)
+        finally:
+            self.release()
+
+    # Function to get the memory used by the cached entries in bytes (chunk sizes)
+    def volume(self):
+        self.acquire()
+        try:
+            return self.read_header(5)
+        finally:
+            self.release()
+
+    def hot_keys(self, suffix=""):
+        """
+        Returns (key, estimated requests, last access) of all entries with keys ending
+        with suffix, most requested first. The arena is locked page by page, the other
+        workers wait at most for the scan of one page.
+        """
+        suffix = suffix.encode()
+        entries = []
+        for page in range(self.page_count):
+            self.acquire()
+            try:
+                if page >= self.read_header(4):
+                    break
+                start = self.data_offset + page * PAGE_SIZE
+                chunk_size = SIZE_CLASSES[self.page_class(page)]
+                for offset in range(start, start + PAGE_SIZE, chunk_size):
+                    _, key_hash, access, _, key_length, _, flags = CHUNK.unpack_from(self.memory, offset)[:7]
+                    if flags:
+                        key = self.memory[offset + CHUNK.size:offset + CHUNK.size + key_length]
+                        if key.endswith(suffix):
+                            entries.append((key.decode(), self.estimate(key_hash), access))
+            finally:
+                self.release()
+        entries.sort(key=lambda entry: (-entry[1], -entry[2]))
+        return entries
+
+    # Function to get the memory used by pinned entries in bytes
+    def pinned_volume(self):
+        self.acquire()
+        try:
+            return self.read_header(7)
+        finally:
+            self.release()
+
+    def clear(self):
+        self.acquire()
+        try:
+            self.clear_arena()
+        finally:
+            self.release()
+
+#########################################################################################################################
+# Token buckets in shared memory: request limits per tile server for all worker processes of the server
+#########################################################################################################################
+
+BUCKET_MAGIC = b"MCSTB001"
+BUCKET_SLOTS = 64                           # Buckets (tile server providers), open addressing by key hash
+BUCKET = struct.Struct("<Qdd")              # key hash (0: free), tokens, last update
+
+class SharedTokenBuckets:
+    """
+    Token buckets shared by all worker processes: take(key, rate, burst, needed)
+    takes one token if the bucket holds at least needed tokens. A bucket is filled
+    with rate tokens per second up to burst and starts full.
+    """
+
+    def __init__(self, name, directory=SHARED_MEMORY_DIR):
+        if fcntl is None:
+            raise OSError("Shared token buckets need fcntl (Linux, macOS)")
+        self.path = os.path.join(directory, name)
+        self.size = len(BUCKET_MAGIC) + BUCKET_SLOTS * BUCKET.size
+        self.lock = Lock()
+        self.open()
+
+    def open(self):
+        self.pid = os.getpid()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != self.size:
+                os.ftruncate(self.fd, 0)
+                os.posix_fallocate(self.fd, 0, self.size)
+            self.memory = mmap.mmap(self.fd, self.size)
+            if self.memory[:len(BUCKET_MAGIC)] != BUCKET_MAGIC:
+                self.memory[:] = BUCKET_MAGIC + bytes(self.size - len(BUCKET_MAGIC))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def acquire(self):
+        # Worker processes forked after the import need their own file descriptor for the fcntl lock
+        if os.getpid() != self.pid:
+            self.lock = Lock()
+            self.open()
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    # Function to find the slot of a key (a free slot for a new key, the home slot if all slots are taken)
+    def find_slot(self, key_hash):
+        home = key_hash % BUCKET_SLOTS
+        for probe in range(BUCKET_SLOTS):
+            offset = len(BUCKET_MAGIC) + ((home + probe) % BUCKET_SLOTS) * BUCKET.size
+            slot_hash = struct.unpack_from("<Q", self.memory, offset)[0]
+            if slot_hash in (key_hash, 0):
+                return offset
+        return len(BUCKET_MAGIC) + home * BUCKET.size
+
+    def take(self, key, rate, burst, needed=1.0):
+        """
+        Takes one token from the bucket of key. Returns 0.0 if a token was taken,
+        otherwise the seconds until the bucket holds needed tokens.
+        """
+        key_hash = SharedTileCache.hash_key(key.encode()) | 1
+        self.acquire()
+        try:
+            offset = self.find_slot(key_hash)
+            slot_hash, tokens, updated = BUCKET.unpack_from(self.memory, offset)
+            now = time.time()
+            if slot_hash != key_hash:
+                tokens, updated = burst, now
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            delay = 0.0
+            if tokens >= needed:
+                tokens -= 1.0
+            else:
+                delay = (needed - tokens) / rate
+            BUCKET.pack_into(self.memory, offset, key_hash, tokens, now)
+            return delay
+        finally:
+            self.release()
@@ -0,0 +1,329 @@
+#########################################################################################################################
+#
+# Maps-Converter Tile Server Stand-in
+#
+# Open Boat Projects, Norbert Walter (C) 2025-2026
+#
+# Local stand-in for the tile servers (OSM, OpenSeaMap, Google, OpenTopoMap, Esri, Stadia, Free Nautical Chart)
+# for load tests and benchmarks of the Maps Converter without real tile servers. Recorded tiles (fixtures) are
+# replayed, missing fixtures are generated. Latency, errors, 304 answers and bandwidth can be configured.
+#
+# Start the stand-in:
+# python tile_standin.py --port 8090 --latency lognormal:40,0.6 --error-rate 0.01 --bandwidth 2000
+#
+# Start the Maps Converter with all tile requests redirected to the stand-in:
+# TILE_SERVER_OVERRIDE=http://127.0.0.1:8090 python Maps_Converter_V1_21.py
+#
+# Requests have the form http://127.0.0.1:8090/<host>/<path>, e.g. /tile.openstreetmap.org/14/8529/5287.png
+#
+# Record the tiles of the real tile servers once (only tiles that are not recorded yet):
+# python tile_standin.py --record
+#
+# Fixtures: fixtures/<host>/<path>, e.g. fixtures/tile.openstreetmap.org/14/8529/5287.png
+#
+# Latency distributions in milliseconds:
+#   fixed:50             Always 50 ms
+#   uniform:20,80        Between 20 and 80 ms
+#   lognormal:40,0.6     Median 40 ms, sigma 0.6 (typical tile server)
+#   pareto:30,2.5        Minimum 30 ms, shape 2.5 (heavy tail)
+#
+# Settings per host with a JSON file (--config), the command line settings are the defaults:
+# {"hosts": {"tile.opentopomap.org": {"latency": "pareto:100,1.5", "error_rate": 0.05, "bandwidth": 200}}}
+#
+# Statistics of the stand-in
+# http://127.0.0.1:8090/_stats
+#
+#########################################################################################################################
+
+import os
+import io
+import json
+import math
+import time
+import zlib
+import random
+import argparse
+import requests
+from threading import Lock
+from collections import Counter
+from email.utils import formatdate, parsedate_to_datetime
+from PIL import Image, ImageDraw
+from flask import Flask, Response, request, jsonify
+
+app = Flask(__name__)
+
+# Directory of the recorded tiles
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Size of the chunks for the bandwidth limit in bytes
+CHUNK_SIZE = 4096
+
+# Hosts that deliver JPEG images, all other hosts deliver PNG images
+JPEG_HOSTS = ("google.com", "arcgisonline.com")
+
+# Hosts with transparent overlays, most generated tiles are empty
+OVERLAY_HOSTS = ("openseamap.org",)
+
+# Settings, replaced by the command line options in main()
+settings = {
+    "default": {"latency": "fixed:0", "error_rate": 0.0, "error_status": [503], "missing_rate": 0.0,
+                "conditional": "honor", "bandwidth": 0, "max_zoom": 20},
+    "hosts": {},
+    "record": False,
+    "synthetic": True,
+}
+
+# Random numbers for latency and errors, with --seed reproducible for one client thread
+rng = random.Random()
+rng_lock = Lock()
+
+# Statistics
+stats = Counter()
+stats_lock = Lock()
+
+# Start time of the stand-in, Last-Modified of the generated tiles
+START_TIME = time.time()
+
+# Bandwidth limits: token buckets per host and for the whole stand-in (bytes per second)
+buckets = {}
+buckets_lock = Lock()
+
+def count(event):
+    with stats_lock:
+        stats[event] += 1
+
+# Function to get the settings of a host (defaults of the command line with the host settings of the config file)
+def get_host_settings(host):
+    host_settings = dict(settings["default"])
+    host_settings.update(settings["hosts"].get(host, {}))
+    return host_settings
+
+def parse_latency(spec):
+    """
+    Checks a latency distribution (see header) and returns (name, parameters).
+    """
+    name, _, values = spec.partition(":")
+    parameters = [float(value) for value in values.split(",") if value != ""]
+    expected = {"fixed": 1, "uniform": 2, "lognormal": 2, "pareto": 2}
+    if expected.get(name) != len(parameters):
+        raise ValueError(f"Invalid latency distribution: '{spec}'")
+    return name, parameters
+
+# Function to draw a latency in seconds
+def draw_latency(spec):
+    name, parameters = parse_latency(spec)
+    with rng_lock:
+        if name == "fixed":
+            milliseconds = parameters[0]
+        elif name == "uniform":
+            milliseconds = rng.uniform(parameters[0], parameters[1])
+        elif name == "lognormal":
+            milliseconds = rng.lognormvariate(math.log(max(parameters[0], 0.001)), parameters[1])
+        else:
+            milliseconds = parameters[0] * rng.paretovariate(parameters[1])
+    return milliseconds / 1000.0
+
+def draw_chance(rate):
+    with rng_lock:
+        return rng.random() < rate
+
+# Function to wait until the bandwidth limit allows to send a chunk
+def wait_bandwidth(key, rate, size):
+    if rate <= 0:
+        return
+    with buckets_lock:
+        bucket = buckets.setdefault(key, {"tokens": 0.0, "time": time.monotonic()})
+        now = time.monotonic()
+        bucket["tokens"] = min(rate, bucket["tokens"] + (now - bucket["time"]) * rate)
+        bucket["time"] = now
+        # Debt is allowed, the chunk waits until the bucket is refilled
+        bucket["tokens"] -= size
+        wait = -bucket["tokens"] / rate if bucket["tokens"] < 0 else 0.0
+    if wait > 0:
+        time.sleep(wait)
+
+# Function to find the zoom level, x and y in a tile path (all URL schemes of the Maps Converter)
+def parse_tile_path(path):
+    if path.startswith("vt/"):
+        # Google: vt/lyrs=y&x=1&y=2&z=3
+        values = dict(part.split("=", 1) for part in path[3:].split("&") if "=" in part)
+        return int(values["z"]), int(values["x"]), int(values["y"])
+    parts = path.rsplit(".", 1)[0].split("/")
+    if "MapServer" in parts:
+        # Esri: .../MapServer/tile/z/y/x
+        return int(parts[-3]), int(parts[-1]), int(parts[-2])
+    return int(parts[-3]), int(parts[-2]), int(parts[-1])
+
+# Function to generate a tile if there is no fixture: colored base tile with grid, sparse overlay
+def generate_tile(host, path):
+    zoom, x, y = parse_tile_path(path)
+    buffer = io.BytesIO()
+    if host.endswith(OVERLAY_HOSTS):
+        image = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+        # Only every 8th tile has a sea mark, like the real overlay at sea
+        if zlib.crc32(f"{zoom}/{x}/{y}".encode()) % 8 == 0:
+            ImageDraw.Draw(image).ellipse((120, 120, 136, 136), fill=(255, 0, 0, 255))
+        image.save(buffer, "PNG")
+        return buffer.getvalue(), "image/png"
+    # The color depends on the host, the brightness on the tile
+    color = zlib.crc32(host.encode())
+    shade = 160 + (x + y) % 2 * 40
+    image = Image.new("RGB", (256, 256), ((color & 0xFF) * shade // 255, (color >> 8 & 0xFF) * shade // 255, (color >> 16 & 0xFF) * shade // 255))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 255, 255), outline=(0, 0, 0))
+    draw.text((8, 8), f"{zoom}/{x}/{y}", fill=(0, 0, 0))
+    if host.endswith(JPEG_HOSTS):
+        image.save(buffer, "JPEG", quality=80)
+        return buffer.getvalue(), "image/jpeg"
+    image.save(buffer, "PNG")
+    return buffer.getvalue(), "image/png"
+
+# Function to get the content type of a fixture from its first bytes
+def sniff_content_type(data):
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def load_tile(host, path):
+    """
+    Returns (data, content type, last modified) of a tile: the fixture, a recorded
+    tile of the real tile server (--record) or a generated tile. Returns None if
+    the tile is not available.
+    """
+    fixture_path = os.path.join(FIXTURE_DIR, host, path)
+    if os.path.isfile(fixture_path):
+        with open(fixture_path, "rb") as f:
+            data = f.read()
+        count("fixture")
+        return data, sniff_content_type(data), os.path.getmtime(fixture_path)
+
+    if settings["record"]:
+        query = f"?{request.query_string.decode()}" if request.query_string else ""
+        response = requests.get(f"https://{host}/{path}{query}", headers={"User-Agent": request.headers.get("User-Agent", "Maps-Converter-Standin")}, timeout=(3.05, 10))
+        if response.status_code == 200:
+            os.makedirs(os.path.dirname(fixture_path), exist_ok=True)
+            with open(fixture_path, "wb") as f:
+                f.write(response.content)
+            count("recorded")
+            return response.content, sniff_content_type(response.content), time.time()
+        count("record_failed")
+        return None
+
+    if settings["synthetic"]:
+        count("generated")
+        data, content_type = generate_tile(host, path)
+        return data, content_type, START_TIME
+    return None
+
+@app.route("/_stats")
+def get_stats():
+    with stats_lock:
+        return jsonify(dict(stats))
+
+@app.route("/<host>/<path:path>")
+def get_tile(host, path):
+    host_settings = get_host_settings(host)
+    count("requests")
+    count(f"host {host}")
+
+    # Latency until the first byte
+    time.sleep(draw_latency(host_settings["latency"]))
+
+    # Injected server errors
+    if draw_chance(host_settings["error_rate"]):
+        with rng_lock:
+            status = rng.choice(host_settings["error_status"])
+        count(f"status {status}")
+        return Response(f"Injected error {status}", status=status)
+
+    # Tiles the tile server does not have (the same tiles every time)
+    try:
+        zoom, x, y = parse_tile_path(path)
+    except (ValueError, KeyError, IndexError):
+        count("status 400")
+        return Response("Unknown tile path", status=400)
+    missing = (zlib.crc32(f"{host}/{path}".encode()) % 10000) / 10000.0 < host_settings["missing_rate"]
+    tile = None if missing or zoom > host_settings["max_zoom"] else load_tile(host, path)
+    if tile is None:
+        count("status 404")
+        return Response("Tile not found", status=404)
+
+    data, content_type, last_modified = tile
+    etag = f'"{zlib.crc32(data):08x}"'
+    headers = {"ETag": etag, "Last-Modified": formatdate(last_modified, usegmt=True), "Cache-Control": "max-age=604800"}
+
+    # Conditional requests: honor answers 304 for unchanged tiles, ignore always sends the tile
+    if host_settings["conditional"] == "honor":
+        if_none_match = request.headers.get("If-None-Match")
+        if_modified_since = request.headers.get("If-Modified-Since")
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = etag in [tag.strip() for tag in if_none_match.split(",")]
+        elif if_modified_since is not None:
+            try:
+                not_modified = parsedate_to_datetime(if_modified_since).timestamp() >= int(last_modified)
+            except (TypeError, ValueError):
+                not_modified = False
+        if not_modified:
+            count("status 304")
+            return Response(status=304, headers=headers)
+
+    count("status 200")
+    with stats_lock:
+        stats["bytes"] += len(data)
+
+    # Bandwidth limit per host and for the whole stand-in, the tile is sent in chunks
+    host_rate = settings["hosts"].get(host, {}).get("bandwidth", 0) * 1024
+    total_rate = settings["default"]["bandwidth"] * 1024
+    if host_rate <= 0 and total_rate <= 0:
+        return Response(data, status=200, content_type=content_type, headers=headers)
+
+    def send_chunks():
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            wait_bandwidth(f"host {host}", host_rate, len(chunk))
+            wait_bandwidth("total", total_rate, len(chunk))
+            yield chunk
+    headers["Content-Length"] = str(len(data))
+    return Response(send_chunks(), status=200, content_type=content_type, headers=headers)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the tile servers of the Maps Converter.")
+    parser.add_argument("--port", type=int, default=8090, help="Port (default 8090)")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address (default 127.0.0.1)")
+    parser.add_argument("--latency", default="fixed:0", help="Latency distribution, e.g. lognormal:40,0.6 (default fixed:0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Part of the requests answered with an error (default 0)")
+    parser.add_argument("--error-status", default="503", help="Status codes of the errors, e.g. 500,503,429 (default 503)")
+    parser.add_argument("--missing-rate", type=float, default=0.0, help="Part of the tiles the tile server does not have, 404 (default 0)")
+    parser.add_argument("--conditional", choices=["honor", "ignore"], default="honor", help="Answer conditional requests with 304 (honor) or always send the tile (ignore)")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Bandwidth of the stand-in in KB/s, 0: unlimited (default 0)")
+    parser.add_argument("--config", help="JSON file with settings per host")
+    parser.add_argument("--record", action="store_true", help="Load missing fixtures from the real tile servers")
+    parser.add_argument("--no-synthetic", action="store_true", help="Answer 404 for missing fixtures instead of generating tiles")
+    parser.add_argument("--seed", type=int, help="Seed of the random numbers for reproducible runs")
+    args = parser.parse_args()
+
+    parse_latency(args.latency)
+    settings["default"].update(latency=args.latency, error_rate=args.error_rate, error_status=[int(status) for status in args.error_status.split(",")],
+                               missing_rate=args.missing_rate, conditional=args.conditional, bandwidth=args.bandwidth)
+    if args.config:
+        with open(args.config) as f:
+            settings["hosts"] = json.load(f).get("hosts", {})
+        for host_settings in settings["hosts"].values():
+            if "latency" in host_settings:
+                parse_latency(host_settings["latency"])
+    settings["record"] = args.record
+    settings["synthetic"] = not args.no_synthetic
+    if args.seed is not None:
+        rng.seed(args.seed)
+
+    print(f"Tile server stand-in running on http://{args.host}:{args.port}, fixtures in {FIXTURE_DIR}")
+    print(f"Start the Maps Converter with TILE_SERVER_OVERRIDE=http://{args.host}:{args.port}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
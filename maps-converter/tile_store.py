@@ -0,0 +1,1312 @@
+#########################################################################################################################
+#
+# Maps-Converter Tile Store
+#
+# Open Boat Projects, Norbert Walter (C) 2025-2026
+#
+# Disk cache backends for the tiles of the Maps Converter, selected with TILE_STORE (see .env):
+#
+# tree     File tree, one file per tile (default)
+#          tile_cache/<layer>/ZZZ/XXX/YYY.png|jpg   Tile as delivered by the tile server
+#          tile_cache/<layer>/ZZZ/XXX/YYY.json      Validators of the tile server (ETag, Last-Modified)
+#          tile_cache/<layer>/ZZZ/XXX/YYY.neg       Negative cache entry (status, expiry)
+#          tile_cache/.blobs/HH/<digest>            Content of the tiles, the tile files are hard links to it
+#
+# mbtiles  One MBTiles file (SQLite) per layer, e.g. tile_cache/base_1.mbtiles, tile_cache/seamark.mbtiles
+#          Standard MBTiles tables metadata, map and images (TMS row order, identical tiles share one image) and
+#          the view tiles, can be copied or served by other MBTiles tools.
+#          Additional tables tile_info (time of download, validators) and missing_tiles (negative cache).
+#          WAL mode: readers never wait for the writer. Writes are collected by a writer thread and inserted
+#          in batches (one transaction per batch), reads see the pending writes of their own process.
+#
+# pack     Append-only pack files per layer, e.g. tile_cache/packs/base_1/0000-00000.pack
+#          Tiles are appended to large pack files and read through mmap, an index in memory (rebuilt at start
+#          from the index file index-GGGG.log) gives the position of each tile. No open() or stat() per tile.
+#          Replaced tiles stay in the pack files until the layer is compacted. Identical small tiles share one blob.
+#
+# Identical tiles (plain sea, empty sea mark overlays) are stored once in all backends (content address: digest of
+# the tile data). Blobs no tile refers to any more are removed by the janitor after an eviction (reclaim).
+#
+# Convert an existing file tree into MBTiles files or pack files (the file tree is not changed):
+# python tile_store.py convert
+# python tile_store.py convert --to pack --cache-dir /app/tile_cache
+#
+# Compact the pack files (removes replaced tiles, can run beside the server, writes wait meanwhile):
+# python tile_store.py compact
+# python tile_store.py compact --min-garbage 0.1
+#
+# Link the identical tiles of a file tree stored before the deduplication to one blob each:
+# python tile_store.py dedup
+#
+#########################################################################################################################
+
+import os
+import sys
+import json
+import errno
+import time
+import mmap
+import queue
+import struct
+import atexit
+import hashlib
+import sqlite3
+import tempfile
+import argparse
+from itertools import islice
+from contextlib import contextmanager
+from threading import Thread, Lock, RLock, local, get_ident
+
+try:
+    import fcntl  # File locks between worker processes (not available on Windows)
+except ImportError:
+    fcntl = None
+
+# Image formats of the cached tiles (file extension: first bytes of the file)
+TILE_FORMATS = {
+    "png": b"\x89PNG",
+    "jpg": b"\xff\xd8",
+    "webp": b"RIFF",
+}
+
+# Batches of the MBTiles writer thread
+MBTILES_BATCH_SIZE = 256    # Maximum number of writes per transaction
+MBTILES_BATCH_DELAY = 0.2   # Seconds the writer collects writes before a transaction
+MBTILES_BUSY_TIMEOUT = 10   # Seconds a writer waits for the writer of another worker process
+MBTILES_READ_POOL = 16      # Idle read connections kept per layer and process (one per parallel tile download)
+
+# Function to get the image format of tile data from its first bytes, None if unknown
+def sniff_tile_format(tile_data):
+    for extension, magic in TILE_FORMATS.items():
+        if tile_data.startswith(magic):
+            return extension
+    return None
+
+# Function to get the content address of tile data (identical tiles, e.g. open sea, share one blob)
+def tile_digest(tile_data):
+    return hashlib.blake2b(tile_data, digest_size=16).hexdigest()
+
+def write_file_atomic(path, data):
+    """
+    Writes a file via a temporary file in the same directory and an atomic rename,
+    so readers in other processes never see a partially written tile.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+###################################################################################
+# File tree                                                                       #
+###################################################################################
+
+class FileTreeStore:
+    """
+    Tiles as files in a directory tree, one directory per layer, zoom level and x.
+    Identical tiles are hard links to one blob in .blobs (named by the digest of the
+    content), the link count of the blob is its reference count.
+    """
+
+    def __init__(self, cache_dir, layer_formats):
+        self.cache_dir = cache_dir
+        self.layer_formats = layer_formats
+        self.blob_dir = os.path.join(cache_dir, ".blobs")
+        self.hard_links = True     # False after the file system refused a hard link
+
+    def get_path(self, layer, zoom, x, y, extension="png"):
+        return os.path.join(self.cache_dir, layer, str(zoom), str(x), f"{y}.{extension}")
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    # Function to find the tile file, the format of the tile server is tried first
+    def find_path(self, layer, zoom, x, y):
+        expected = self.layer_formats.get(layer, "png")
+        for extension in [expected] + [extension for extension in TILE_FORMATS if extension != expected]:
+            tile_path = self.get_path(layer, zoom, x, y, extension)
+            if os.path.exists(tile_path):
+                return tile_path
+        return None
+
+    # Function to load a tile, returns (tile data, time of download) or None
+    def load_tile(self, layer, zoom, x, y):
+        tile_path = self.find_path(layer, zoom, x, y)
+        if tile_path is None:
+            return None
+        try:
+            with open(tile_path, "rb") as f:
+                return f.read(), os.path.getmtime(tile_path)
+        except OSError:
+            return None
+
+    def tile_exists(self, layer, zoom, x, y):
+        return self.find_path(layer, zoom, x, y) is not None
+
+    # Function to get the time of download of a tile, None if the tile is not stored
+    def tile_time(self, layer, zoom, x, y):
+        tile_path = self.find_path(layer, zoom, x, y)
+        try:
+            return os.path.getmtime(tile_path) if tile_path is not None else None
+        except OSError:
+            return None
+
+    def tile_size(self, layer, zoom, x, y):
+        tile_path = self.find_path(layer, zoom, x, y)
+        try:
+            return os.path.getsize(tile_path) if tile_path is not None else None
+        except OSError:
+            return None
+
+    def store_tile(self, layer, zoom, x, y, tile_data, extension):
+        tile_path = self.get_path(layer, zoom, x, y, extension)
+        if not self.hard_links or not self.link_blob(tile_data, tile_path):
+            write_file_atomic(tile_path, tile_data)
+        # The tile server may have changed the format (or the tile was cached as PNG before)
+        for other in TILE_FORMATS:
+            if other != extension:
+                try:
+                    os.remove(self.get_path(layer, zoom, x, y, other))
+                except FileNotFoundError:
+                    pass
+
+    def link_blob(self, tile_data, tile_path, updated=None):
+        """
+        Stores a tile as hard link to the blob of its content (the first tile with this
+        content writes the blob). The time of download is kept by the blob, so it is the
+        time of the newest download of all tiles with this content. Returns False if the
+        file system has no hard links.
+        """
+        blob_path = self.get_blob_path(tile_digest(tile_data))
+        directory = os.path.dirname(tile_path)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, f".{os.path.basename(tile_path)}.{os.getpid()}.{get_ident()}.tmp")
+        for _ in range(3):
+            try:
+                if not os.path.exists(blob_path):
+                    write_file_atomic(blob_path, tile_data)
+                os.link(blob_path, temp_path)
+                break
+            except FileExistsError:
+                os.remove(temp_path)    # Left over by a crashed process
+            except FileNotFoundError:
+                pass                    # Blob removed by reclaim() just now, written again
+            except OSError as e:
+                if e.errno == errno.EMLINK:
+                    # Link limit of the file system (e.g. empty sea marks), a new blob is started, the tiles keep the old one
+                    try:
+                        os.remove(blob_path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                print(f"No hard links in {self.cache_dir} ({e}), identical tiles are stored as copies.")
+                self.hard_links = False
+                return False
+        else:
+            return False
+        try:
+            os.replace(temp_path, tile_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        os.utime(tile_path, None if updated is None else (updated, updated))
+        return True
+
+    # Function to reset the age of an unchanged tile (HTTP 304, applies to all tiles with the same content)
+    def touch_tile(self, layer, zoom, x, y):
+        tile_path = self.find_path(layer, zoom, x, y)
+        if tile_path is not None:
+            os.utime(tile_path)
+
+    # Function to remove a tile and its validators (eviction), the blob is removed with its last tile
+    def delete_tile(self, layer, zoom, x, y):
+        for extension in list(TILE_FORMATS) + ["json"]:
+            tile_path = self.get_path(layer, zoom, x, y, extension)
+            try:
+                blob_path = self.get_tile_blob(tile_path) if extension != "json" else None
+                os.remove(tile_path)
+            except FileNotFoundError:
+                continue
+            if blob_path is not None:
+                self.remove_unused_blob(blob_path)
+
+    # Function to get the blob a tile file links to, None for a copy (or a link to a blob replaced after EMLINK)
+    def get_tile_blob(self, tile_path):
+        status = os.stat(tile_path)
+        if status.st_nlink < 2:
+            return None
+        with open(tile_path, "rb") as f:
+            blob_path = self.get_blob_path(tile_digest(f.read()))
+        try:
+            return blob_path if os.path.samestat(status, os.stat(blob_path)) else None
+        except FileNotFoundError:
+            return None
+
+    # Function to remove a blob no tile links to any more, returns the number of bytes freed
+    def remove_unused_blob(self, blob_path):
+        try:
+            status = os.stat(blob_path)
+            if status.st_nlink == 1:
+                os.remove(blob_path)
+                return status.st_size
+        except OSError:
+            pass
+        return 0
+
+    def load_validators(self, layer, zoom, x, y):
+        try:
+            with open(self.get_path(layer, zoom, x, y, "json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def store_validators(self, layer, zoom, x, y, validators):
+        write_file_atomic(self.get_path(layer, zoom, x, y, "json"), json.dumps(validators).encode())
+
+    # Function to load a negative cache entry {"status", "expires"}, None if there is none
+    def load_negative(self, layer, zoom, x, y):
+        try:
+            with open(self.get_path(layer, zoom, x, y, "neg"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store_negative(self, layer, zoom, x, y, entry):
+        write_file_atomic(self.get_path(layer, zoom, x, y, "neg"), json.dumps(entry).encode())
+
+    # Function to get the sizes of some tiles of a layer (estimates)
+    def sample_tile_sizes(self, layer, count):
+        sizes = []
+        for directory, _, files in os.walk(os.path.join(self.cache_dir, layer)):
+            for name in files:
+                if name.rsplit(".", 1)[-1] in TILE_FORMATS and not name.startswith("."):
+                    sizes.append(os.path.getsize(os.path.join(directory, name)))
+                    if len(sizes) >= count:
+                        return sizes
+        return sizes
+
+    # Function to list the tiles of a layer: (zoom, x, y, size, time of download)
+    def iter_tile_sizes(self, layer):
+        layer_dir = os.path.join(self.cache_dir, layer)
+        for directory, _, files in os.walk(layer_dir):
+            parts = os.path.relpath(directory, layer_dir).split(os.sep)
+            if len(parts) != 2 or not all(part.isdigit() for part in parts):
+                continue
+            for name in files:
+                stem, _, extension = name.rpartition(".")
+                if stem.isdigit() and extension in TILE_FORMATS:
+                    try:
+                        status = os.stat(os.path.join(directory, name))
+                    except OSError:
+                        continue
+                    yield int(parts[0]), int(parts[1]), int(stem), status.st_size, status.st_mtime
+
+    def reclaim(self, full=True):
+        """
+        Removes the blobs no tile links to any more (replaced tiles), returns the number
+        of bytes freed. The blobs of evicted tiles are removed by delete_tile, so only
+        the full sweep (full=False: nothing to do) walks all blobs.
+        """
+        freed = 0
+        if not full:
+            return freed
+        for directory, _, files in os.walk(self.blob_dir):
+            for name in files:
+                if name.startswith("."):
+                    continue    # Blob being written
+                freed += self.remove_unused_blob(os.path.join(directory, name))
+        return freed
+
+    # Function to read all tiles of a layer: (zoom, x, y, tile data, time of download, validators, negative entry)
+    def iter_layer(self, layer):
+        for directory, _, files in os.walk(os.path.join(self.cache_dir, layer)):
+            parts = os.path.relpath(directory, os.path.join(self.cache_dir, layer)).split(os.sep)
+            if len(parts) != 2 or not all(part.isdigit() for part in parts):
+                continue
+            zoom, x = int(parts[0]), int(parts[1])
+            for name in files:
+                stem, _, extension = name.rpartition(".")
+                if not stem.isdigit():
+                    continue
+                y = int(stem)
+                if extension in TILE_FORMATS:
+                    tile = self.load_tile(layer, zoom, x, y)
+                    if tile is not None:
+                        yield zoom, x, y, tile[0], tile[1], self.load_validators(layer, zoom, x, y), None
+                elif extension == "neg" and self.find_path(layer, zoom, x, y) is None:
+                    yield zoom, x, y, None, None, None, self.load_negative(layer, zoom, x, y)
+
+    # Function to find the layers in the file tree (seamark, base/1, base/2, ...), the layer is the path above ZZZ/XXX/YYY.ext
+    def find_layers(self):
+        layers = set()
+        for directory, dirs, files in os.walk(self.cache_dir):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            parts = os.path.relpath(directory, self.cache_dir).split(os.sep)
+            if len(parts) > 2 and parts[-1].isdigit() and parts[-2].isdigit() and any(name.split(".")[0].isdigit() for name in files):
+                layers.add("/".join(parts[:-2]))
+        return sorted(layers)
+
+    def flush(self):
+        pass
+
+###################################################################################
+# MBTiles (SQLite)                                                                #
+###################################################################################
+
+MBTILES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name);
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id);
+CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);
+CREATE TABLE IF NOT EXISTS tile_info (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, updated REAL, etag TEXT, last_modified TEXT,
+                                      PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS missing_tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, status INTEGER, expires REAL,
+                                          PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;
+"""
+CREATE_TILES_VIEW = ("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+                     "map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id")
+
+# Statements (compiled once per connection by the statement cache of sqlite3)
+SELECT_TILE = ("SELECT t.tile_data, i.updated FROM tiles t LEFT JOIN tile_info i "
+               "ON i.zoom_level = t.zoom_level AND i.tile_column = t.tile_column AND i.tile_row = t.tile_row "
+               "WHERE t.zoom_level = ? AND t.tile_column = ? AND t.tile_row = ?")
+SELECT_TILE_EXISTS = "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+SELECT_TILE_SIZE = "SELECT length(tile_data) FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+SELECT_TILE_TIME = ("SELECT i.updated FROM tiles t LEFT JOIN tile_info i "
+                    "ON i.zoom_level = t.zoom_level AND i.tile_column = t.tile_column AND i.tile_row = t.tile_row "
+                    "WHERE t.zoom_level = ? AND t.tile_column = ? AND t.tile_row = ?")
+SELECT_VALIDATORS = "SELECT etag, last_modified FROM tile_info WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+SELECT_NEGATIVE = "SELECT status, expires FROM missing_tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+SELECT_SIZES = "SELECT length(tile_data) FROM tiles LIMIT ?"
+SELECT_TILE_SIZES = ("SELECT t.zoom_level, t.tile_column, t.tile_row, length(t.tile_data), i.updated FROM tiles t LEFT JOIN tile_info i "
+                     "ON i.zoom_level = t.zoom_level AND i.tile_column = t.tile_column AND i.tile_row = t.tile_row")
+INSERT_IMAGE = "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)"
+INSERT_TILE = "INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)"
+UPSERT_TILE_TIME = ("INSERT INTO tile_info (zoom_level, tile_column, tile_row, updated) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET updated = excluded.updated")
+UPSERT_VALIDATORS = ("INSERT INTO tile_info (zoom_level, tile_column, tile_row, etag, last_modified) VALUES (?, ?, ?, ?, ?) "
+                     "ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified")
+DELETE_NEGATIVE = "DELETE FROM missing_tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+DELETE_TILE = "DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+SELECT_TILE_ID = "SELECT tile_id FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+DELETE_IMAGE_UNUSED = "DELETE FROM images WHERE tile_id = ? AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id = ?)"
+SELECT_UNUSED_SIZE = "SELECT coalesce(sum(length(tile_data)), 0) FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)"
+DELETE_UNUSED_IMAGES = "DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)"
+DELETE_TILE_INFO = "DELETE FROM tile_info WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+INSERT_NEGATIVE = "INSERT OR REPLACE INTO missing_tiles (zoom_level, tile_column, tile_row, status, expires) VALUES (?, ?, ?, ?, ?)"
+
+class MBTilesStore:
+    """
+    One MBTiles file per layer. Identical tiles share one row of images (tile_id is the
+    digest of the content), the view tiles keeps the file readable for MBTiles tools.
+    Reads borrow a connection from a pool per process and layer (the reads come
+    from the short-lived download threads of the image requests), the writer and
+    janitor threads keep their own connection. Writes go through a queue to a
+    writer thread that inserts them in batches.
+    Writes not yet committed are kept in memory and seen by the reads of this
+    process. Other processes see them after the next batch (the RAM cache is
+    shared anyway).
+    """
+
+    def __init__(self, cache_dir, layer_formats, attributions=None):
+        self.cache_dir = cache_dir
+        self.layer_formats = layer_formats
+        self.attributions = attributions or {}
+        self.connections = local()
+        self.read_pool = {}
+        self.read_pool_pid = None
+        self.read_pool_lock = Lock()
+        self.initialized = set()
+        self.init_lock = Lock()
+        # Pending writes: (layer, zoom, x, y) -> tile (data, time), validators or negative entry
+        self.pending_tiles = {}
+        self.pending_validators = {}
+        self.pending_negatives = {}
+        self.pending_lock = Lock()
+        self.writes = queue.Queue()
+        self.writer = None
+        self.writer_pid = None
+        atexit.register(self.flush)
+
+    def get_path(self, layer):
+        return os.path.join(self.cache_dir, f"{layer.replace('/', '_')}.mbtiles")
+
+    def connect(self, layer):
+        """
+        Returns the connection of this thread to the MBTiles file of a layer
+        (writer and janitor threads, which run as long as the process).
+        """
+        connections = getattr(self.connections, "by_layer", None)
+        if connections is None or getattr(self.connections, "pid", None) != os.getpid():
+            connections = self.connections.by_layer = {}
+            self.connections.pid = os.getpid()
+        connection = connections.get(layer)
+        if connection is None:
+            connection = connections[layer] = self.open_connection(layer)
+        return connection
+
+    # Function to open a connection, the file and its tables are created with the first connection
+    def open_connection(self, layer):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        connection = sqlite3.connect(self.get_path(layer), timeout=MBTILES_BUSY_TIMEOUT, isolation_level=None,
+                                     cached_statements=64, check_same_thread=False)
+        connection.execute("PRAGMA synchronous = NORMAL")
+        with self.init_lock:
+            if layer not in self.initialized:
+                self.create_tables(connection, layer)
+                self.initialized.add(layer)
+        return connection
+
+    @contextmanager
+    def read_connection(self, layer):
+        """
+        Lends a read connection of this process to the MBTiles file of a layer. At most
+        MBTILES_READ_POOL idle connections are kept per layer, further ones are closed.
+        """
+        with self.read_pool_lock:
+            if self.read_pool_pid != os.getpid():
+                self.read_pool = {}
+                self.read_pool_pid = os.getpid()
+            idle = self.read_pool.setdefault(layer, [])
+            connection = idle.pop() if idle else None
+        if connection is None:
+            connection = self.open_connection(layer)
+        try:
+            yield connection
+        finally:
+            with self.read_pool_lock:
+                idle = self.read_pool.setdefault(layer, [])
+                if len(idle) < MBTILES_READ_POOL:
+                    idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    def create_tables(self, connection, layer):
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript(MBTILES_SCHEMA)
+        row = connection.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()
+        if row is None:
+            connection.execute(CREATE_TILES_VIEW)
+        elif row[0] == "table":
+            self.deduplicate_tiles(connection, layer)
+        metadata = {
+            "name": layer,
+            "format": self.layer_formats.get(layer, "png"),
+            "type": "overlay" if layer == "seamark" else "baselayer",
+            "version": "1.3",
+            "description": f"Maps Converter tile cache {layer}",
+            "attribution": self.attributions.get(layer, ""),
+        }
+        connection.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+
+    def deduplicate_tiles(self, connection, layer):
+        """
+        Moves the tiles of an MBTiles file with a plain tiles table (older cache, other
+        MBTiles tools) into map and images, identical tiles are stored once.
+        """
+        started = time.monotonic()
+        connection.create_function("tile_digest", 1, lambda tile_data: tile_digest(bytes(tile_data or b"")), deterministic=True)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()
+            if row[0] != "table":
+                connection.execute("ROLLBACK")
+                return      # Moved by another worker process in the meantime
+            connection.execute("INSERT OR IGNORE INTO images (tile_id, tile_data) SELECT tile_digest(tile_data), tile_data FROM tiles")
+            connection.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) "
+                               "SELECT zoom_level, tile_column, tile_row, tile_digest(tile_data) FROM tiles")
+            connection.execute("DROP TABLE tiles")
+            connection.execute(CREATE_TILES_VIEW)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        tiles, images = connection.execute("SELECT (SELECT count(*) FROM map), (SELECT count(*) FROM images)").fetchone()
+        print(f"{self.get_path(layer)}: {tiles} tiles deduplicated to {images} images ({time.monotonic() - started:.1f} s)")
+
+    @staticmethod
+    def tms_row(zoom, y):
+        # MBTiles counts the rows from the south (TMS), the tile servers from the north (XYZ)
+        return (1 << zoom) - 1 - y
+
+    def query_one(self, layer, sql, zoom, x, y):
+        with self.read_connection(layer) as connection:
+            return connection.execute(sql, (zoom, x, self.tms_row(zoom, y))).fetchone()
+
+    def load_tile(self, layer, zoom, x, y):
+        with self.pending_lock:
+            tile = self.pending_tiles.get((layer, zoom, x, y))
+        if tile is not None:
+            return tile
+        row = self.query_one(layer, SELECT_TILE, zoom, x, y)
+        if row is None:
+            return None
+        return bytes(row[0]), row[1] or 0.0   # Tiles of other MBTiles tools have no time, they are revalidated
+
+    def tile_exists(self, layer, zoom, x, y):
+        with self.pending_lock:
+            if (layer, zoom, x, y) in self.pending_tiles:
+                return True
+        return self.query_one(layer, SELECT_TILE_EXISTS, zoom, x, y) is not None
+
+    def tile_time(self, layer, zoom, x, y):
+        with self.pending_lock:
+            tile = self.pending_tiles.get((layer, zoom, x, y))
+        if tile is not None:
+            return tile[1]
+        row = self.query_one(layer, SELECT_TILE_TIME, zoom, x, y)
+        return None if row is None else (row[0] or 0.0)
+
+    def tile_size(self, layer, zoom, x, y):
+        with self.pending_lock:
+            tile = self.pending_tiles.get((layer, zoom, x, y))
+        if tile is not None:
+            return len(tile[0])
+        row = self.query_one(layer, SELECT_TILE_SIZE, zoom, x, y)
+        return None if row is None else row[0]
+
+    def store_tile(self, layer, zoom, x, y, tile_data, extension):
+        tile = (tile_data, time.time())
+        with self.pending_lock:
+            self.pending_tiles[(layer, zoom, x, y)] = tile
+            self.pending_negatives.pop((layer, zoom, x, y), None)
+        self.write(("tile", layer, zoom, x, y, tile))
+
+    def touch_tile(self, layer, zoom, x, y):
+        self.write(("touch", layer, zoom, x, y, time.time()))
+
+    def delete_tile(self, layer, zoom, x, y):
+        with self.pending_lock:
+            self.pending_tiles.pop((layer, zoom, x, y), None)
+            self.pending_validators.pop((layer, zoom, x, y), None)
+        self.write(("delete", layer, zoom, x, y, None))
+
+    def load_validators(self, layer, zoom, x, y):
+        with self.pending_lock:
+            validators = self.pending_validators.get((layer, zoom, x, y))
+        if validators is not None:
+            return validators
+        row = self.query_one(layer, SELECT_VALIDATORS, zoom, x, y)
+        validators = {}
+        if row is not None and row[0]:
+            validators["etag"] = row[0]
+        if row is not None and row[1]:
+            validators["last_modified"] = row[1]
+        return validators
+
+    def store_validators(self, layer, zoom, x, y, validators):
+        with self.pending_lock:
+            self.pending_validators[(layer, zoom, x, y)] = validators
+        self.write(("validators", layer, zoom, x, y, validators))
+
+    def load_negative(self, layer, zoom, x, y):
+        with self.pending_lock:
+            entry = self.pending_negatives.get((layer, zoom, x, y))
+        if entry is not None:
+            return entry
+        row = self.query_one(layer, SELECT_NEGATIVE, zoom, x, y)
+        return None if row is None else {"status": row[0], "expires": row[1]}
+
+    def store_negative(self, layer, zoom, x, y, entry):
+        with self.pending_lock:
+            self.pending_negatives[(layer, zoom, x, y)] = entry
+        self.write(("negative", layer, zoom, x, y, entry))
+
+    def sample_tile_sizes(self, layer, count):
+        if not os.path.exists(self.get_path(layer)):
+            return []
+        with self.read_connection(layer) as connection:
+            return [row[0] for row in connection.execute(SELECT_SIZES, (count,))]
+
+    def iter_tile_sizes(self, layer):
+        if not os.path.exists(self.get_path(layer)):
+            return
+        with self.read_connection(layer) as connection:
+            for zoom, x, row, size, updated in connection.execute(SELECT_TILE_SIZES):
+                yield zoom, x, self.tms_row(zoom, row), size, updated or 0.0
+
+    def reclaim(self, full=True):
+        """
+        Removes the images no tile refers to any more (replaced tiles), returns the number
+        of bytes freed. The free pages are reused by SQLite, the files do not shrink. The
+        images of evicted tiles are removed with the tile (full=False: nothing to do).
+        """
+        freed = 0
+        if not full:
+            return freed
+        for layer in self.layer_formats:
+            if os.path.exists(self.get_path(layer)):
+                connection = self.connect(layer)
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    freed += connection.execute(SELECT_UNUSED_SIZE).fetchone()[0]
+                    connection.execute(DELETE_UNUSED_IMAGES)
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+        return freed
+
+    # Function to queue a write for the writer thread (started on the first write of each process)
+    def write(self, operation):
+        if self.writer_pid != os.getpid():
+            with self.init_lock:
+                if self.writer_pid != os.getpid():
+                    self.writes = queue.Queue()
+                    self.writer = Thread(target=self.run_writer, name="mbtiles-writer", daemon=True)
+                    self.writer_pid = os.getpid()
+                    self.writer.start()
+        self.writes.put(operation)
+
+    def run_writer(self):
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + MBTILES_BATCH_DELAY
+            while len(batch) < MBTILES_BATCH_SIZE:
+                try:
+                    batch.append(self.writes.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except sqlite3.Error as e:
+                print(f"MBTiles write of {len(batch)} entries failed: {e}")
+            finally:
+                self.clear_pending(batch)
+                for _ in batch:
+                    self.writes.task_done()
+
+    def write_batch(self, batch):
+        """
+        Writes a batch with one transaction per layer file.
+        """
+        by_layer = {}
+        for operation in batch:
+            by_layer.setdefault(operation[1], []).append(operation)
+        for layer, operations in by_layer.items():
+            connection = self.connect(layer)
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for kind, _, zoom, x, y, value in operations:
+                    key = (zoom, x, self.tms_row(zoom, y))
+                    if kind == "tile":
+                        digest = tile_digest(value[0])
+                        connection.execute(INSERT_IMAGE, (digest, value[0]))
+                        connection.execute(INSERT_TILE, key + (digest,))
+                        connection.execute(UPSERT_TILE_TIME, key + (value[1],))
+                        connection.execute(DELETE_NEGATIVE, key)
+                    elif kind == "touch":
+                        connection.execute(UPSERT_TILE_TIME, key + (value,))
+                    elif kind == "validators":
+                        connection.execute(UPSERT_VALIDATORS, key + (value.get("etag"), value.get("last_modified")))
+                    elif kind == "negative":
+                        connection.execute(INSERT_NEGATIVE, key + (value["status"], value["expires"]))
+                    elif kind == "delete":
+                        # The image goes with its last tile (map_tile_id index)
+                        row = connection.execute(SELECT_TILE_ID, key).fetchone()
+                        connection.execute(DELETE_TILE, key)
+                        connection.execute(DELETE_TILE_INFO, key)
+                        if row is not None:
+                            connection.execute(DELETE_IMAGE_UNUSED, (row[0], row[0]))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    # Function to forget the pending writes of a written batch (unless they were replaced in the meantime)
+    def clear_pending(self, batch):
+        pending = {"tile": self.pending_tiles, "validators": self.pending_validators, "negative": self.pending_negatives}
+        with self.pending_lock:
+            for kind, layer, zoom, x, y, value in batch:
+                entries = pending.get(kind)
+                if entries is not None and entries.get((layer, zoom, x, y)) is value:
+                    del entries[(layer, zoom, x, y)]
+
+    # Function to wait until all queued writes are in the MBTiles files
+    def flush(self):
+        if self.writer_pid == os.getpid():
+            self.writes.join()
+
+###################################################################################
+# Pack files (append-only, memory mapped)                                         #
+###################################################################################
+
+PACK_FILE_SIZE = 256 * 1024 * 1024  # A new pack file is started when a pack file would grow beyond this size
+PACK_INDEX_REFRESH = 1.0            # Seconds between reads of the index entries of other worker processes
+PACK_COMPACT_GARBAGE = 0.3          # Share of replaced bytes from which a layer is compacted (compact command)
+PACK_DEDUP_MAX_SIZE = 4096          # Identical tiles up to this size share one blob (plain sea, empty overlays), larger tiles are not compared
+PACK_WRITE_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+# Index entry: kind, zoom, x, y, pack number, offset, length (status of negative entries), time (expiry of negative entries)
+PACK_RECORD = struct.Struct("<BBIIHIId")
+PACK_TILE = 1           # Tile data in a pack file
+PACK_TOUCH = 2          # New time of download of an unchanged tile (HTTP 304)
+PACK_VALIDATORS = 3     # Validators (JSON) in a pack file
+PACK_NEGATIVE = 4       # Negative cache entry
+PACK_DELETE = 5         # Tile and validators removed (eviction)
+PACK_BLOB = 6           # Digest of a tile blob (x, y: 64 bits of the digest), later tiles with this content refer to the blob
+
+# Function to get the digest of a tile blob for the index (64 bits, checked against the data before a blob is shared)
+def pack_digest(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+# Function to combine the tile coordinates to one integer key (small index in memory)
+def pack_key(zoom, x, y):
+    return (zoom << 56) | (x << 28) | y
+
+def unpack_key(key):
+    return key >> 56, (key >> 28) & 0xFFFFFFF, key & 0xFFFFFFF
+
+class PackLayer:
+    """
+    Pack files and index of one layer, opened by one worker process.
+
+    packs/<layer>/CURRENT           Generation of the files, changed by a compaction
+    packs/<layer>/GGGG-NNNNN.pack   Tile data and validators, appended one after the other
+    packs/<layer>/index-GGGG.log    Index entries (PACK_RECORD), appended after their data
+    packs/<layer>/lock              flock() of the writers of all worker processes
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+        self.lock = RLock()
+        self.lock_file = open(os.path.join(directory, "lock"), "a")
+        self.index_fd = None
+        self.index_reader = None
+        self.maps = {}
+        self.load()
+
+    def get_path(self, generation, pack=None):
+        if pack is None:
+            return os.path.join(self.directory, f"index-{generation:04d}.log")
+        return os.path.join(self.directory, f"{generation:04d}-{pack:05d}.pack")
+
+    def load(self):
+        """
+        Builds the index in memory from the index file of the current generation.
+        """
+        with self.lock:
+            self.close()
+            try:
+                with open(os.path.join(self.directory, "CURRENT")) as f:
+                    self.generation = int(f.read())
+            except (OSError, ValueError):
+                self.generation = 0
+            index_path = self.get_path(self.generation)
+            self.index_fd = os.open(index_path, PACK_WRITE_FLAGS, 0o644)
+            self.index_reader = open(index_path, "rb")
+            self.index_position = 0
+            self.tiles = {}         # key -> (pack, offset, length, time of download)
+            self.validators = {}    # key -> (pack, offset, length)
+            self.negatives = {}     # key -> (status, expires)
+            self.blobs = {}         # Digest -> (pack, offset, length) of the small tile blobs
+            self.blob_digests = {}  # (pack, offset, length) -> digest
+            self.blob_refs = {}     # (pack, offset, length) -> tiles referring to the blob, only for shared blobs (else 1)
+            self.pack_ends = {}     # Pack -> end of the data, blobs before the end are shared by a new tile
+            self.size = 0           # Bytes of all entries in the pack files
+            self.garbage = 0        # Bytes of replaced tiles and validators
+            self.last_pack = 0
+            self.read_index()
+
+    def close(self):
+        for mapping in self.maps.values():
+            mapping.close()
+        self.maps = {}
+        if self.index_fd is not None:
+            os.close(self.index_fd)
+            self.index_reader.close()
+            self.index_fd = self.index_reader = None
+
+    def read_index(self, size=None):
+        with self.lock:
+            if size is None:
+                size = os.fstat(self.index_reader.fileno()).st_size
+            end = size - size % PACK_RECORD.size    # A torn last entry (crashed writer) is ignored
+            if end > self.index_position:
+                self.index_reader.seek(self.index_position)
+                data = self.index_reader.read(end - self.index_position)
+                self.index_position = end
+                for entry in PACK_RECORD.iter_unpack(data):
+                    self.apply(*entry)
+            self.checked = time.monotonic()
+
+    def apply(self, kind, zoom, x, y, pack, offset, length, timestamp):
+        if kind == PACK_BLOB:
+            digest = (x << 32) | y
+            self.blobs[digest] = (pack, offset, length)
+            self.blob_digests[(pack, offset, length)] = digest
+            return
+        key = pack_key(zoom, x, y)
+        if kind == PACK_TILE:
+            self.release_blob(self.tiles.get(key))
+            self.tiles[key] = (pack, offset, length, timestamp)
+            if offset < self.pack_ends.get(pack, 0):
+                self.blob_refs[(pack, offset, length)] = self.blob_refs.get((pack, offset, length), 1) + 1
+            self.negatives.pop(key, None)
+        elif kind == PACK_TOUCH:
+            entry = self.tiles.get(key)
+            if entry is not None:
+                self.tiles[key] = entry[:3] + (timestamp,)
+        elif kind == PACK_VALIDATORS:
+            replaced = self.validators.get(key)
+            if replaced is not None:
+                self.garbage += replaced[2]
+            self.validators[key] = (pack, offset, length)
+        elif kind == PACK_NEGATIVE:
+            self.negatives[key] = (length, timestamp)
+        elif kind == PACK_DELETE:
+            self.release_blob(self.tiles.pop(key, None))
+            removed = self.validators.pop(key, None)
+            if removed is not None:
+                self.garbage += removed[2]
+        if kind in (PACK_TILE, PACK_VALIDATORS) and offset >= self.pack_ends.get(pack, 0):
+            self.size += length
+            self.pack_ends[pack] = offset + length
+            self.last_pack = max(self.last_pack, pack)
+
+    # Function to drop a reference to a tile blob, the blob is garbage when no tile refers to it any more
+    def release_blob(self, entry):
+        if entry is None:
+            return
+        location = entry[:3]
+        refs = self.blob_refs.pop(location, 1) - 1
+        if refs > 0:
+            self.blob_refs[location] = refs
+            return
+        self.garbage += location[2]
+        digest = self.blob_digests.pop(location, None)
+        if digest is not None and self.blobs.get(digest) == location:
+            del self.blobs[digest]
+
+    # Function to read the index entries written by other worker processes (at most every PACK_INDEX_REFRESH seconds)
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self.checked < PACK_INDEX_REFRESH:
+            return
+        with self.lock:
+            status = os.fstat(self.index_reader.fileno())
+            if status.st_nlink == 0:
+                self.load()     # Index file removed by a compaction, new generation
+            else:
+                self.read_index(status.st_size)
+
+    def read_blob(self, pack, offset, length):
+        """
+        Returns the data of an entry from the memory map of its pack file (lock held).
+        A pack file that has grown since it was mapped is mapped again.
+        """
+        if length == 0:
+            return b""
+        mapping = self.maps.get(pack)
+        if mapping is None or offset + length > len(mapping):
+            if mapping is not None:
+                mapping.close()
+            with open(self.get_path(self.generation, pack), "rb") as f:
+                mapping = self.maps[pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapping[offset:offset + length]
+
+    def lookup(self, table, key, read=False):
+        """
+        Returns (entry, data) of a key in the tiles, validators or negatives of the index,
+        (None, None) if there is no entry. On a miss the index is read again first, the
+        entry may have been written by another worker process just now. A pack file
+        removed by the compaction of another worker process (index not read again yet)
+        loads the new generation, if the entry cannot be read then either it is a miss.
+        """
+        for force in (False, True):
+            self.refresh(force)
+            with self.lock:
+                entry = getattr(self, table).get(key)
+                if entry is None:
+                    continue
+                if not read:
+                    return entry, None
+                try:
+                    return entry, self.read_blob(*entry[:3])
+                except OSError:
+                    if force:
+                        break
+                    self.load()     # Closes the memory maps of the old generation
+        return None, None
+
+    @contextmanager
+    def file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def write_entries(self, generation, index_fd, pack, entries, blobs):
+        """
+        Appends the data of the entries (kind, key, data or None, status, time) to the pack
+        files of a generation, starting with pack (a new pack file is started at PACK_FILE_SIZE),
+        and then their index entries to the index file (lock held). A small tile with the
+        content of a blob in blobs (digest -> location, blobs of the current generation) or of
+        a blob written by this call refers to that blob instead of being written again.
+        """
+        records = []
+        written = {}
+        fd = None
+        try:
+            for kind, key, data, status, timestamp in entries:
+                zoom, x, y = unpack_key(key)
+                if data is None:
+                    records.append(PACK_RECORD.pack(kind, zoom, x, y, 0, 0, status, timestamp))
+                    continue
+                digest = None
+                if kind == PACK_TILE and len(data) <= PACK_DEDUP_MAX_SIZE:
+                    digest = pack_digest(data)
+                    location = written.get(digest)
+                    if location is None and digest in blobs and self.read_blob(*blobs[digest]) == data:
+                        location = blobs[digest]
+                    if location is not None:
+                        records.append(PACK_RECORD.pack(kind, zoom, x, y, *location, timestamp))
+                        continue
+                if fd is None:
+                    fd = os.open(self.get_path(generation, pack), PACK_WRITE_FLAGS, 0o644)
+                    offset = os.fstat(fd).st_size
+                if offset > 0 and offset + len(data) > PACK_FILE_SIZE:
+                    os.close(fd)
+                    pack += 1
+                    fd = os.open(self.get_path(generation, pack), PACK_WRITE_FLAGS, 0o644)
+                    offset = os.fstat(fd).st_size
+                os.write(fd, data)
+                records.append(PACK_RECORD.pack(kind, zoom, x, y, pack, offset, len(data), timestamp))
+                if digest is not None:
+                    records.append(PACK_RECORD.pack(PACK_BLOB, 0, digest >> 32, digest & 0xFFFFFFFF, pack, offset, len(data), 0.0))
+                    written[digest] = (pack, offset, len(data))
+                offset += len(data)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        # The index entries follow their data, readers never find an entry of unwritten data
+        size = os.fstat(index_fd).st_size
+        if size % PACK_RECORD.size:
+            os.ftruncate(index_fd, size - size % PACK_RECORD.size)
+        os.write(index_fd, b"".join(records))
+
+    def append(self, entries):
+        with self.lock, self.file_lock():
+            self.refresh(force=True)
+            self.write_entries(self.generation, self.index_fd, self.last_pack, entries, self.blobs)
+            self.read_index()
+
+    def live_entries(self, generation, tiles, validators, negatives):
+        """
+        Generator of the entries of an index snapshot, the tile data is read one tile after
+        the other from own memory maps (the reads of this process keep using theirs).
+        """
+        now = time.time()
+        maps = {}
+
+        def read(pack, offset, length):
+            if length == 0:
+                return b""
+            if pack not in maps:
+                with open(self.get_path(generation, pack), "rb") as f:
+                    maps[pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return maps[pack][offset:offset + length]
+
+        try:
+            for key, (pack, offset, length, timestamp) in tiles.items():
+                yield PACK_TILE, key, read(pack, offset, length), 0, timestamp
+            for key, (pack, offset, length) in validators.items():
+                yield PACK_VALIDATORS, key, read(pack, offset, length), 0, 0.0
+            for key, (status, expires) in negatives.items():
+                if expires > now:
+                    yield PACK_NEGATIVE, key, None, status, expires
+        finally:
+            for mapping in maps.values():
+                mapping.close()
+
+    def compact(self):
+        """
+        Copies the current tiles, validators and negative entries into the pack files of a
+        new generation and removes the files of the old generation. Other worker processes
+        change to the new generation when they find the old index file removed.
+        The writers of all processes wait for the compaction (file lock), the reads of
+        this process only for the change to the new generation. Returns the number of
+        bytes freed.
+        """
+        with self.file_lock():
+            # Snapshot of the index, no other process appends while the file lock is held
+            with self.lock:
+                self.refresh(force=True)
+                old_generation = self.generation
+                tiles, validators, negatives = dict(self.tiles), dict(self.validators), dict(self.negatives)
+                freed = self.garbage
+            generation = old_generation + 1
+            for name in os.listdir(self.directory):
+                if name.startswith(f"{generation:04d}-"):
+                    os.remove(os.path.join(self.directory, name))   # Left over by a crashed compaction
+            index_fd = os.open(self.get_path(generation), PACK_WRITE_FLAGS | os.O_TRUNC, 0o644)
+            try:
+                self.write_entries(generation, index_fd, 0, self.live_entries(old_generation, tiles, validators, negatives), {})
+            finally:
+                os.close(index_fd)
+            with self.lock:
+                write_file_atomic(os.path.join(self.directory, "CURRENT"), str(generation).encode())
+                old_files = (f"{old_generation:04d}-", f"index-{old_generation:04d}.")
+                for name in os.listdir(self.directory):
+                    if name.startswith(old_files):
+                        os.remove(os.path.join(self.directory, name))
+                self.load()
+            return freed
+
+class PackStore:
+    """
+    Append-only pack files with an index in memory, one PackLayer per layer.
+    Small tiles with the content of a stored blob refer to that blob.
+    """
+
+    def __init__(self, cache_dir, layer_formats):
+        self.pack_dir = os.path.join(cache_dir, "packs")
+        self.layer_formats = layer_formats
+        self.layers = {}
+        self.layers_lock = Lock()
+
+    def get_layer(self, layer):
+        pack_layer = self.layers.get(layer)
+        if pack_layer is None or pack_layer.pid != os.getpid():
+            with self.layers_lock:
+                pack_layer = self.layers.get(layer)
+                # Each worker process opens its own files, flock() is shared by inherited file descriptors
+                if pack_layer is None or pack_layer.pid != os.getpid():
+                    pack_layer = self.layers[layer] = PackLayer(os.path.join(self.pack_dir, layer.replace("/", "_")))
+        return pack_layer
+
+    def load_tile(self, layer, zoom, x, y):
+        entry, tile_data = self.get_layer(layer).lookup("tiles", pack_key(zoom, x, y), read=True)
+        return None if entry is None else (tile_data, entry[3])
+
+    def tile_exists(self, layer, zoom, x, y):
+        return self.get_layer(layer).lookup("tiles", pack_key(zoom, x, y))[0] is not None
+
+    def tile_time(self, layer, zoom, x, y):
+        entry = self.get_layer(layer).lookup("tiles", pack_key(zoom, x, y))[0]
+        return None if entry is None else entry[3]
+
+    def tile_size(self, layer, zoom, x, y):
+        entry = self.get_layer(layer).lookup("tiles", pack_key(zoom, x, y))[0]
+        return None if entry is None else entry[2]
+
+    def store_tile(self, layer, zoom, x, y, tile_data, extension):
+        self.get_layer(layer).append([(PACK_TILE, pack_key(zoom, x, y), bytes(tile_data), 0, time.time())])
+
+    def touch_tile(self, layer, zoom, x, y):
+        self.get_layer(layer).append([(PACK_TOUCH, pack_key(zoom, x, y), None, 0, time.time())])
+
+    def delete_tile(self, layer, zoom, x, y):
+        self.get_layer(layer).append([(PACK_DELETE, pack_key(zoom, x, y), None, 0, time.time())])
+
+    def load_validators(self, layer, zoom, x, y):
+        entry, data = self.get_layer(layer).lookup("validators", pack_key(zoom, x, y), read=True)
+        return {} if entry is None else json.loads(data)
+
+    def store_validators(self, layer, zoom, x, y, validators):
+        self.get_layer(layer).append([(PACK_VALIDATORS, pack_key(zoom, x, y), json.dumps(validators).encode(), 0, 0.0)])
+
+    def load_negative(self, layer, zoom, x, y):
+        entry = self.get_layer(layer).lookup("negatives", pack_key(zoom, x, y))[0]
+        return None if entry is None else {"status": entry[0], "expires": entry[1]}
+
+    def store_negative(self, layer, zoom, x, y, entry):
+        self.get_layer(layer).append([(PACK_NEGATIVE, pack_key(zoom, x, y), None, entry["status"], entry["expires"])])
+
+    def sample_tile_sizes(self, layer, count):
+        pack_layer = self.get_layer(layer)
+        with pack_layer.lock:
+            return [entry[2] for entry in islice(pack_layer.tiles.values(), count)]
+
+    def iter_tile_sizes(self, layer):
+        pack_layer = self.get_layer(layer)
+        with pack_layer.lock:
+            entries = list(pack_layer.tiles.items())
+        for key, (pack, offset, length, updated) in entries:
+            yield unpack_key(key) + (length, updated)
+
+    # Function to compact the layers with many removed or replaced bytes, returns the number of bytes freed
+    # (full=False after an eviction: nothing, a compaction blocks the writers of all processes and runs once a day)
+    def reclaim(self, full=True):
+        freed = 0
+        if not full:
+            return freed
+        for pack_layer in list(self.layers.values()):
+            if pack_layer.pid == os.getpid() and pack_layer.size and pack_layer.garbage / pack_layer.size >= PACK_COMPACT_GARBAGE:
+                freed += pack_layer.compact()
+        return freed
+
+    def flush(self):
+        pass
+
+###################################################################################
+# Backend selection and converter                                                 #
+###################################################################################
+
+TILE_STORES = {
+    "tree": FileTreeStore,
+    "mbtiles": MBTilesStore,
+    "pack": PackStore,
+}
+
+def open_tile_store(kind, cache_dir, layer_formats, attributions=None):
+    if kind not in TILE_STORES:
+        raise ValueError(f"Unknown tile store '{kind}' ({', '.join(TILE_STORES)})")
+    if kind == "mbtiles":
+        return MBTilesStore(cache_dir, layer_formats, attributions)
+    return TILE_STORES[kind](cache_dir, layer_formats)
+
+# Function to copy one layer of the file tree into its MBTiles file, returns the number of tiles
+def convert_layer_to_mbtiles(tree, layer):
+    # The MBTiles format is the format of the first tile of the layer
+    layer_format = "png"
+    for _, _, _, tile_data, _, _, _ in tree.iter_layer(layer):
+        if tile_data:
+            layer_format = sniff_tile_format(tile_data) or "png"
+            break
+    store = MBTilesStore(tree.cache_dir, {layer: layer_format})
+    connection = store.connect(layer)
+    count = 0
+    connection.execute("BEGIN")
+    for zoom, x, y, tile_data, updated, validators, negative in tree.iter_layer(layer):
+        key = (zoom, x, store.tms_row(zoom, y))
+        if tile_data is not None:
+            digest = tile_digest(tile_data)
+            connection.execute(INSERT_IMAGE, (digest, tile_data))
+            connection.execute(INSERT_TILE, key + (digest,))
+            connection.execute(UPSERT_TILE_TIME, key + (updated,))
+            if validators:
+                connection.execute(UPSERT_VALIDATORS, key + (validators.get("etag"), validators.get("last_modified")))
+            count += 1
+            # Commit in batches, the converter may run beside the server
+            if count % 1000 == 0:
+                connection.execute("COMMIT")
+                connection.execute("BEGIN")
+        elif negative is not None:
+            connection.execute(INSERT_NEGATIVE, key + (negative["status"], negative["expires"]))
+    connection.execute("COMMIT")
+    return count
+
+# Function to copy one layer of the file tree into its pack files, returns the number of tiles
+def convert_layer_to_packs(tree, layer):
+    pack_layer = PackStore(tree.cache_dir, {}).get_layer(layer)
+    count = 0
+    entries = []
+    for zoom, x, y, tile_data, updated, validators, negative in tree.iter_layer(layer):
+        key = pack_key(zoom, x, y)
+        if tile_data is not None:
+            entries.append((PACK_TILE, key, tile_data, 0, updated))
+            if validators:
+                entries.append((PACK_VALIDATORS, key, json.dumps(validators).encode(), 0, 0.0))
+            count += 1
+        elif negative is not None:
+            entries.append((PACK_NEGATIVE, key, None, negative["status"], negative["expires"]))
+        if len(entries) >= 1000:
+            pack_layer.append(entries)
+            entries = []
+    pack_layer.append(entries)
+    return count
+
+def convert_tree(cache_dir, kind):
+    """
+    Copies all tiles, validators and negative cache entries of the file tree into
+    MBTiles files or pack files (one per layer). Tiles that are already there are
+    replaced. The file tree is not changed.
+    """
+    tree = FileTreeStore(cache_dir, {})
+    layers = tree.find_layers()
+    if not layers:
+        print(f"No tiles found in {cache_dir}")
+        return
+    for layer in layers:
+        started = time.monotonic()
+        if kind == "mbtiles":
+            count = convert_layer_to_mbtiles(tree, layer)
+        else:
+            count = convert_layer_to_packs(tree, layer)
+        print(f"{layer}: {count} tiles ({time.monotonic() - started:.1f} s)")
+    print(f"Start the server with TILE_STORE={kind} to use the converted tiles.")
+
+def compact_packs(cache_dir, min_garbage):
+    """
+    Compacts the pack files of all layers with at least min_garbage replaced bytes.
+    """
+    pack_dir = os.path.join(cache_dir, "packs")
+    names = sorted(os.listdir(pack_dir)) if os.path.isdir(pack_dir) else []
+    for name in names:
+        pack_layer = PackLayer(os.path.join(pack_dir, name))
+        garbage = pack_layer.garbage / pack_layer.size if pack_layer.size else 0.0
+        if garbage < min_garbage:
+            print(f"{name}: {garbage * 100:.0f} % replaced, not compacted")
+            continue
+        started = time.monotonic()
+        freed = pack_layer.compact()
+        print(f"{name}: {freed / 1024 / 1024:.1f} MB freed ({time.monotonic() - started:.1f} s)")
+        pack_layer.close()
+
+def dedup_tree(cache_dir):
+    """
+    Replaces identical tiles of the file tree (stored before the deduplication) by hard
+    links to one blob each and removes the blobs no tile links to any more. The time of
+    download of merged tiles is the newest one.
+    """
+    tree = FileTreeStore(cache_dir, {})
+    for layer in tree.find_layers():
+        started = time.monotonic()
+        count = 0
+        saved = 0
+        for zoom, x, y, size, updated in tree.iter_tile_sizes(layer):
+            tile_path = tree.find_path(layer, zoom, x, y)
+            try:
+                if tile_path is None or os.stat(tile_path).st_nlink > 1:
+                    continue    # Already linked to its blob
+                with open(tile_path, "rb") as f:
+                    tile_data = f.read()
+                blob_path = tree.get_blob_path(tile_digest(tile_data))
+                if not os.path.exists(blob_path):
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.link(tile_path, blob_path)   # First tile with this content becomes the blob
+                elif tree.link_blob(tile_data, tile_path, max(updated, os.path.getmtime(blob_path))):
+                    saved += size
+                else:
+                    break
+                count += 1
+            except OSError as e:
+                print(f"Tile {layer} {x}, {y} not deduplicated ({e})")
+        print(f"{layer}: {count} tiles linked, {saved / 1024 / 1024:.1f} MB saved ({time.monotonic() - started:.1f} s)")
+    freed = tree.reclaim()
+    print(f"Unused blobs removed: {freed / 1024 / 1024:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Tile store tools of the Maps Converter.")
+    parser.add_argument("command", choices=["convert", "compact", "dedup"], help="convert: copy the file tree into MBTiles or pack files, compact: remove replaced tiles from the pack files, dedup: link identical tiles of the file tree to one blob")
+    parser.add_argument("--cache-dir", default=os.path.join(os.getcwd(), "tile_cache"), help="Tile cache directory (default ./tile_cache)")
+    parser.add_argument("--to", choices=["mbtiles", "pack"], default="mbtiles", help="Target of convert (default mbtiles)")
+    parser.add_argument("--min-garbage", type=float, default=PACK_COMPACT_GARBAGE, help=f"Share of replaced bytes from which a layer is compacted (default {PACK_COMPACT_GARBAGE})")
+    args = parser.parse_args()
+    if args.command == "convert":
+        convert_tree(args.cache_dir, args.to)
+    elif args.command == "compact":
+        compact_packs(args.cache_dir, args.min_garbage)
+    elif args.command == "dedup":
+        dedup_tree(args.cache_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())